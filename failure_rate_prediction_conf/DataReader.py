@@ -1,55 +1,191 @@
+import os
+import copy
 import pickle
-from keras.preprocessing.sequence import pad_sequences
+import hashlib
 import numpy as np
-from collections import Counter
-from sklearn.utils import shuffle
+from functools import lru_cache
 from scipy.sparse import csr_matrix
-from failure_rate_prediction_conf.data_entry_class.ImpressionEntry import MIN_OCCURRENCE_SYMBOL, MIN_OCCURRENCE as ORIGIN_MIN_OCCURRENCE
+from failure_rate_prediction_conf.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS, MIN_OCCURRENCE_SYMBOL, MIN_OCCURRENCE as ORIGIN_MIN_OCCURRENCE
+from util.sparse_batch import pad_csr_rows, row_min_max, batch_rows, bucket_batch_rows
+from util.row_subsets import RowSubsets
+from util.shards import load_shard_meta, iter_shard_buffers, BUFFER_SHARDS
+from util.shared_arrays import SharedArrays
+
+CACHE_DIR_NAME = 'cache'  # next to the data set file
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+ATTACH_SHARED = True  # load_survival_data attaches the data set when DataServer hosts it, instead of loading a copy
+
+
+@lru_cache(maxsize=None)
+def _load_dict(file_path):
+    ''' attr2idx and counter are read once per process, e.g. not again for every shard buffer '''
+    return pickle.load(open(file_path, 'rb'))
+
+
+def compact_col_map(num_columns, *dropped_col_indices):
+    ''' old column -> new column of the num_columns columns without the dropped ones (-1 for those) '''
+    keep = np.ones(num_columns, dtype=bool)
+    for col_indices in dropped_col_indices:
+        keep[np.asarray(col_indices).astype(int)] = False
+    return np.where(keep, np.cumsum(keep) - 1, -1)
 
 
 class SurvivalData:
 
     def __init__(self, times, events, sparse_features, sparse_headerbids,
-                 min_occurrence=ORIGIN_MIN_OCCURRENCE, only_hb_imp=False):
+                 min_occurrence=ORIGIN_MIN_OCCURRENCE, only_hb_imp=False, attr2idx=None, counter=None,
+                 infreq_col_indices=None):
+        '''
+        :param infreq_col_indices: the (user, page) columns of load_addtl_infreq(min_occurrence) when they are already
+                                   known, e.g. once for all the buffers of ShardedSurvivalData
+        '''
         self.times, self.events, self.sparse_features, self.sparse_headerbids = \
             times, events, sparse_features.tocsr(), sparse_headerbids.tocsr()
+        self.window_rows = None  # the rows of window(), within which every selection is taken
 
-        self.max_nonzero_len = Counter(self.sparse_features.nonzero()[0]).most_common(1)[0][1]  # 94
-        self.load_rares_index()
+        self.load_rares_index(attr2idx)
 
         self.infreq_user_col_indices, self.infreq_page_col_indices = np.array([]), np.array([])
         if min_occurrence > ORIGIN_MIN_OCCURRENCE:
-            print("Need to merge additional infreq users and pages")
-            self.infreq_user_col_indices, self.infreq_page_col_indices = self.load_addtl_infreq(min_occurrence)
+            if infreq_col_indices is None:
+                print("Need to merge additional infreq users and pages")
+                infreq_col_indices = self.load_addtl_infreq(min_occurrence, attr2idx, counter)
+            self.infreq_user_col_indices, self.infreq_page_col_indices = infreq_col_indices
             self.merge_addtl_infreq()
+        self.compact_columns()
 
-        if only_hb_imp:
-            num_rows_before_filtering = len(self.times)
-            print("Need to select impressions with hb")
-            hb_imp_rows = np.array(list(set(np.nonzero(self.sparse_headerbids)[0])))
-            self.times, self.events, self.sparse_features, self.sparse_headerbids = \
-            self.times[hb_imp_rows], self.events[hb_imp_rows], self.sparse_features[hb_imp_rows], self.sparse_headerbids[hb_imp_rows]
-            print("reduce from %d impressions to %d impressions" % (num_rows_before_filtering, len(self.times)))
-
-        self.num_instances = len(self.times)
+        self.max_nonzero_len = int(np.bincount(self.sparse_features.nonzero()[0]).max())  # 94
 
+        self.subsets = self.build_row_subsets()
 
+        ''' the rows batched by default; the data itself is kept whole '''
+        self.selection = ('has_hb',) if only_hb_imp else ()
+        if only_hb_imp:
+            print("Need to select impressions with hb")
+            print("reduce from %d impressions to %d impressions" % (len(self.times), self.subsets.count(*self.selection)))
+
+        self.num_instances = self.subsets.count(*self.selection)
+
+
+
+    def _arrays(self):
+        ''' the final arrays, written by save() and shared by share() '''
+        arrays = {'times': self.times, 'events': self.events, 'col_map': self.col_map,
+                  'infreq_user_col_indices': self.infreq_user_col_indices,
+                  'infreq_page_col_indices': self.infreq_page_col_indices}
+        for name, mat in (('features', self.sparse_features), ('headerbids', self.sparse_headerbids)):
+            arrays.update({'%s_data' % name: mat.data, '%s_indices' % name: mat.indices, '%s_indptr' % name: mat.indptr})
+        return {name: np.asarray(arr) for name, arr in arrays.items()}
+
+    def _meta(self):
+        return {'features_shape': self.sparse_features.shape, 'headerbids_shape': self.sparse_headerbids.shape,
+                'rare_user_col_index': self.rare_user_col_index, 'rare_page_col_index': self.rare_page_col_index,
+                'num_features': self.num_features, 'max_nonzero_len': self.max_nonzero_len,
+                'selection': self.selection, 'num_instances': self.num_instances}
+
+    @classmethod
+    def _from_arrays(cls, arrays, meta, subsets):
+        ''' a SurvivalData on the arrays of _arrays(), without redoing any of the construction '''
+        data = cls.__new__(cls)
+        data.__dict__.update(meta)
+        data.window_rows = None
+        data.times, data.events, data.col_map = arrays['times'], arrays['events'], arrays['col_map']
+        data.infreq_user_col_indices = arrays['infreq_user_col_indices']
+        data.infreq_page_col_indices = arrays['infreq_page_col_indices']
+        data.sparse_features = csr_matrix((arrays['features_data'], arrays['features_indices'], arrays['features_indptr']),
+                                          shape=data.__dict__.pop('features_shape'))
+        data.sparse_headerbids = csr_matrix((arrays['headerbids_data'], arrays['headerbids_indices'], arrays['headerbids_indptr']),
+                                            shape=data.__dict__.pop('headerbids_shape'))
+        data.subsets = subsets
+        return data
+
+    def save(self, dir_path):
+        ''' the final arrays as .npy files, so that load() memory-maps them '''
+        os.makedirs(dir_path, exist_ok=True)
+        for name, arr in self._arrays().items():
+            np.save(os.path.join(dir_path, '%s.npy' % name), arr)
+        self.subsets.save(os.path.join(dir_path, 'subsets.npz'))
+        pickle.dump(self._meta(), open(os.path.join(dir_path, 'meta.p'), 'wb'))
+
+    @classmethod
+    def load(cls, dir_path):
+        ''' a SurvivalData saved by save(), without redoing any of the construction '''
+        arrays = {name[:-len('.npy')]: np.load(os.path.join(dir_path, name), mmap_mode='r')
+                  for name in os.listdir(dir_path) if name.endswith('.npy')}
+        return cls._from_arrays(arrays, pickle.load(open(os.path.join(dir_path, 'meta.p'), 'rb')),
+                                RowSubsets().load(os.path.join(dir_path, 'subsets.npz')))
+
+    def share(self, name):
+        '''
+        Publish the arrays in shared memory under name, for attach(name) in the other processes.
+        :return: the SharedArrays, whose reference this process holds until its release()
+        '''
+        arrays = self._arrays()
+        arrays.update(('subsets_%s' % subset, bitmap) for subset, bitmap in self.subsets.bitmaps.items())
+        return SharedArrays.publish(name, arrays, dict(self._meta(), subsets_num_rows=self.subsets.num_rows))
 
-    def load_rares_index(self):
-        attr2idx = pickle.load(open('output/attr2idx.dict', 'rb'))
+    @classmethod
+    def attach(cls, name):
+        '''
+        A SurvivalData on the arrays shared by share(name), zero-copy; the reference of this process is released
+        with the data.
+        :raise FileNotFoundError: if nothing is shared under name
+        '''
+        shared = SharedArrays.attach(name)
+        meta = dict(shared.meta)
+        subsets = RowSubsets(meta.pop('subsets_num_rows'))
+        subsets.bitmaps = {key[len('subsets_'):]: bitmap for key, bitmap in shared.arrays.items()
+                           if key.startswith('subsets_')}
+        data = cls._from_arrays(shared.arrays, meta, subsets)
+        data.shared = shared
+        return data
+
+    def compact_columns(self):
+        '''
+        Drop the columns of the additionally merged users and pages, which the models never see, and renumber the
+        others through the lookup array self.col_map (old column -> new column, -1 if dropped).
+        The columns only depend on attr2idx, counter and min_occurrence, so train, val and test data agree.
+        '''
+        self.col_map = compact_col_map(self.sparse_features.shape[1], self.infreq_user_col_indices,
+                                       self.infreq_page_col_indices)
+        keep = self.col_map >= 0
+
+        if not keep.all():
+            mat = self.sparse_features
+            kept = keep[mat.indices]
+            indptr = np.concatenate(([0], np.cumsum(kept)))[mat.indptr]
+            self.sparse_features = csr_matrix((mat.data[kept], self.col_map[mat.indices[kept]], indptr),
+                                              shape=(mat.shape[0], int(keep.sum())))
+            self.rare_user_col_index = int(self.col_map[self.rare_user_col_index])
+            self.rare_page_col_index = int(self.col_map[self.rare_page_col_index])
+            print("%d -> %d columns after dropping the additionally merged users and pages"
+                  % (len(keep), self.sparse_features.shape[1]))
+        self.num_features = self.sparse_features.shape[1]
+
+    def load_rares_index(self, attr2idx=None):
+        ''' attr2idx is given when the data was built from the FeatureStore rather than the vector files '''
+        if attr2idx is None:
+            attr2idx = _load_dict('output/attr2idx.dict')
         self.rare_user_col_index = attr2idx['UserId'][MIN_OCCURRENCE_SYMBOL]
         self.rare_page_col_index = attr2idx['NaturalIDs'][MIN_OCCURRENCE_SYMBOL]
 
-    def load_addtl_infreq(self, min_occur):
+    @staticmethod
+    def load_addtl_infreq(min_occur, attr2idx=None, counter=None):
         """
         Beside those users and pages whose occurrences are less than MIN_OCCURRENCE,
         we also merge those whose occurrences are less than min_occur (if min_occur > MIN_OCCURRENCE)
 
         :param min_occur:
+        :param attr2idx, counter: those of the FeatureStore (FeatureStore.counter()) the data was built from;
+                                  output/attr2idx.dict and output/counter.dict of the vector files by default
         :return:
         """
-        attr2idx = pickle.load(open('output/attr2idx.dict', 'rb'))
-        counter = pickle.load(open('output/counter.dict', 'rb'))
+        if attr2idx is None:
+            attr2idx = _load_dict('output/attr2idx.dict')
+            counter = _load_dict('output/counter.dict')
+        elif counter is None:
+            raise ValueError("the counter of the FeatureStore is needed with its attr2idx for min_occurrence > %d"
+                             % ORIGIN_MIN_OCCURRENCE)
 
 
         # print("RARE USERS: %d" % attr2idx['UserId']['<RARE>'])
@@ -131,107 +267,219 @@ class SurvivalData:
     #     data = np.ones(len(infreq_row_indices))
     #     return csr_matrix((data, (row, col)), shape=shape, dtype=float)
 
-    def get_sparse_feat_vec_batch(self, batch_size=100):
+    def build_row_subsets(self):
+        '''
+        The row subsets, from the CSR structure only:
+        has_hb (any header bid), hb_<agent> (a bid from the agent), freq_user and freq_page (not on the <RARE> column)
+        '''
+        num_rows = len(self.times)
+        subsets = RowSubsets(num_rows)
+
+        ''' explicit zeros do not count, as with np.nonzero '''
+        hb_mat = self.sparse_headerbids
+        hb_nonzero = hb_mat.data != 0
+        hb_rows = np.repeat(np.arange(num_rows), np.diff(hb_mat.indptr))[hb_nonzero]
+        subsets.add_rows('has_hb', hb_rows)
+        for col, hb_agent_name in enumerate(HEADER_BIDDING_KEYS):
+            subsets.add_rows('hb_%s' % hb_agent_name, hb_rows[hb_mat.indices[hb_nonzero] == col])
+
+        feat_mat = self.sparse_features
+        feat_rows = np.repeat(np.arange(num_rows), np.diff(feat_mat.indptr))
+        for name, rare_col_index in (('freq_user', self.rare_user_col_index), ('freq_page', self.rare_page_col_index)):
+            mask = np.ones(num_rows, dtype=bool)
+            mask[feat_rows[(feat_mat.indices == rare_col_index) & (feat_mat.data != 0)]] = False
+            subsets.add(name, mask)
+        return subsets
+
+    def window(self, rows, only_hb_imp=None):
+        '''
+        The data set restricted to rows (e.g. a time window of a DayIndex), sharing all the arrays of this one: the
+        rows are only the selection of its batches, which gather them batch by batch.
+        :param only_hb_imp: the default selection of the window, if not the one of this data set
+        '''
+        data = copy.copy(self)
+        data.window_rows = np.asarray(rows)
+        if only_hb_imp is not None:
+            data.selection = ('has_hb',) if only_hb_imp else ()
+        data.num_instances = len(data.select_rows())
+        return data
+
+    def select_rows(self, *names):
+        '''
+        :param names: row subsets of self.subsets, on top of the default selection (e.g. 'freq_user', 'hb_amznbid')
+        :return: the selected rows (in the order of the window, if any), or None for all the rows
+        '''
+        names = self.selection + tuple(names)
+        if self.window_rows is None:
+            return self.subsets.rows(*names) if names else None
+        return self.window_rows[self.subsets.mask(*names)[self.window_rows]] if names else self.window_rows
+
+    def get_sparse_feat_vec_batch(self, batch_size=100, shuffle=True):
         '''
         For baselines
         :param batch_size:
+        :param shuffle: False for evaluation passes, which take the rows in order
         :return:
         '''
-        self.times, self.events, self.sparse_features, self.sparse_headerbids = \
-            shuffle(self.times, self.events, self.sparse_features, self.sparse_headerbids)
+        for rows in batch_rows(len(self.times), batch_size, shuffle, self.select_rows()):
+            yield self.times[rows], \
+                  self.events[rows], \
+                  self.sparse_features[rows]
 
-        start_index = 0
-        while start_index < self.num_instances:
+    def row_lengths(self):
+        ''' the number of nonzeros of every row '''
+        return np.diff(self.sparse_features.indptr)
 
-            yield self.times[start_index: start_index + batch_size], \
-                  self.events[start_index: start_index + batch_size], \
-                  self.sparse_features[start_index: start_index + batch_size, :]
-            start_index += batch_size
+    def make_sparse_batch(self, batch_size=10000, only_freq=False, shuffle=True, num_buckets=None, subsets=()):
+        '''
+        for our methods; the data is left as it is, the batches are gathered through a permutation of the rows
+        (gather_batch of each batch of batch_plan)
+        '''
+        for rows, max_len in self.batch_plan(batch_size, only_freq, shuffle, num_buckets, subsets):
+            yield self.gather_batch(rows, max_len)
 
-    def make_sparse_batch(self, batch_size=10000, only_freq=False):
+    def batch_plan(self, batch_size=10000, only_freq=False, shuffle=True, num_buckets=None, subsets=(), rs=None):
         '''
-        for our methods
+        The rows of the batches of make_sparse_batch, without gathering them
         :param batch_size:
-        :return:
+        :param only_freq: only the rows whose user and page are both frequent
+        :param shuffle: False for evaluation passes, which take the rows in order
+        :param num_buckets: if given, the rows are batched by length buckets and each batch is padded only to the
+                            longest row of its bucket instead of max_nonzero_len
+        :param subsets: names of other row subsets to select, e.g. ('hb_amznbid',)
+        :param rs: the np.random.RandomState of the shuffling, the global one by default
+        :return: (rows, padded length) for each batch
         '''
-        self.times, self.events, self.sparse_features, self.sparse_headerbids = \
-            shuffle(self.times, self.events, self.sparse_features, self.sparse_headerbids)
+        subset = self.select_rows(*(tuple(subsets) + (('freq_user', 'freq_page') if only_freq else ())))
+        if num_buckets:
+            return bucket_batch_rows(self.row_lengths(), batch_size, num_buckets, shuffle, subset, rs)
+        return ((rows, self.max_nonzero_len) for rows in batch_rows(len(self.times), batch_size, shuffle, subset, rs))
+
+    def gather_batch(self, rows, max_len):
         '''
         self.times: <class 'numpy.ndarray'>
         self.events: <class 'numpy.ndarray'>
         self.sparse_features: <class 'scipy.sparse.csr.csr_matrix'>
         self.sparse_headerbids: <class 'scipy.sparse.csr.csr_matrix'>
+        :return: the arrays of the batch of rows, its features padded to max_len
         '''
-
-        if only_freq:
-            freq_user_row_mask = ~np.ravel(self.sparse_features[:, self.rare_user_col_index].toarray()).astype(bool)
-            freq_page_row_mask = ~np.ravel(self.sparse_features[:, self.rare_page_col_index].toarray()).astype(bool)
-            freq_both_row_mask = freq_user_row_mask & freq_page_row_mask
-            self.times, self.events, self.sparse_features, self.sparse_headerbids = \
-                self.times[freq_both_row_mask], self.events[freq_both_row_mask], \
-                self.sparse_features[freq_both_row_mask], self.sparse_headerbids[freq_both_row_mask]
-            assert self.times.shape[0] == self.events.shape[0] == self.sparse_features.shape[0] == self.sparse_headerbids.shape[0]
-
-        infreq_col_set = set(self.infreq_user_col_indices) | set(self.infreq_page_col_indices)
-        start_index = 0
-        while start_index < self.num_instances:
-            batch_feat_mat = self.sparse_features[start_index: start_index + batch_size, :]
-
-            feat_indices_batch = np.split(batch_feat_mat.indices, batch_feat_mat.indptr)[1:-1]
-            feat_values_batch = np.split(batch_feat_mat.data, batch_feat_mat.indptr)[1:-1]
-
-
-            filter_mask = [np.array(list(map(lambda i: i not in infreq_col_set, indices_arr))).astype(bool) for indices_arr in feat_indices_batch]
-            # print([len(f) for f in feat_indices_batch])
-            # print([len(f) for f in feat_values_batch])
-            feat_indices_batch = [indices[mask] for indices, mask in zip(feat_indices_batch, filter_mask)]
-            feat_values_batch = [indices[mask] for indices, mask in zip(feat_values_batch, filter_mask)]
-            # print([len(f) for f in feat_indices_batch])
-            # print([len(f) for f in feat_values_batch])
-
-
-            # padding
-            feat_indices_batch = pad_sequences(feat_indices_batch, maxlen=self.max_nonzero_len, padding='post', value=0)
-            feat_values_batch = pad_sequences(feat_values_batch, maxlen=self.max_nonzero_len, padding='post', value=0.0, dtype='float32')
-
-            batch_hb_mat = self.sparse_headerbids[start_index: start_index + batch_size, :]
-            '''
-            EXAMPLE of row (Array):
-            [0.1]
-            [2.77]
-            []
-            [0.04 1.52 1.53]
-            [1.56 1.5 ]
-            []
-            [0.12 0.03 0.22]
-            '''
-            min_hbs_batch = []
-            max_hbs_batch = []
-            for row in np.split(batch_hb_mat.data, batch_hb_mat.indptr)[1:-1]:
-                if row.size:
-                    min_hbs_batch.append(min(row))
-                    max_hbs_batch.append(max(row))
-                else:
-                    # if header bids are missing, use 0.0 instead.
-                    min_hbs_batch.append(0.0)
-                    max_hbs_batch.append(0.0)
-
-
-            yield self.times[start_index: start_index + batch_size], \
-                  self.events[start_index: start_index + batch_size], \
-                  feat_indices_batch, \
-                  feat_values_batch, \
-                  min_hbs_batch, \
-                  max_hbs_batch, \
-                  self.max_nonzero_len
-            start_index += batch_size
-
+        batch_feat_mat = self.sparse_features[rows]
+        # padding
+        feat_indices_batch, feat_values_batch = pad_csr_rows(batch_feat_mat, max_len)
+
+        # if header bids are missing, use 0.0 instead.
+        min_hbs_batch, max_hbs_batch = row_min_max(self.sparse_headerbids[rows])
+
+        return self.times[rows], \
+               self.events[rows], \
+               feat_indices_batch, \
+               feat_values_batch, \
+               min_hbs_batch, \
+               max_hbs_batch, \
+               max_len
+
+
+
+class ShardedSurvivalData:
+    '''
+    A data set written as shards (TrainValTestSplitter with SHARD_SIZE) that does not fit in memory.
+    The shards are read buffer_shards at a time, in a random order; every buffer is a SurvivalData whose rows are
+    permuted and batched as usual. Memory is bounded by the buffer, and the batches are those of SurvivalData.
+    The counts and the columns come from the shard meta information and the dictionaries, without reading any shard.
+    '''
+    def __init__(self, dir_path, min_occurrence=ORIGIN_MIN_OCCURRENCE, only_hb_imp=False, buffer_shards=BUFFER_SHARDS):
+        self.shard_paths, meta = load_shard_meta(dir_path)
+        self.min_occurrence, self.only_hb_imp, self.buffer_shards = min_occurrence, only_hb_imp, buffer_shards
+        if 'num_hb_rows' not in meta:
+            raise ValueError("%s has no num_hb_rows in its meta information; write the shards again with "
+                             "TrainValTestSplitter" % dir_path)
+        self.num_instances = meta['num_hb_rows'] if only_hb_imp else sum(meta['num_rows'])
+
+        ''' the infrequent columns, and so the columns after dropping them, are the same in every buffer '''
+        self.infreq_col_indices = (np.array([]), np.array([]))
+        if min_occurrence > ORIGIN_MIN_OCCURRENCE:
+            self.infreq_col_indices = SurvivalData.load_addtl_infreq(min_occurrence)
+        self.col_map = compact_col_map(meta['num_features'], *self.infreq_col_indices)
+        self.num_features = int((self.col_map >= 0).sum())
+
+    def _buffers(self, shuffle, rs=None):
+        for buffer in iter_shard_buffers(self.shard_paths, self.buffer_shards, shuffle, rs=rs):
+            yield SurvivalData(buffer['times'], buffer['events'], buffer['sparse_features'], buffer['sparse_headerbids'],
+                               min_occurrence=self.min_occurrence, only_hb_imp=self.only_hb_imp,
+                               infreq_col_indices=self.infreq_col_indices)
+
+    def get_sparse_feat_vec_batch(self, batch_size=100, shuffle=True):
+        for data in self._buffers(shuffle):
+            yield from data.get_sparse_feat_vec_batch(batch_size, shuffle)
+
+    def make_sparse_batch(self, batch_size=10000, only_freq=False, shuffle=True, num_buckets=None, subsets=()):
+        ''' the batches of SurvivalData.make_sparse_batch, buffer after buffer '''
+        for data, rows, max_len in self.batch_plan(batch_size, only_freq, shuffle, num_buckets, subsets):
+            yield data.gather_batch(rows, max_len)
+
+    def batch_plan(self, batch_size=10000, only_freq=False, shuffle=True, num_buckets=None, subsets=(), rs=None):
+        ''' (buffer, rows, padded length) of each batch; a buffer is read when the plan reaches it '''
+        for data in self._buffers(shuffle, rs):
+            for rows, max_len in data.batch_plan(batch_size, only_freq, shuffle, num_buckets, subsets, rs):
+                yield data, rows, max_len
+
+    @staticmethod
+    def gather_batch(data, rows, max_len):
+        return data.gather_batch(rows, max_len)
+
+
+def _file_hash(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as infile:
+        for block in iter(lambda: infile.read(HASH_BLOCK_SIZE), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _cache_path(file_path, min_occurrence, only_hb_imp):
+    key = [_file_hash(file_path), str(min_occurrence), str(only_hb_imp)]
+    for dict_path in ('output/attr2idx.dict', 'output/counter.dict'):
+        if os.path.exists(dict_path):
+            key.append(_file_hash(dict_path))
+    cache_path = os.path.join(os.path.dirname(file_path), CACHE_DIR_NAME,
+                              '%s_%s' % (os.path.splitext(os.path.basename(file_path))[0],
+                                         hashlib.sha1('_'.join(key).encode()).hexdigest()[:16]))
+    return cache_path
+
+
+def shared_name(file_path, min_occurrence=ORIGIN_MIN_OCCURRENCE, only_hb_imp=False):
+    ''' the shared memory name of a data set, keyed like its cache '''
+    return 'survival_%s' % os.path.basename(_cache_path(file_path, min_occurrence, only_hb_imp))
+
+
+def load_survival_data(file_path, min_occurrence=ORIGIN_MIN_OCCURRENCE, only_hb_imp=False):
+    '''
+    SurvivalData of a pickled data set (e.g. output/TRAIN_SET.p), built once and then reloaded from a cache
+    under <data set dir>/cache. The cache is keyed by the content of the data set file and of the dictionaries
+    SurvivalData reads (attr2idx, counter), min_occurrence and only_hb_imp, so a stale entry is never used.
+    With ATTACH_SHARED, the data set hosted in shared memory by DataServer is attached instead, if any.
+    '''
+    cache_path = _cache_path(file_path, min_occurrence, only_hb_imp)
+    if ATTACH_SHARED:
+        try:
+            data = SurvivalData.attach('survival_%s' % os.path.basename(cache_path))
+            print("Attached %s shared by DataServer" % file_path)
+            return data
+        except FileNotFoundError:
+            pass
+
+    if os.path.exists(os.path.join(cache_path, 'meta.p')):
+        print("Loading %s from the cache %s" % (file_path, cache_path))
+        return SurvivalData.load(cache_path)
+
+    data = SurvivalData(*pickle.load(open(file_path, 'rb')), min_occurrence=min_occurrence, only_hb_imp=only_hb_imp)
+    data.save(cache_path)
+    print("%s is cached in %s" % (file_path, cache_path))
+    return data
 
 
 if __name__ == "__main__":
-    times, events, sparse_features, sparse_headerbids = pickle.load(open('output/TRAIN_SET.p', 'rb'))
-    s = SurvivalData(times, events, sparse_features, sparse_headerbids,
-                     min_occurrence=10, only_hb_imp=False)
+    s = load_survival_data('output/TRAIN_SET.p', min_occurrence=10, only_hb_imp=False)
 
     for t, e, f_ind, f_val, h_ind, h_val, max_nonzero_len in s.make_sparse_batch(2048, only_freq=False):
         #print(t)
@@ -0,0 +1,29 @@
+"""
+Hosts output/TRAIN_SET.p, VAL_SET.p and TEST_SET.p in shared memory, so the processes training or evaluating on them
+concurrently (ParametricSurvivalModels, Sweep, RunBaselines) attach one copy instead of each loading its own:
+    python -m failure_rate_prediction_conf.DataServer
+load_survival_data attaches a hosted data set by itself, keyed like its cache (the content of the data set and of the
+dictionaries, min_occurrence and only_hb_imp), so a data set hosted with other settings is loaded as before. The shared
+memory is freed once the server is stopped (Ctrl-C) and the processes attached have exited.
+"""
+import os
+from failure_rate_prediction_conf import DataReader
+from failure_rate_prediction_conf.DataReader import load_survival_data, shared_name
+from failure_rate_prediction_conf.ParametricSurvivalModels import MIN_OCCURRENCE, ONLY_HB_IMP
+from util.shared_arrays import serve
+
+''' the settings of the __main__ of ParametricSurvivalModels: the others do not attach the hosted data sets '''
+DATA_SETS = [('output/TRAIN_SET.p', MIN_OCCURRENCE, False),
+             ('output/VAL_SET.p', MIN_OCCURRENCE, ONLY_HB_IMP),
+             ('output/TEST_SET.p', MIN_OCCURRENCE, ONLY_HB_IMP)]
+
+
+if __name__ == "__main__":
+    DataReader.ATTACH_SHARED = False  # load the data sets to host, not a copy hosted already
+    shared = []
+    for file_path, min_occurrence, only_hb_imp in DATA_SETS:
+        file_path = os.path.abspath(file_path)
+        data = load_survival_data(file_path, min_occurrence=min_occurrence, only_hb_imp=only_hb_imp)
+        shared.append(data.share(shared_name(file_path, min_occurrence, only_hb_imp)))
+        del data  # the loaded copy, once shared
+    serve(shared)
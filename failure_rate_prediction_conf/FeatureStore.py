@@ -0,0 +1,220 @@
+import os, pickle, numpy as np
+from array import array
+from collections import defaultdict, Counter
+from pymongo import MongoClient
+from scipy.sparse import csr_matrix
+from util.sparse_batch import ragged_positions
+from failure_rate_prediction_conf.Vectorizer import FEATURE_FIELDS
+from failure_rate_prediction_conf.data_entry_class.NetworkBackfillImpressionEntry import NetworkBackfillImpressionEntry
+from failure_rate_prediction_conf.data_entry_class.NetworkImpressionEntry import NetworkImpressionEntry
+from failure_rate_prediction_conf.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS, MIN_OCCURRENCE, MIN_OCCURRENCE_SYMBOL
+
+STORE_DIR = 'output/feature_store'
+
+SINGLE, MULTI, NUMERIC = 'single', 'multi', 'numeric'
+
+
+class FeatureStore:
+    '''
+    Every attribute is kept as a dictionary-encoded int32 column (multi-valued attributes as ragged arrays),
+    together with the occurrence count of every code.
+    Building the CSR matrix for any min_occurrence, attribute subset or dummy-dropping rule is then a remap
+    of the codes instead of a rescan of Mongo.
+    '''
+    def __init__(self):
+        self.vocab = defaultdict(dict)  # {Attribute1: dict(feat1:code, ...), ...}; codes follow the first occurrence
+        self.kinds = {}                 # {Attribute1: SINGLE | MULTI | NUMERIC, ...}
+        self.counts = {}                # {Attribute1: array of the occurrences of each code, ...}
+        self.codes = {}                 # {Attribute1: codes (SINGLE, MULTI) or values (NUMERIC), ...}
+        self.offsets = {}               # {Attribute1: row offsets into codes, ...}; MULTI only
+        self.times, self.events, self.headerbids = array('d'), array('b'), array('d')
+        self.num_rows = 0
+
+    def _code(self, attr, feat):
+        feat2code = self.vocab[attr]
+        if feat not in feat2code:
+            feat2code[feat] = len(feat2code)
+            self.counts[attr].append(0)
+        return feat2code[feat]
+
+    def _count(self, attr, v):
+        if attr not in self.kinds:
+            self.kinds[attr] = MULTI if type(v) == list else SINGLE if type(v) == str else NUMERIC
+            self.counts[attr] = array('q')
+            self.codes[attr] = array('i') if self.kinds[attr] != NUMERIC else array('d')
+            if self.kinds[attr] == MULTI:
+                self.offsets[attr] = array('q', [0] * (self.num_rows + 1))
+            else:
+                self.codes[attr].extend([-1 if self.kinds[attr] == SINGLE else 0.0] * self.num_rows)  # missing in the rows before
+
+        if self.kinds[attr] == MULTI:
+            for f in v:
+                self.counts[attr][self._code(attr, f)] += 1
+        elif self.kinds[attr] == SINGLE:
+            self.counts[attr][self._code(attr, v)] += 1
+        else:
+            self.counts[attr][self._code(attr, attr)] += 1  # for float or int features, occupy only one column
+
+    def _append(self, entry, target, header_bids):
+        for attr, kind in self.kinds.items():
+            v = entry.get(attr)
+            if kind == MULTI:
+                self.codes[attr].extend(self.vocab[attr][f] for f in (v or []))
+                self.offsets[attr].append(len(self.codes[attr]))
+            elif kind == SINGLE:
+                self.codes[attr].append(self.vocab[attr][v] if v is not None else -1)
+            else:
+                self.codes[attr].append(v if v is not None else 0.0)
+
+        self.times.append(target[0])
+        self.events.append(target[1])
+        self.headerbids.extend(hb if hb is not None else np.nan for hb in header_bids)
+        self.num_rows += 1
+
+    def add_collection(self, dbname, colname, ImpressionEntry):
+        '''
+        Count every qualified impression like Vectorizer.fit and store the ones with a target like Vectorizer.transform,
+        in a single pass over the collection.
+        '''
+        col = MongoClient()[dbname][colname]
+        n = 0
+        total_entries = col.find().count()
+        for doc in col.find(projection=FEATURE_FIELDS):
+            if n % 1000000 == 0:
+                print('%d/%d (%.2f%%)' % (n, total_entries, n / total_entries * 100))
+            n += 1
+
+            imp_entry = ImpressionEntry(doc)
+            imp_entry.build_entry()
+            if not imp_entry.is_qualified():
+                continue
+
+            for k, v in imp_entry.entry.items():  # iterate all <fields:feature>
+                self._count(k, v)
+
+            target = imp_entry.get_target()
+            if target:
+                self._append(imp_entry.entry, target, imp_entry.get_headerbids())
+
+    def build_attr2idx(self, min_occurrence=MIN_OCCURRENCE, attributes=None, drop_most_common=True):
+        '''
+        Same indexing rule as Vectorizer.build_attr2idx, computed on the code counts only.
+        :return: attr2idx, {Attribute1: code2col, ...} where code2col[code] is the column of the code (-1: no column)
+        '''
+        attr2idx = defaultdict(dict)
+        code2col = {}
+        num_features = 0
+        for attr, kind in self.kinds.items():
+            if attributes is not None and attr not in attributes:
+                continue
+            counts = np.asarray(self.counts[attr])
+            feats = np.array(list(self.vocab[attr]), dtype=object)
+
+            indexed = np.ones(len(counts), dtype=bool)
+            if drop_most_common and kind != NUMERIC:
+                indexed[np.argmax(counts)] = False  # the first most common feature, as Counter.most_common does
+            rare = (counts < min_occurrence) & (kind != NUMERIC)
+            rare_indexed = np.flatnonzero(indexed & rare)
+
+            ''' the first rare feature takes the position of <RARE>; the other rare features share it '''
+            owns_col = indexed & ~rare
+            owns_col[rare_indexed[:1]] = True
+            cols = num_features + np.cumsum(owns_col) - 1
+            num_features += int(owns_col.sum())
+
+            code2col[attr] = np.where(owns_col, cols, -1).astype(np.int32)
+            attr2idx[attr] = dict(zip(feats[indexed & ~rare], code2col[attr][indexed & ~rare].tolist()))
+            if len(rare_indexed):
+                rare_col = int(cols[rare_indexed[0]])
+                attr2idx[attr][MIN_OCCURRENCE_SYMBOL] = rare_col
+                if kind == SINGLE:
+                    code2col[attr][rare] = rare_col  # list features are skipped when rare, as in ImpressionEntry
+                else:
+                    code2col[attr][rare] = -1
+
+        return attr2idx, code2col, num_features
+
+    def counter(self, attributes=None):
+        ''' the occurrences of the features, as output/counter.dict of the Vectorizer: {Attribute1:Counter<features>, ...} '''
+        return {attr: Counter(dict(zip(self.vocab[attr], np.asarray(self.counts[attr]).tolist())))
+                for attr in self.kinds if attributes is None or attr in attributes}
+
+    def to_csr(self, min_occurrence=MIN_OCCURRENCE, attributes=None, drop_most_common=True, rows=None):
+        '''
+        :param rows: the row indices to take (e.g. one data partition); all rows by default
+        :return: times, events, sparse_features, sparse_headerbids (as in TRAIN_SET.p); self.attr2idx and
+                 self.num_features describe the columns of sparse_features, and go with counter() to SurvivalData
+        '''
+        self.attr2idx, code2col, self.num_features = self.build_attr2idx(min_occurrence, attributes, drop_most_common)
+        rows = np.arange(self.num_rows) if rows is None else np.asarray(rows)
+
+        row_indices, col_indices, values = [], [], []
+        for attr in code2col:
+            if self.kinds[attr] == MULTI:
+                offsets = np.asarray(self.offsets[attr])
+                lengths = offsets[rows + 1] - offsets[rows]
+                codes = np.asarray(self.codes[attr])[ragged_positions(offsets[rows], lengths)]
+                row_index = np.repeat(np.arange(len(rows)), lengths)
+                value = np.repeat(1.0 / np.maximum(lengths, 1), lengths)
+                col = code2col[attr][codes]
+            elif self.kinds[attr] == SINGLE:
+                codes = np.asarray(self.codes[attr])[rows]
+                row_index = np.arange(len(rows))
+                value = np.ones(len(rows))
+                col = np.where(codes >= 0, code2col[attr][codes], -1)
+            else:
+                value = np.asarray(self.codes[attr])[rows]
+                row_index = np.arange(len(rows))
+                col = np.full(len(rows), code2col[attr][0])
+
+            mask = col >= 0
+            row_indices.append(row_index[mask])
+            col_indices.append(col[mask])
+            values.append(value[mask])
+
+        ''' duplicates are summed, as when the coo_matrix of the vector files is converted to csr '''
+        sparse_features = csr_matrix((np.concatenate(values), (np.concatenate(row_indices), np.concatenate(col_indices))),
+                                     shape=(len(rows), self.num_features))
+
+        headerbids = np.asarray(self.headerbids).reshape(-1, len(HEADER_BIDDING_KEYS))[rows]
+        sparse_headerbids = csr_matrix(np.nan_to_num(headerbids, nan=0.0))
+
+        return np.asarray(self.times)[rows], np.asarray(self.events)[rows], sparse_features, sparse_headerbids
+
+    def save(self, dir_path=STORE_DIR):
+        os.makedirs(dir_path, exist_ok=True)
+        for attr, kind in self.kinds.items():
+            np.save(os.path.join(dir_path, '%s.codes.npy' % attr), np.asarray(self.codes[attr]))
+            np.save(os.path.join(dir_path, '%s.counts.npy' % attr), np.asarray(self.counts[attr]))
+            if kind == MULTI:
+                np.save(os.path.join(dir_path, '%s.offsets.npy' % attr), np.asarray(self.offsets[attr]))
+        np.save(os.path.join(dir_path, 'times.npy'), np.asarray(self.times))
+        np.save(os.path.join(dir_path, 'events.npy'), np.asarray(self.events))
+        np.save(os.path.join(dir_path, 'headerbids.npy'), np.asarray(self.headerbids))
+        pickle.dump((self.vocab, self.kinds, self.num_rows), open(os.path.join(dir_path, 'vocab.p'), 'wb'))
+
+    def load(self, dir_path=STORE_DIR):
+        ''' the columns are memory-mapped; only the rows taken by to_csr are read '''
+        self.vocab, self.kinds, self.num_rows = pickle.load(open(os.path.join(dir_path, 'vocab.p'), 'rb'))
+        for attr, kind in self.kinds.items():
+            self.codes[attr] = np.load(os.path.join(dir_path, '%s.codes.npy' % attr), mmap_mode='r')
+            self.counts[attr] = np.load(os.path.join(dir_path, '%s.counts.npy' % attr))
+            if kind == MULTI:
+                self.offsets[attr] = np.load(os.path.join(dir_path, '%s.offsets.npy' % attr), mmap_mode='r')
+        self.times = np.load(os.path.join(dir_path, 'times.npy'), mmap_mode='r')
+        self.events = np.load(os.path.join(dir_path, 'events.npy'), mmap_mode='r')
+        self.headerbids = np.load(os.path.join(dir_path, 'headerbids.npy'), mmap_mode='r')
+        return self
+
+
+if __name__ == "__main__":
+    store = FeatureStore()
+    print('Storing NetworkBackfillImpressions...')
+    store.add_collection('Header_Bidding', 'NetworkBackfillImpressions', NetworkBackfillImpressionEntry)
+    print('Storing NetworkImpressions...')
+    store.add_collection('Header_Bidding', 'NetworkImpressions', NetworkImpressionEntry)
+    store.save()
+
+    for min_occurrence in (MIN_OCCURRENCE, 10, 50):
+        times, events, sparse_features, sparse_headerbids = store.to_csr(min_occurrence)
+        print("min_occurrence = %d: %d instances and %d features" % (min_occurrence, *sparse_features.shape))
@@ -1,10 +1,16 @@
-import numpy as np, pickle, csv
+import numpy as np, pickle, csv, threading, itertools
 
 import tensorflow as tf
 from sklearn.metrics import log_loss, accuracy_score
-from failure_rate_prediction_conf.DataReader import SurvivalData
+from failure_rate_prediction_conf.DataReader import SurvivalData, ShardedSurvivalData, load_survival_data
 from failure_rate_prediction_conf import Distributions
 from failure_rate_prediction_conf.EvaluationMetrics import c_index
+from util.day_index import DayIndex
+from util.tf_input import BatchInput
+from util.distributed import Cluster
+from util.sparse_updates import make_optimizer, clip_sparse_gradients, SPARSE_OPTIMIZERS
+from util.embedding_precision import embedding_table, embedding_lookup, adam_epsilon, clip_by_global_norm, \
+    print_embedding_memory
 from time import time as nowtime
 
 
@@ -15,6 +21,27 @@ ONLY_HB_IMP = False
 
 MIN_OCCURRENCE = 5
 
+''' e.g. 7: walk forward over output/DAY_INDEX.npz, training on the 7 days before each validation day '''
+TRAIN_DAYS = None
+
+''' e.g. 4: batch the rows by length buckets, each batch padded to its bucket's longest row instead of max_nonzero_len '''
+NUM_LENGTH_BUCKETS = None
+
+''' e.g. 'output/TRAIN_SET_shards': stream the training set from its shards (TrainValTestSplitter with SHARD_SIZE) '''
+TRAIN_SHARDS_DIR = None
+
+''' training threads sharing the session and the batch stream, each applying its updates unlocked (Hogwild); more than
+one needs OPTIMIZER 'lazy_adam' or 'adagrad', whose updates are sparse, see train_epoch '''
+NUM_WORKERS = 1
+''' the threads of one op and the ops run concurrently (tf.ConfigProto); 0: as many as the cores '''
+INTRA_OP_THREADS = 0
+INTER_OP_THREADS = 0
+
+''' 'adam', or 'lazy_adam' / 'adagrad': update only the embedding rows of each batch, their gradients clipped row by row '''
+OPTIMIZER = 'adam'
+''' 'float32', or 'bfloat16' / 'float16' to store the embedding tables and their optimizer slots in half the memory '''
+EMBEDDING_DTYPE = 'float32'
+
 class ParametricSurvival:
 
     def __init__(self, distribution, batch_size, num_epochs, k, learning_rate=0.001,
@@ -33,237 +60,298 @@ class ParametricSurvival:
         return tf.reduce_sum(weights_linear, axis=-1) + intercept
 
     def factorization_machines(self, weights_factorized):
-        dot_product_res = tf.matmul(weights_factorized, tf.transpose(weights_factorized, perm=[0,2,1]))
-        element_product_res = weights_factorized * weights_factorized
-        pairs_mulsum = tf.reduce_sum(tf.multiply(0.5, tf.reduce_sum(dot_product_res, axis=2)
-                                        - tf.reduce_sum(element_product_res, axis=2)),
-                            axis=-1)
+        '''
+        sum_{i<j} <v_i, v_j> = 0.5 * sum_f ((sum_i v_if)^2 - sum_i v_if^2), in O(max_nonzero_len * k) per row
+        instead of the (max_nonzero_len x max_nonzero_len) matrix of all the dot products.
+        :param weights_factorized: (batch_size, max_nonzero_len, k), the embeddings times the feature values, so the
+                                   padded entries (value 0) are zero vectors and add nothing
+        '''
+        sum_squared = tf.square(tf.reduce_sum(weights_factorized, axis=1))
+        squared_sum = tf.reduce_sum(tf.square(weights_factorized), axis=1)
+        pairs_mulsum = tf.multiply(0.5, tf.reduce_sum(sum_squared - squared_sum, axis=-1))
         return pairs_mulsum
 
 
-    def run_graph(self, num_features, train_data, val_data, test_data, sample_weights=None):
+    def train_epoch(self, sess, batch_input, fetches, num_workers=1, verbose=False, num_total_batches=None):
+        '''
+        Run the training fetches (training op, loss, ..., batch size) until the batches of the epoch run out.
+        With num_workers > 1 each thread takes the next batch of the shared input and applies its update without
+        waiting for the others. With OPTIMIZER 'lazy_adam' or 'adagrad' an update only writes the embedding rows of
+        its batch (and their slots), which mostly differ between the batches, so the lost updates are rare. With
+        'adam' the update of the slots m and v is dense: every thread would write every row of the tables and of both
+        slots, and overwrite the updates of the others, so run_graph rejects it with num_workers > 1.
+        :return: the number of batches and of instances trained on
+        '''
+        lock = threading.Lock()
+        counts, failures = [0, 0], []
+        start = [nowtime()]
+
+        def work():
+            try:
+                while True:
+                    try:
+                        _, loss_batch, _, batch_size = batch_input.run(sess, fetches)
+                    except tf.errors.OutOfRangeError:
+                        return
+                    with lock:
+                        counts[0] += 1
+                        counts[1] += batch_size
+                        if verbose:
+                            print("Batch %d/%d: batch loss = %.4f" % (counts[0], num_total_batches, loss_batch))
+                            print("                         time: %.4fs" % (nowtime() - start[0]))
+                            start[0] = nowtime()
+            except Exception as e:
+                failures.append(e)
+
+        workers = [threading.Thread(target=work) for _ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if failures:
+            raise failures[0]
+        return tuple(counts)
+
+    def run_graph(self, num_features, train_data, val_data, test_data, sample_weights=None, num_workers=NUM_WORKERS,
+                  cluster=None, stop_early=None):
         '''
 
         :param distribution:
         :param num_features:
         :param k: the dimensionality of the embedding, Must be >= 0; when k=0, it is a simple model; Otherwise it is factorized
-        :return:
-        '''
-        # INPUTs
-        feature_indice = tf.placeholder(tf.int32, name='feature_indice')
-        feature_values = tf.placeholder(tf.float32, name='feature_values')
-
-        min_hbs = tf.placeholder(tf.float32, name='min_headerbids')  # for regularization
-        max_hbs = tf.placeholder(tf.float32, name='max_headerbids')  # for regularization
-
-        times = tf.placeholder(tf.float32, shape=[None], name='times')
-        events = tf.placeholder(tf.int32, shape=[None], name='events')
-
-        # shape: (batch_size, max_nonzero_len)
-        embeddings_linear = tf.Variable(tf.truncated_normal(shape=(num_features,), mean=0.0, stddev=1e-5))
-        filtered_embeddings_linear = tf.nn.embedding_lookup(embeddings_linear, feature_indice) * feature_values
-        intercept = tf.Variable(1e-5)
-        linear_term = self.linear_function(filtered_embeddings_linear, intercept)
-        scale = linear_term
-
-        embeddings_factorized = None
-        filtered_embeddings_factorized = None
-        if self.k > 0:
-            # shape: (batch_size, max_nonzero_len, k)
-            embeddings_factorized = tf.Variable(tf.truncated_normal(shape=(num_features, self.k), mean=0.0, stddev=1e-5))
-            filtered_embeddings_factorized = tf.nn.embedding_lookup(embeddings_factorized, feature_indice) * \
-                                      tf.tile(tf.expand_dims(feature_values, axis=-1), [1, 1, 1])
-            factorized_term = self.factorization_machines(filtered_embeddings_factorized)
-            scale += factorized_term
-
-        scale = tf.nn.softplus(scale)
-
-        ''' 
-        if event == 0, right-censoring
-        if event == 1, left-censoring 
-        '''
-        shape = tf.Variable(0.2,
-                            trainable=True
-                            )
-        not_survival_proba = self.distribution.left_censoring(times, scale, shape)  # the left area
-
-
-        not_survival_bin = tf.where(tf.greater_equal(not_survival_proba, 0.5),
-                                    tf.ones(tf.shape(not_survival_proba)),
-                                    tf.zeros(tf.shape(not_survival_proba)))
-
-        running_acc, acc_update = None, None
-        if not sample_weights:
-            running_acc, acc_update = tf.metrics.accuracy(labels=events, predictions=not_survival_bin)
-        elif sample_weights == 'time':
-            running_acc, acc_update = tf.metrics.accuracy(labels=events, predictions=not_survival_bin, weights=times)
-
-        batch_loss = None
-        if not sample_weights:
-            batch_loss = tf.losses.log_loss(labels=events, predictions=not_survival_proba,
-                                            reduction = tf.losses.Reduction.MEAN)
-        elif sample_weights == 'time':
-            # class_weights = tf.where(tf.equal(events, 1),
-            #                             tf.ones(tf.shape(events)) * 100,
-            #                             tf.ones(tf.shape(events)))
-            batch_loss = tf.losses.log_loss(labels=events, predictions=not_survival_proba, weights=times,
-                                            reduction = tf.losses.Reduction.MEAN)
-        running_loss, loss_update = tf.metrics.mean(batch_loss)
-
-
-        # Header Bidding Regularization
-        hb_adxwon_partitions = tf.cast(
-            tf.logical_and(tf.equal(events, 0),  # adx won
-                           tf.logical_and(
-                               tf.not_equal(0.0, max_hbs),  # the max_hb is not missing
-                               tf.less(times, max_hbs)
-                               # tf.less(times, min_hbs),
-                               # tf.logical_and(
-                               #                                #     # tf.less(times, max_hbs),  # the max hb > the revenue
-                               #                                #                # tf.less(max_hbs - time, 1.0)  # remove the outliers
-                               #                                #                tf.less(times, min_hbs),
-                               #                                #                tf.less((max_hbs - times) / times, 0.01)
-                               #                                #                # tf.logical_and(
-                               #                                #                #     tf.less((max_hbs - times) / times, 0.01),
-                               #                                #                #     tf.less(times, 10.0)
-                               #                                #                # )
-                               #                                #                )
-                           )
-                           ), tf.int32)
-        hb_adxlose_partitions = tf.cast(
-            tf.logical_and(tf.equal(events, 1),  # adx lose
-                           tf.logical_and(
-                               tf.not_equal(0.0, min_hbs),  # the min_hb is not missing
-                               tf.less(min_hbs, times)  # the min hb < the floor
-                               # tf.less(max_hbs, times),
-                               # tf.logical_and(
-                               #                tf.less(min_hbs, times),
-                               #                # tf.less(max_hbs - time, 1.0)  # remove the outliers
-                               #                tf.less(0.9, (times - min_hbs) / times)
-                               #                # tf.logical_and(
-                               #                #     tf.less(0.1, (times - min_hbs) / times),
-                               #                #     tf.less(times, 10.0)
-                               #                # )
-                               #                )
-                           )
-                           ), tf.int32)
-
-        # Using boolean_mask instead of dynamic_partition leads to:
-        # "UserWarning: Converting sparse IndexedSlices to a dense Tensor of unknown shape. This may consume a large amount of memory."
-        # https://stackoverflow.com/questions/44380727/get-userwarning-while-i-use-tf-boolean-mask?noredirect=1&lq=1
-        regable_hb_adxwon = tf.dynamic_partition(max_hbs, hb_adxwon_partitions, 2)[1]
-        regable_hb_adxlose = tf.dynamic_partition(min_hbs, hb_adxlose_partitions, 2)[1]
-        regable_scale_adxwon = tf.dynamic_partition(scale, hb_adxwon_partitions, 2)[1]
-        regable_scale_adxlose = tf.dynamic_partition(scale, hb_adxlose_partitions, 2)[1]
-
-        hb_adxwon_pred = self.distribution.left_censoring(regable_hb_adxwon, regable_scale_adxwon, shape)
-        hb_adxlose_pred = self.distribution.left_censoring(regable_hb_adxlose, regable_scale_adxlose, shape)
-
-        hb_reg_adxwon, hb_reg_adxlose = None, None
-        if not sample_weights:
-        # if True:
-            hb_reg_adxwon = tf.losses.log_loss(labels=tf.zeros(tf.shape(hb_adxwon_pred)),
-                                               predictions=hb_adxwon_pred)
-            hb_reg_adxlose = tf.losses.log_loss(labels=tf.zeros(tf.shape(hb_adxlose_pred)),
-                                                predictions=hb_adxlose_pred)
-        elif sample_weights == 'time':
-            regable_time_adxwon = tf.dynamic_partition(times, hb_adxwon_partitions, 2)[1]
-            regable_time_adxlose = tf.dynamic_partition(times, hb_adxlose_partitions, 2)[1]
-            hb_reg_adxwon = tf.losses.log_loss(labels=tf.ones(tf.shape(hb_adxwon_pred)),
-                                               predictions=hb_adxwon_pred,
-                                               weights=1.0 / regable_time_adxwon)
-            hb_reg_adxlose = tf.losses.log_loss(labels=tf.zeros(tf.shape(hb_adxlose_pred)),
-                                                predictions=hb_adxlose_pred,
-                                                weights=1.0 / regable_time_adxlose)
-        mean_hb_reg_adxwon = tf.reduce_mean(hb_reg_adxwon)
-        mean_hb_reg_adxlose = tf.reduce_mean(hb_reg_adxlose)
-
-
-        # L2 regularized sum of squares loss function over the embeddings
+        :param num_workers: the training threads of train_epoch; more than one needs a sparse OPTIMIZER
+        :param cluster: the util.distributed.Cluster of this worker, to train on parameter servers
+        :param stop_early: called as stop_early(epoch, validation loss) after every evaluation, True stops the training
+                           (e.g. util.sweep.SuccessiveHalving)
+        :return: the training throughput (instances/s) of every epoch; the validation (loss, C-index) of every epoch
+                 evaluated are left in self.val_history
         '''
-        l2_norm = tf.constant(self.lambda_linear) * tf.pow(embeddings_linear, 2)
-        if embeddings_factorized is not None:
-            l2_norm += tf.reduce_sum(tf.pow(embeddings_factorized, 2), axis=-1)
-        sum_l2_norm = tf.constant(self.lambda_factorized) * tf.reduce_sum(l2_norm)
-        '''
-        l2_norm = self.lambda_linear * tf.nn.l2_loss(filtered_embeddings_linear)
-        if embeddings_factorized is not None:
-            l2_norm += self.lambda_factorized * tf.nn.l2_loss(filtered_embeddings_factorized)
-
-
-        loss_mean = batch_loss + \
-                    tf.constant(self.lambda_hb_adxwon) * mean_hb_reg_adxwon + \
-                    tf.constant(self.lambda_hb_adxlose) * mean_hb_reg_adxlose + \
-                    l2_norm
-        # training_op = tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(loss_mean)
-
-        ### gradient clipping
-        optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
-        gradients, variables = zip(*optimizer.compute_gradients(loss_mean))
-        gradients_clipped, _ = tf.clip_by_global_norm(gradients, 5.0)
-        training_op = optimizer.apply_gradients(zip(gradients_clipped, variables))
-
-
-        # Isolate the variables stored behind the scenes by the metric operation
-        running_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES)
-        # Define initializer to initialize/reset running variables
-        running_vars_initializer = tf.variables_initializer(var_list=running_vars)
-
-        init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
-
-
-        with tf.Session() as sess:
-            init.run()
+        if num_workers > 1 and OPTIMIZER not in SPARSE_OPTIMIZERS:
+            raise ValueError("%d training threads need a sparse OPTIMIZER (%s), not '%s'"
+                             % (num_workers, ', '.join(SPARSE_OPTIMIZERS), OPTIMIZER))
+        tf.reset_default_graph()
+        self.val_history = []
+
+        ''' with a cluster, the variables live on the ps tasks and the embedding tables are partitioned over them '''
+        device = cluster.device_setter() if cluster else None
+        local_device = cluster.worker_device if cluster else None
+        partitioner = cluster.partitioner() if cluster else None
+
+        with tf.device(device):
+            # INPUTs: the arrays of make_sparse_batch; min_hbs and max_hbs are for regularization
+            batch_input = BatchInput((tf.float32, tf.int32, tf.int32, tf.float32, tf.float32, tf.float32),
+                                     ([None], [None], [None, None], [None, None], [None], [None]))
+            self.batch_input = batch_input  # also read by evaluate
+            times, events, feature_indice, feature_values, min_hbs, max_hbs = batch_input.next_batch
+
+            # shape: (batch_size, max_nonzero_len)
+            embeddings_linear = embedding_table('embeddings_linear', (num_features,), EMBEDDING_DTYPE, partitioner)
+            filtered_embeddings_linear = embedding_lookup(embeddings_linear, feature_indice) * feature_values
+            intercept = tf.Variable(1e-5)
+            linear_term = self.linear_function(filtered_embeddings_linear, intercept)
+            scale = linear_term
+
+            embeddings_factorized = None
+            filtered_embeddings_factorized = None
+            if self.k > 0:
+                # shape: (batch_size, max_nonzero_len, k)
+                embeddings_factorized = embedding_table('embeddings_factorized', (num_features, self.k),
+                                                        EMBEDDING_DTYPE, partitioner)
+                filtered_embeddings_factorized = embedding_lookup(embeddings_factorized, feature_indice) * \
+                                          tf.tile(tf.expand_dims(feature_values, axis=-1), [1, 1, 1])
+                factorized_term = self.factorization_machines(filtered_embeddings_factorized)
+                scale += factorized_term
+
+            scale = tf.nn.softplus(scale)
+
+            ''' 
+            if event == 0, right-censoring
+            if event == 1, left-censoring 
+            '''
+            shape = tf.Variable(0.2,
+                                trainable=True
+                                )
+            not_survival_proba = self.distribution.left_censoring(times, scale, shape)  # the left area
+
+
+            not_survival_bin = tf.where(tf.greater_equal(not_survival_proba, 0.5),
+                                        tf.ones(tf.shape(not_survival_proba)),
+                                        tf.zeros(tf.shape(not_survival_proba)))
+
+            running_acc, acc_update = None, None
+            with tf.device(local_device):  # the running metrics of each worker are its own
+                if not sample_weights:
+                    running_acc, acc_update = tf.metrics.accuracy(labels=events, predictions=not_survival_bin)
+                elif sample_weights == 'time':
+                    running_acc, acc_update = tf.metrics.accuracy(labels=events, predictions=not_survival_bin, weights=times)
+
+            batch_loss = None
+            if not sample_weights:
+                batch_loss = tf.losses.log_loss(labels=events, predictions=not_survival_proba,
+                                                reduction = tf.losses.Reduction.MEAN)
+            elif sample_weights == 'time':
+                # class_weights = tf.where(tf.equal(events, 1),
+                #                             tf.ones(tf.shape(events)) * 100,
+                #                             tf.ones(tf.shape(events)))
+                batch_loss = tf.losses.log_loss(labels=events, predictions=not_survival_proba, weights=times,
+                                                reduction = tf.losses.Reduction.MEAN)
+            with tf.device(local_device):
+                running_loss, loss_update = tf.metrics.mean(batch_loss)
+
+
+            # Header Bidding Regularization
+            hb_adxwon_partitions = tf.cast(
+                tf.logical_and(tf.equal(events, 0),  # adx won
+                               tf.logical_and(
+                                   tf.not_equal(0.0, max_hbs),  # the max_hb is not missing
+                                   tf.less(times, max_hbs)
+                                   # tf.less(times, min_hbs),
+                                   # tf.logical_and(
+                                   #                                #     # tf.less(times, max_hbs),  # the max hb > the revenue
+                                   #                                #                # tf.less(max_hbs - time, 1.0)  # remove the outliers
+                                   #                                #                tf.less(times, min_hbs),
+                                   #                                #                tf.less((max_hbs - times) / times, 0.01)
+                                   #                                #                # tf.logical_and(
+                                   #                                #                #     tf.less((max_hbs - times) / times, 0.01),
+                                   #                                #                #     tf.less(times, 10.0)
+                                   #                                #                # )
+                                   #                                #                )
+                               )
+                               ), tf.int32)
+            hb_adxlose_partitions = tf.cast(
+                tf.logical_and(tf.equal(events, 1),  # adx lose
+                               tf.logical_and(
+                                   tf.not_equal(0.0, min_hbs),  # the min_hb is not missing
+                                   tf.less(min_hbs, times)  # the min hb < the floor
+                                   # tf.less(max_hbs, times),
+                                   # tf.logical_and(
+                                   #                tf.less(min_hbs, times),
+                                   #                # tf.less(max_hbs - time, 1.0)  # remove the outliers
+                                   #                tf.less(0.9, (times - min_hbs) / times)
+                                   #                # tf.logical_and(
+                                   #                #     tf.less(0.1, (times - min_hbs) / times),
+                                   #                #     tf.less(times, 10.0)
+                                   #                # )
+                                   #                )
+                               )
+                               ), tf.int32)
+
+            # Using boolean_mask instead of dynamic_partition leads to:
+            # "UserWarning: Converting sparse IndexedSlices to a dense Tensor of unknown shape. This may consume a large amount of memory."
+            # https://stackoverflow.com/questions/44380727/get-userwarning-while-i-use-tf-boolean-mask?noredirect=1&lq=1
+            regable_hb_adxwon = tf.dynamic_partition(max_hbs, hb_adxwon_partitions, 2)[1]
+            regable_hb_adxlose = tf.dynamic_partition(min_hbs, hb_adxlose_partitions, 2)[1]
+            regable_scale_adxwon = tf.dynamic_partition(scale, hb_adxwon_partitions, 2)[1]
+            regable_scale_adxlose = tf.dynamic_partition(scale, hb_adxlose_partitions, 2)[1]
+
+            hb_adxwon_pred = self.distribution.left_censoring(regable_hb_adxwon, regable_scale_adxwon, shape)
+            hb_adxlose_pred = self.distribution.left_censoring(regable_hb_adxlose, regable_scale_adxlose, shape)
+
+            hb_reg_adxwon, hb_reg_adxlose = None, None
+            if not sample_weights:
+            # if True:
+                hb_reg_adxwon = tf.losses.log_loss(labels=tf.zeros(tf.shape(hb_adxwon_pred)),
+                                                   predictions=hb_adxwon_pred)
+                hb_reg_adxlose = tf.losses.log_loss(labels=tf.zeros(tf.shape(hb_adxlose_pred)),
+                                                    predictions=hb_adxlose_pred)
+            elif sample_weights == 'time':
+                regable_time_adxwon = tf.dynamic_partition(times, hb_adxwon_partitions, 2)[1]
+                regable_time_adxlose = tf.dynamic_partition(times, hb_adxlose_partitions, 2)[1]
+                hb_reg_adxwon = tf.losses.log_loss(labels=tf.ones(tf.shape(hb_adxwon_pred)),
+                                                   predictions=hb_adxwon_pred,
+                                                   weights=1.0 / regable_time_adxwon)
+                hb_reg_adxlose = tf.losses.log_loss(labels=tf.zeros(tf.shape(hb_adxlose_pred)),
+                                                    predictions=hb_adxlose_pred,
+                                                    weights=1.0 / regable_time_adxlose)
+            mean_hb_reg_adxwon = tf.reduce_mean(hb_reg_adxwon)
+            mean_hb_reg_adxlose = tf.reduce_mean(hb_reg_adxlose)
+
+
+            # L2 regularized sum of squares loss function over the embeddings
+            '''
+            l2_norm = tf.constant(self.lambda_linear) * tf.pow(embeddings_linear, 2)
+            if embeddings_factorized is not None:
+                l2_norm += tf.reduce_sum(tf.pow(embeddings_factorized, 2), axis=-1)
+            sum_l2_norm = tf.constant(self.lambda_factorized) * tf.reduce_sum(l2_norm)
+            '''
+            l2_norm = self.lambda_linear * tf.nn.l2_loss(filtered_embeddings_linear)
+            if embeddings_factorized is not None:
+                l2_norm += self.lambda_factorized * tf.nn.l2_loss(filtered_embeddings_factorized)
+
+
+            loss_mean = batch_loss + \
+                        tf.constant(self.lambda_hb_adxwon) * mean_hb_reg_adxwon + \
+                        tf.constant(self.lambda_hb_adxlose) * mean_hb_reg_adxlose + \
+                        l2_norm
+            # training_op = tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(loss_mean)
+
+            ### gradient clipping
+            optimizer = make_optimizer(OPTIMIZER, self.learning_rate, epsilon=adam_epsilon(EMBEDDING_DTYPE))
+            if OPTIMIZER == 'adam':
+                gradients, variables = zip(*optimizer.compute_gradients(loss_mean))
+                gradients_clipped = clip_by_global_norm(gradients, 5.0)
+                training_op = optimizer.apply_gradients(zip(gradients_clipped, variables))
+            else:
+                training_op = optimizer.apply_gradients(clip_sparse_gradients(optimizer.compute_gradients(loss_mean), 5.0))
+
+
+            # Isolate the variables stored behind the scenes by the metric operation
+            running_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES)
+            # Define initializer to initialize/reset running variables
+            running_vars_initializer = tf.variables_initializer(var_list=running_vars)
+
+            init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+            epochs = itertools.count()  # the workers of a cluster split the batches of each epoch
+            train_init = batch_input.data_initializer(
+                train_data, (lambda make_plan: cluster.worker_batches(make_plan, seed=next(epochs))) if cluster else None,
+                batch_size=self.batch_size, only_freq=ONLY_FREQ_TRAIN, num_buckets=NUM_LENGTH_BUCKETS)
+            eval_inits = [batch_input.data_initializer(data, only_freq=ONLY_FREQ_TEST, shuffle=False,
+                                                       num_buckets=NUM_LENGTH_BUCKETS)
+                          for data in (train_data, val_data, test_data)]
+            train_eval_init, val_init, test_init = eval_inits
+            training_fetches = [training_op, loss_mean, acc_update, tf.size(events)]
+            ''' the whole tables, also when partitioned, in float32 whatever EMBEDDING_DTYPE '''
+            embedding_tables = {'embeddings_linear': tf.cast(tf.convert_to_tensor(embeddings_linear), tf.float32)}
+            if embeddings_factorized is not None:
+                embedding_tables['embeddings_factorized'] = tf.cast(tf.convert_to_tensor(embeddings_factorized),
+                                                                    tf.float32)
+        print_embedding_memory(EMBEDDING_DTYPE)
+
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=INTRA_OP_THREADS,
+                                inter_op_parallelism_threads=INTER_OP_THREADS)
+        sess = cluster.session(init, tf.local_variables_initializer(), config) if cluster else tf.Session(config=config)
+        with sess:
+            if cluster is None:
+                init.run()
 
             max_loss_val = None
+            throughputs = []
 
             num_total_batches = int(np.ceil(train_data.num_instances / self.batch_size))
             for epoch in range(1, self.num_epochs + 1):
                 sess.run(running_vars_initializer)
                 # model training
-                num_batch = 0
                 start = nowtime()
-                for time_batch, event_batch, featidx_batch, featval_batch, minhbs_natch, maxhbs_batch, max_nz_len \
-                        in train_data.make_sparse_batch(self.batch_size, only_freq=ONLY_FREQ_TRAIN):
-
-                    num_batch += 1
-
-                    _, loss_batch, _, event_batch, time_batch, shape_batch = sess.run([training_op, loss_mean,
-                                                                  acc_update, events, times, shape],
-                                                                   feed_dict={
-                                             'feature_indice:0': featidx_batch,
-                                             'feature_values:0': featval_batch,
-                                             'min_headerbids:0': minhbs_natch,
-                                             'max_headerbids:0': maxhbs_batch,
-                                             'times:0': time_batch,
-                                             'events:0': event_batch})
-
-                    # print()
-                    # print('mean_hb_reg_adxwon_batch')
-                    # print(mean_hb_reg_adxwon_batch)
-                    # print('mean_hb_reg_adxlose_batch')
-                    # print(mean_hb_reg_adxlose_batch)
-                    # print('mean_batch_loss_batch')
-                    # print(mean_batch_loss_batch)
-                    # print("event_batch")
-                    # print(event_batch)
-                    # print('shape_batch')
-                    # print(shape_batch)
-
-                    if epoch == 1:
-                        print("Epoch %d - Batch %d/%d: batch loss = %.4f" %
-                              (epoch, num_batch, num_total_batches, loss_batch))
-                        print("                         time: %.4fs" % (nowtime() - start))
-                        start = nowtime()
+                batch_input.start(sess, train_init)
+                num_batches, num_instances = self.train_epoch(sess, batch_input, training_fetches, num_workers,
+                                                              verbose=epoch == 1, num_total_batches=num_total_batches)
+                throughputs.append(num_instances / (nowtime() - start))
+                print("Epoch %d: %d batches, %.0f instances/s with %d workers" %
+                      (epoch, num_batches, throughputs[-1], num_workers))
+                batch_input.report("Epoch %d training batches" % epoch)
+                if cluster is not None and not cluster.is_chief:  # the chief evaluates the shared model
+                    continue
 
 
                 # evaluation on training data
-                eval_nodes_update = [loss_update, acc_update, not_survival_proba, scale, max_hbs]
+                eval_nodes_update = [loss_update, acc_update, not_survival_proba, scale, max_hbs, events, times]
                 eval_nodes_metric = [running_loss, running_acc]
                 print()
                 print("========== Evaluation at Epoch %d ==========" % epoch)
                 print('*** On Training Set:')
-                (loss_train, acc_train), _, _, _, _, _ = self.evaluate(train_data.make_sparse_batch(only_freq=ONLY_FREQ_TEST),
+                (loss_train, acc_train), _, _, _, _, _ = self.evaluate(train_eval_init,
                                                                  running_vars_initializer, sess,
                                                                  eval_nodes_update, eval_nodes_metric,
                                                                  sample_weights)
@@ -271,12 +359,14 @@ class ParametricSurvival:
 
                 # evaluation on validation data
                 print('*** On Validation Set:')
-                (loss_val, acc_val), not_survival_val, _, _, events_val, times_val = self.evaluate(val_data.make_sparse_batch(only_freq=ONLY_FREQ_TEST),
+                (loss_val, acc_val), not_survival_val, _, _, events_val, times_val = self.evaluate(val_init,
                                                            running_vars_initializer, sess,
                                                            eval_nodes_update, eval_nodes_metric,
                                                            sample_weights)
                 # print("TENSORFLOW:\tloss = %.6f\taccuracy = %.4f" % (loss_val, acc_val))
-                print("Validation C-Index = %.4f" % c_index(events_val, not_survival_val, times_val))
+                c_index_val = c_index(events_val, not_survival_val, times_val)
+                print("Validation C-Index = %.4f" % c_index_val)
+                self.val_history.append((loss_val, c_index_val))
 
 
 
@@ -287,7 +377,7 @@ class ParametricSurvival:
                     # evaluation on test data
                     print('*** On Test Set:')
                     (loss_test, acc_test), not_survival_test, scale_test, max_hbs_test, events_test, times_test = self.evaluate(
-                        test_data.make_sparse_batch(only_freq=ONLY_FREQ_TEST),
+                        test_init,
                         running_vars_initializer, sess,
                         eval_nodes_update, eval_nodes_metric,
                         sample_weights)
@@ -305,38 +395,42 @@ class ParametricSurvival:
                     print('All predictions are outputted for error analysis')
 
                     # Store parameters
-                    params = {'embeddings_linear': embeddings_linear.eval(),
+                    params = {'embeddings_linear': embedding_tables['embeddings_linear'].eval(),
                               'intercept': intercept.eval(),
                               'shape': shape.eval(),
-                              'distribution_name': type(self.distribution).__name__}
+                              'distribution_name': type(self.distribution).__name__,
+                              'col_map': train_data.col_map}  # attr2idx column -> embedding row (-1: dropped)
                     if embeddings_factorized is not None:
-                        params['embeddings_factorized'] = embeddings_factorized.eval(),
+                        params['embeddings_factorized'] = embedding_tables['embeddings_factorized'].eval(),
                     pickle.dump(params, open('output/params_k%d.pkl' % self.k, 'wb'))
 
+                if stop_early is not None and stop_early(epoch, loss_val):
+                    print("Stopped at epoch %d" % epoch)
+                    break
+        return throughputs
 
 
 
 
-    def evaluate(self, next_batch, running_init, sess, updates, metrics, sample_weights=None):
+    def evaluate(self, batch_init, running_init, sess, updates, metrics, sample_weights=None):
+        ''' :param batch_init: the BatchInput initializer of the data set to evaluate '''
         all_not_survival = []
         all_events = []
         all_times = []
         all_scales = []
         all_max_hbs = []
-        sess.run(running_init)
-        for time_batch, event_batch, featidx_batch, featval_batch, minhbs_natch, maxhbs_batch, max_nz_len in next_batch:
-            _, _, not_survival, scale_batch, max_hbs_batch  = sess.run(updates, feed_dict={
-                                             'feature_indice:0': featidx_batch,
-                                             'feature_values:0': featval_batch,
-                                             'min_headerbids:0': minhbs_natch,
-                                             'max_headerbids:0': maxhbs_batch,
-                                             'times:0': time_batch,
-                                             'events:0': event_batch})
+        self.batch_input.start(sess, batch_init, running_init)
+        while True:
+            try:
+                _, _, not_survival, scale_batch, max_hbs_batch, event_batch, time_batch = self.batch_input.run(sess, updates)
+            except tf.errors.OutOfRangeError:
+                break
             all_not_survival.extend(not_survival)
             all_events.extend(event_batch)
             all_times.extend(time_batch)
             all_scales.extend(scale_batch)
             all_max_hbs.extend(max_hbs_batch)
+        self.batch_input.report("Evaluation batches")
 
         all_not_survival = np.array(all_not_survival, dtype=np.float64)
         all_not_survival_bin = np.where(all_not_survival>=0.5, 1.0, 0.0)
@@ -355,9 +449,11 @@ class ParametricSurvival:
 
 
 if __name__ == "__main__":
-    with open('output/FeatVec_adxwon.csv') as f:
-        ''' The first line is the total number of unique features '''
-        num_features = int(f.readline())
+    ''' set by util.distributed.launch_local for every process of a local cluster; a ps task only serves from here on '''
+    cluster = Cluster.from_env()
+    if cluster is not None:
+        assert TRAIN_DAYS is None, "the time windows are trained on one machine"
+        cluster.start()
 
     model = ParametricSurvival(
         distribution=Distributions.WeibullDistribution(),
@@ -371,14 +467,30 @@ if __name__ == "__main__":
         lambda_hb_adxlose=0.0
     )
 
-    print('Start training...')
-    model.run_graph(num_features,
-                    SurvivalData(*pickle.load(open('output/TRAIN_SET.p', 'rb')),
-                                 min_occurrence=MIN_OCCURRENCE),
-                    SurvivalData(*pickle.load(open('output/VAL_SET.p', 'rb')),
-                                 min_occurrence=MIN_OCCURRENCE,
-                                 only_hb_imp = ONLY_HB_IMP),
-                    SurvivalData(*pickle.load(open('output/TEST_SET.p', 'rb')),
-                                 min_occurrence=MIN_OCCURRENCE,
-                                 only_hb_imp=ONLY_HB_IMP),
-                    sample_weights='time')
+    if TRAIN_DAYS is not None:
+        ''' one data set of all the impressions; every window is a selection of its rows, not a copy '''
+        all_data = load_survival_data('output/ALL_SET.p', min_occurrence=MIN_OCCURRENCE)
+        day_index = DayIndex().load('output/DAY_INDEX.npz')
+        for val_day, train_rows, val_rows in day_index.rolling_windows(TRAIN_DAYS, last_test_day=day_index.days[-2]):
+            print('Start training on %d days before %s...' % (TRAIN_DAYS, val_day))
+            test_rows = day_index.rows(val_day + 1, val_day + 2)  # the day after the validation day
+            if not len(train_rows) or not len(val_rows) or not len(test_rows):
+                continue
+            model.run_graph(all_data.num_features,
+                            all_data.window(train_rows),
+                            all_data.window(val_rows, only_hb_imp=ONLY_HB_IMP),
+                            all_data.window(test_rows, only_hb_imp=ONLY_HB_IMP),
+                            sample_weights='time')
+    else:
+        print('Start training...')
+        ''' the number of features after dropping the additionally merged users and pages '''
+        if TRAIN_SHARDS_DIR is not None:
+            train_data = ShardedSurvivalData(TRAIN_SHARDS_DIR, min_occurrence=MIN_OCCURRENCE)
+        else:
+            train_data = load_survival_data('output/TRAIN_SET.p', min_occurrence=MIN_OCCURRENCE)
+        model.run_graph(train_data.num_features,
+                        train_data,
+                        load_survival_data('output/VAL_SET.p', min_occurrence=MIN_OCCURRENCE, only_hb_imp=ONLY_HB_IMP),
+                        load_survival_data('output/TEST_SET.p', min_occurrence=MIN_OCCURRENCE, only_hb_imp=ONLY_HB_IMP),
+                        sample_weights='time',
+                        cluster=cluster)
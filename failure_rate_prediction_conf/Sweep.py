@@ -0,0 +1,73 @@
+"""
+Hyperparameter sweep of ParametricSurvival over k, learning_rate, the lambdas, the distribution and sample_weights,
+with util.sweep, instead of editing the __main__ of ParametricSurvivalModels for every setting:
+    python -m failure_rate_prediction_conf.Sweep
+Every process of the pool loads output/TRAIN_SET.p, VAL_SET.p and TEST_SET.p once; the results table is written to
+output/sweep_results.csv, and the files of each trial under output/sweep/trial_<no>/.
+"""
+import os
+from util.sweep import grid, random_search, log_uniform, run_sweep
+from failure_rate_prediction_conf import Distributions, ParametricSurvivalModels
+from failure_rate_prediction_conf.DataReader import load_survival_data
+from failure_rate_prediction_conf.ParametricSurvivalModels import ParametricSurvival, MIN_OCCURRENCE, ONLY_HB_IMP
+
+SEARCH = 'random'  # or 'grid': every combination of GRID
+NUM_TRIALS = 32  # of the random search
+SEED = 0
+THREADS_PER_TRIAL = 4
+NUM_PROCESSES = None  # the trials run concurrently; None: as many as fit on the cores
+''' a trial never stopped trains NUM_EPOCHS epochs; with successive halving the rungs are at 1, 3 and 9 epochs '''
+NUM_EPOCHS = 9
+HALVING = True
+ETA = 3
+
+SPACE = {
+    'k': [10, 20, 40, 80],
+    'learning_rate': log_uniform(1e-4, 1e-2),
+    'lambda_linear': [0.0, 1e-6, 1e-4],
+    'lambda_factorized': [0.0, 1e-6, 1e-4],
+    'lambda_hb_adxwon': [0.0, 0.1, 1.0],
+    'lambda_hb_adxlose': [0.0, 0.1, 1.0],
+    'distribution': ['WeibullDistribution', 'LogLogisticDistribution', 'GammaDistribution'],
+    'sample_weights': [None, 'time'],
+}
+GRID = {
+    'k': [20, 80],
+    'learning_rate': [1e-3, 1e-4],
+    'distribution': ['WeibullDistribution', 'LogLogisticDistribution'],
+    'sample_weights': [None, 'time'],
+}
+
+
+def pin_threads(threads):
+    ParametricSurvivalModels.INTRA_OP_THREADS = threads
+    ParametricSurvivalModels.INTER_OP_THREADS = 1
+
+
+def load():
+    return tuple(load_survival_data(os.path.abspath('output/%s_SET.p' % data_type), min_occurrence=MIN_OCCURRENCE,
+                                    only_hb_imp=ONLY_HB_IMP and data_type != 'TRAIN')
+                 for data_type in ('TRAIN', 'VAL', 'TEST'))
+
+
+def trial(params, data, stop_early):
+    ''' :return: the validation loss and C-index of the best epoch, and the epochs trained '''
+    train_data, val_data, test_data = data
+    params = dict(params)
+    distribution = getattr(Distributions, params.pop('distribution'))()
+    sample_weights = params.pop('sample_weights')
+    model = ParametricSurvival(distribution=distribution, batch_size=2048, num_epochs=NUM_EPOCHS, **params)
+
+    os.makedirs('output', exist_ok=True)  # run_graph writes its predictions and parameters under output/
+    throughputs = model.run_graph(train_data.num_features, train_data, val_data, test_data,
+                                  sample_weights=sample_weights, stop_early=stop_early)
+    val_loss, c_index = min(model.val_history)
+    return {'val_loss': val_loss, 'c_index': c_index, 'epochs': len(model.val_history),
+            'instances_per_s': sum(throughputs) / len(throughputs)}
+
+
+if __name__ == "__main__":
+    trials = random_search(SPACE, NUM_TRIALS, SEED) if SEARCH == 'random' else grid(GRID)
+    run_sweep(trial, trials, load=load, pin_threads=pin_threads, threads_per_trial=THREADS_PER_TRIAL,
+              num_processes=NUM_PROCESSES, halving=HALVING, eta=ETA, trials_dir='output/sweep',
+              results_path='output/sweep_results.csv')
@@ -0,0 +1,34 @@
+"""
+Random data shaped like TRAIN_SET.p, for the benchmarks and the tests.
+"""
+import numpy as np
+from scipy.sparse import csr_matrix
+from failure_rate_prediction_conf.DataReader import SurvivalData
+from failure_rate_prediction_conf.data_entry_class.ImpressionEntry import MIN_OCCURRENCE_SYMBOL
+
+
+def random_csr(rs, num_rows, num_columns, max_nnz):
+    ''' 1 to max_nnz random nonzeros per row, drawn from the RandomState rs '''
+    nnz = rs.randint(1, max_nnz + 1, size=num_rows)
+    indptr = np.concatenate(([0], np.cumsum(nnz)))
+    mat = csr_matrix((rs.rand(indptr[-1]), rs.randint(num_columns, size=indptr[-1]), indptr),
+                     shape=(num_rows, num_columns))
+    mat.sum_duplicates()
+    return mat
+
+
+def rares_attr2idx():
+    ''' the attr2idx SurvivalData needs: the rare users and the rare pages in the first two columns '''
+    return {'UserId': {MIN_OCCURRENCE_SYMBOL: 0}, 'NaturalIDs': {MIN_OCCURRENCE_SYMBOL: 1}}
+
+
+def random_survival_data(rs, num_rows, num_features, max_nnz, num_hb_keys, event_probability=None):
+    '''
+    :param event_probability: the probability of the event of every row given the features (e.g. a random linear
+                              model, so that a model can learn something); 0.5 by default
+    '''
+    features = random_csr(rs, num_rows, num_features, max_nnz)
+    probability = 0.5 if event_probability is None else event_probability(features)
+    events = (rs.rand(num_rows) < probability).astype(int)
+    return SurvivalData(rs.exponential(size=num_rows), events, features,
+                        random_csr(rs, num_rows, num_hb_keys, num_hb_keys), attr2idx=rares_attr2idx())
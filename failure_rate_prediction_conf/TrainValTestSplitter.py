@@ -1,9 +1,14 @@
-import csv, random, numpy as np, pickle
-from scipy.sparse import coo_matrix
+import os, csv, shutil, numpy as np, pandas as pd, pickle
+from itertools import repeat
+from util.day_index import DayIndex
+from util.hash_split import assign_partition, split_key_value
+from util.sparse_vector_reader import read_sparse_vectors, iter_sparse_vector_blocks, to_csr_matrix
+from util.shards import write_shard, write_shard_meta, shuffle_shards
 from failure_rate_prediction_conf.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS
+from failure_rate_prediction_conf.Vectorizer import vector_file_sets
 
-ADXWON_FEATVEC_IN_PATH, ADXLOSE_FEATVEC_IN_PATH = 'output/FeatVec_adxwon.csv', 'output/FeatVec_adxlose.csv'
-ADXWON_hb_IN_PATH, ADXLOSE_hb_IN_PATH = 'output/HeaderBids_adxwon.csv', 'output/HeaderBids_adxlose.csv'
+''' the vector files of the Vectorizer, with those of its incremental updates (output/FeatVec_adxwon_<tag>.csv, ...) '''
+INPUT_DIR = 'output'
 
 TRAIN_TMPOUT_STEMPATH, VAL_TMPOUT_STEMPATH, TEST_TMPOUT_STEMPATH = 'output/train_tmp', 'output/val_tmp', 'output/test_tmp'
 
@@ -11,124 +16,147 @@ TRAIN_OUT_PATH, VAL_OUT_PATH, TEST_OUT_PATH = 'output/TRAIN_SET.p', 'output/VAL_
 
 TRAIN_PCT, VAL_PCT = 0.8, 0.1
 
-
-def num_lines(file_path, exclude_header=False):
-    raw_total = sum(1 for _ in csv.reader(open(file_path)))
-    return raw_total - 1 if exclude_header else raw_total  # minus the header line
-
-def print_lines_info(file_path, exclude_header=False):
-    print("%d lines in the %s" % (num_lines(file_path, exclude_header=exclude_header), file_path))
-    return num_lines(file_path)
-
-
-
-
-def random_split(FEATVEC_PATH, hb_PATH):
+'''
+'row': every impression is assigned on its own
+'ImpressionId': the same impression always goes to the same partition, also across re-vectorizations
+'UserId': all impressions of a user go to the same partition, avoiding user leakage between partitions
+(the impressions without a UserId are assigned by their ImpressionId, see split_key_value)
+'''
+SPLIT_KEY = 'UserId'
+SPLIT_SALT = 'split-v1'  # change the salt to draw another (still reproducible) split
+
+'''
+'hash': the random train/val/test split above
+'time': a single data set of all impressions plus its DayIndex, from which any (rolling) time window is taken
+'''
+SPLIT_MODE = 'hash'
+ALL_TMPOUT_STEMPATH, ALL_OUT_PATH, DAY_INDEX_PATH = 'output/all_tmp', 'output/ALL_SET.p', 'output/DAY_INDEX.npz'
+
+''' e.g. 200000: write each data set as shards of SHARD_SIZE rows (output/TRAIN_SET_shards/...) for ShardedSurvivalData,
+instead of one pickle; the temp csv files are then never loaded as a whole '''
+SHARD_SIZE = None
+SHUFFLE_TRAIN_SHARDS = True  # shuffle the training shards globally on disk (util.shards.shuffle_shards)
+
+
+def hash_split(FEATVEC_PATH, hb_PATH, KEYS_PATH, partition_files, split_key=SPLIT_KEY):
     """
-    This function assumes that the entire data can completely fit into the memory
+    Stream the lines of the input files into the partition files; only one line of each file is held in memory.
+    The partition of a line only depends on its key, so the split is reproducible without being stored.
+    :param partition_files: [(featvec_file, hb_file, keys_file)] of train, val and test; or of the single data set
+    :return: the number of lines written to each partition
     """
     global num_features
+    num_rows = [0] * len(partition_files)
+    ''' vector files written before the keys files existed can still be split by row '''
+    keys_file = open(KEYS_PATH, newline='\n') if split_key != 'row' or os.path.exists(KEYS_PATH) else None
     with open(FEATVEC_PATH, newline='\n') as featvec_file, open(hb_PATH, newline='\n') as hb_file:
-        num_features = int(next(featvec_file))  # skip the header
+        num_features = max(num_features, int(next(featvec_file)))  # skip the header
         next(hb_file)  # skip the header
-        for featvec_line, hb_line in zip(featvec_file, hb_file):
-            rand_float = random.random()  # Random float x, 0.0 <= x < 1.0
-            if rand_float < TRAIN_PCT:
-                training_featvec.append(featvec_line)
-                training_hb.append(hb_line)
-            elif TRAIN_PCT <= rand_float < TRAIN_PCT + VAL_PCT:
-                validation_featvec.append(featvec_line)
-                validation_hb.append(hb_line)
+        key_names = None
+        if keys_file is not None:
+            keys_header = next(keys_file)
+            for _, _, keys_out in partition_files:
+                if keys_out.tell() == 0:
+                    keys_out.write(keys_header)
+            if split_key != 'row':
+                key_names = next(csv.reader([keys_header]))
+
+        for i, (featvec_line, hb_line, keys_line) in enumerate(zip(featvec_file, hb_file,
+                                                                    keys_file if keys_file is not None else repeat(''))):
+            if key_names is None:
+                key = '%s:%d' % (os.path.basename(FEATVEC_PATH), i)
             else:
-                test_featvec.append(featvec_line)
-                test_hb.append(hb_line)
+                key = split_key_value(dict(zip(key_names, next(csv.reader([keys_line])))), split_key)
 
+            partition = assign_partition(key, TRAIN_PCT, VAL_PCT, SPLIT_SALT) if len(partition_files) > 1 else 0
+            featvec_out, hb_out, keys_out = partition_files[partition]
+            featvec_out.write(featvec_line)
+            hb_out.write(hb_line)
+            keys_out.write(keys_line)
+            num_rows[partition] += 1
 
+    if keys_file is not None:
+        keys_file.close()
+    return num_rows
 
 
-for infile_path in (ADXWON_FEATVEC_IN_PATH, ADXLOSE_FEATVEC_IN_PATH):
-    print_lines_info(infile_path, exclude_header=True)
-    
-training_featvec, validation_featvec, test_featvec = [], [], []
-training_hb, validation_hb, test_hb = [], [], []
 num_features = 0
 
-
-print("\nSplitting data...")
-for featvec_path, headerbids_path in (
-                    (ADXWON_FEATVEC_IN_PATH, ADXWON_hb_IN_PATH),
-                    (ADXLOSE_FEATVEC_IN_PATH, ADXLOSE_hb_IN_PATH)):
-    random_split(featvec_path, headerbids_path)
-
-assert len(training_featvec) == len(training_hb)
-assert len(validation_featvec) == len(validation_hb)
-assert len(test_featvec) == len(test_hb)
-#assert len(training_featvec) + len(validation_featvec) + len(test_featvec) == \
-#       print_lines_info(ADXWON_FEATVEC_IN_PATH, exclude_header=True) + print_lines_info(ADXLOSE_FEATVEC_IN_PATH, exclude_header=True)
-
-
-
-''' Write the split data sets (str; sparse format) to disk in order to easily check the partitions '''
-print("\nWriting data...")
-for featcsv_tmp, hb_tmp, tmpcsv_stempath in ((training_featvec, training_hb, TRAIN_TMPOUT_STEMPATH),
-                            (validation_featvec, validation_hb, VAL_TMPOUT_STEMPATH),
-                            (test_featvec, test_hb, TEST_TMPOUT_STEMPATH)):
-
-    open(tmpcsv_stempath + '_featvec.csv', 'w', newline='\n').writelines(featcsv_tmp)
-    open(tmpcsv_stempath + '_hb.csv', 'w', newline='\n').writelines(hb_tmp)
-    assert print_lines_info(tmpcsv_stempath + '_featvec.csv') == print_lines_info(tmpcsv_stempath + '_hb.csv')
-
-
-
-
-
+if SPLIT_MODE == 'time':
+    print("\nCollecting all data...")
+    tmpout_stempaths, out_paths = (ALL_TMPOUT_STEMPATH,), (ALL_OUT_PATH,)
+else:
+    print("\nSplitting data by %s..." % SPLIT_KEY)
+    tmpout_stempaths, out_paths = (TRAIN_TMPOUT_STEMPATH, VAL_TMPOUT_STEMPATH, TEST_TMPOUT_STEMPATH), \
+                                  (TRAIN_OUT_PATH, VAL_OUT_PATH, TEST_OUT_PATH)
+partition_rows = [0] * len(tmpout_stempaths)
+partition_files = [(open(stempath + '_featvec.csv', 'w', newline='\n'),
+                    open(stempath + '_hb.csv', 'w', newline='\n'),
+                    open(stempath + '_keys.csv', 'w', newline='\n')) for stempath in tmpout_stempaths]
+for featvec_path, headerbids_path, keys_path in vector_file_sets(INPUT_DIR):
+    for partition, n in enumerate(hash_split(featvec_path, headerbids_path, keys_path, partition_files)):
+        partition_rows[partition] += n
+for files in partition_files:
+    for f in files:
+        f.close()
+
+for stempath, n in zip(tmpout_stempaths, partition_rows):
+    print("%d lines are written to %s_*.csv" % (n, stempath))
 
 
 
 print("\nReading the temp csv files...")
 
 def read_data(featvec_path, hb_path):
-    times, events = [], []
-    num_rows = print_lines_info(featvec_path)
-    row_indices_fv, col_indices_fv, values_fv = [], [], []
-    row_indices_hb, col_indices_hb, values_hb = [], [], []
-
-    with open(featvec_path) as fvfile, open(hb_path) as hbfile:
-        fv_reader = csv.reader(fvfile, delimiter=',')
-        hb_reader = csv.reader(hbfile, delimiter=',')
-
-        for i, (featvec, hb) in enumerate(zip(fv_reader, hb_reader)):
-            times.append(float(featvec[0]))
-            events.append(int(featvec[1]))
-            try:
-                for node in featvec[2:]:
-                    col_index, val = node.split(':')
-                    row_indices_fv.append(i)
-                    col_indices_fv.append(int(col_index))
-                    values_fv.append(float(val))
-
-                for node in hb:
-                    if node == '':
-                        break
-                    col_index, val = node.split(':')
-                    row_indices_hb.append(i)
-                    col_indices_hb.append(int(col_index))
-                    values_hb.append(float(val))
-
-            except MemoryError:
-                print("MemoryError")
-            print(i, num_rows)
-
-    return np.array(times), \
-         np.array(events), \
-         coo_matrix((values_fv, (row_indices_fv, col_indices_fv)), shape=(num_rows, num_features)), \
-         coo_matrix((values_hb, (row_indices_hb, col_indices_hb)), shape=(num_rows, len(HEADER_BIDDING_KEYS)))
-
-for tmpcsv_stempath, pkl_path in ((TRAIN_TMPOUT_STEMPATH, TRAIN_OUT_PATH),
-                            (VAL_TMPOUT_STEMPATH, VAL_OUT_PATH),
-                            (TEST_TMPOUT_STEMPATH, TEST_OUT_PATH)):
+    _, target, *featvec_csr = read_sparse_vectors(featvec_path, num_scalars=2, has_header=False)
+    _, _, *hb_csr = read_sparse_vectors(hb_path, has_header=False)
+    num_rows = len(target)
+    assert num_rows == len(hb_csr[0]) - 1
+    print("%d lines in the %s" % (num_rows, featvec_path))
+
+    return target[:, 0], \
+         target[:, 1].astype(int), \
+         to_csr_matrix(*featvec_csr, num_features), \
+         to_csr_matrix(*hb_csr, len(HEADER_BIDDING_KEYS))
+
+def write_shards(featvec_path, hb_path, dir_path, shard_size):
+    ''' the same arrays as read_data, SHARD_SIZE rows per shard '''
+    os.makedirs(dir_path, exist_ok=True)
+    num_rows, num_hb_rows = [], 0
+    for shard_no, ((target, *featvec_csr), (_, *hb_csr)) in enumerate(zip(
+            iter_sparse_vector_blocks(featvec_path, num_scalars=2, has_header=False, lines_per_block=shard_size),
+            iter_sparse_vector_blocks(hb_path, has_header=False, lines_per_block=shard_size))):
+        assert len(target) == len(hb_csr[0]) - 1
+        sparse_headerbids = to_csr_matrix(*hb_csr, len(HEADER_BIDDING_KEYS))
+        write_shard(dir_path, shard_no,
+                    times=target[:, 0],
+                    events=target[:, 1].astype(int),
+                    sparse_features=to_csr_matrix(*featvec_csr, num_features),
+                    sparse_headerbids=sparse_headerbids)
+        num_rows.append(len(target))
+        num_hb_rows += len(np.unique(sparse_headerbids.nonzero()[0]))  # the has_hb rows of SurvivalData
+    ''' totals, which shuffle_shards keeps as they are '''
+    write_shard_meta(dir_path, num_rows, num_features=num_features, num_hb_rows=num_hb_rows)
+    print("%d lines in %d shards in %s" % (sum(num_rows), len(num_rows), dir_path))
+
+for tmpcsv_stempath, pkl_path in zip(tmpout_stempaths, out_paths):
+    if SHARD_SIZE:
+        shards_dir = os.path.splitext(pkl_path)[0] + '_shards'
+        if pkl_path == TRAIN_OUT_PATH and SHUFFLE_TRAIN_SHARDS:  # the csv rows are in the order of the input files
+            write_shards(tmpcsv_stempath + '_featvec.csv', tmpcsv_stempath + '_hb.csv',
+                         shards_dir + '_unshuffled', SHARD_SIZE)
+            shuffle_shards(shards_dir + '_unshuffled', shards_dir)
+            shutil.rmtree(shards_dir + '_unshuffled')
+        else:
+            write_shards(tmpcsv_stempath + '_featvec.csv', tmpcsv_stempath + '_hb.csv', shards_dir, SHARD_SIZE)
+        continue
     pickle.dump(read_data(tmpcsv_stempath + '_featvec.csv',
                           tmpcsv_stempath+ '_hb.csv'),
                 open(pkl_path, 'wb'))
     print("DUMPED:", pkl_path)
 
+if SPLIT_MODE == 'time':
+    day_index = DayIndex(pd.read_csv(ALL_TMPOUT_STEMPATH + '_keys.csv', usecols=['Date'])['Date'].values)
+    day_index.save(DAY_INDEX_PATH)
+    print("DUMPED: %s (%d days from %s to %s)" % (DAY_INDEX_PATH, len(day_index.days), day_index.days[0], day_index.days[-1]))
+
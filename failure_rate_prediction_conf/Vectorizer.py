@@ -1,4 +1,4 @@
-import os, csv, pickle
+import os, re, csv, pickle, pandas as pd
 from pymongo import MongoClient
 from pprint import pprint
 from failure_rate_prediction_conf.data_entry_class.NetworkBackfillImpressionEntry import NetworkBackfillImpressionEntry
@@ -13,21 +13,35 @@ FEATURE_FIELDS = ['URIs_pageno', 'NaturalIDs', 'RefererURL', 'UserId',
                   'Time',
                   'RequestLanguage', 'Country', 'Region', 'Metro', 'City',
                   'RequestedAdUnitSizes', 'AdPosition',
-                  'CustomTargeting', ]
+                  'CustomTargeting', 'ImpressionId']
+
+KEY_FIELDS = ['ImpressionId', 'UserId', 'Date']  # one line per vectorized impression, for splitting and indexing
 
 class Vectorizer:
     def __init__(self):
         self.client = MongoClient()
         self.counter = defaultdict(Counter)  # {Attribute1:Counter<features>, Attribute2:Counter<features>, ...}
 
-    def fit(self, dbname, colname, ImpressionEntry):
+    def load(self, counter_path, attr2idx_path):
+        '''
+        Load a persisted counter and attr2idx so that new days of data can be merged into them.
+        The dropped (dummy) feature of each attribute is the only frequent feature that is not indexed.
+        '''
+        self.counter = pickle.load(open(counter_path, 'rb'))
+        self.attr2idx = pickle.load(open(attr2idx_path, 'rb'))
+        self.num_features = 1 + max(idx for feat2idx in self.attr2idx.values() for idx in feat2idx.values())
+        self.dropped_features = {attr: {feat for feat, cnt in feat_counter.items()
+                                        if cnt >= MIN_OCCURRENCE and feat not in self.attr2idx[attr]}
+                                 for attr, feat_counter in self.counter.items()}
+
+    def fit(self, dbname, colname, ImpressionEntry, query=None):
         '''count unique attributes'''
         self.col = self.client[dbname][colname]
 
         # STOP = False
         n = 0
-        total_entries = self.col.find().count()
-        for doc in self.col.find(projection=FEATURE_FIELDS):
+        total_entries = self.col.find(query).count()
+        for doc in self.col.find(query, projection=FEATURE_FIELDS):
             if n % 1000000 == 0:
                 print('%d/%d (%.2f%%)' % (n, total_entries, n / total_entries * 100))
                 # if STOP:
@@ -73,91 +87,181 @@ class Vectorizer:
                 self.attr2idx[attr][feat] = self.num_features
                 self.num_features += 1
 
+    def extend_attr2idx(self):
+        '''
+        After fitting new days on top of a loaded counter, append the newly qualifying features
+        (and <RARE> symbols of attributes that had none) to the end of the index space.
+        Existing indices are never renumbered, so old vector files and trained embeddings stay valid.
+        '''
+        num_features_before = self.num_features
+        for attr, feat_counter in self.counter.items():
+            if attr not in self.attr2idx:  # unseen attribute, skip its most common feature as build_attr2idx does
+                self.dropped_features[attr] = {feat_counter.most_common(1)[0][0]}
+
+            for feat in feat_counter:
+                if feat in self.attr2idx[attr] or feat in self.dropped_features[attr]:
+                    continue
+
+                if feat_counter[feat] < MIN_OCCURRENCE:
+                    if MIN_OCCURRENCE_SYMBOL in self.attr2idx[attr]:
+                        continue
+                    feat = MIN_OCCURRENCE_SYMBOL
+
+                self.attr2idx[attr][feat] = self.num_features
+                self.num_features += 1
+        print('%d features are appended (%d -> %d)' % (self.num_features - num_features_before,
+                                                         num_features_before, self.num_features))
+
     def transform_one(self, doc, ImpressionEntry):
         imp_entry = ImpressionEntry(doc)
         imp_entry.build_entry()
         target = imp_entry.get_target()
         if not imp_entry.is_qualified() or not target:
-            return None, None
+            return None, None, None
         header_bids = imp_entry.to_sparse_headerbids()
+        user_id = doc.get('UserId')
+        keys = [doc.get('ImpressionId', doc['_id']), '' if pd.isnull(user_id) else user_id, doc['Time'].date().isoformat()]
         # return target + imp_entry.to_full_feature_vector(self.num_features, self.attr2idx)
-        return target + imp_entry.to_sparse_feature_vector(self.attr2idx, self.counter), header_bids
+        return target + imp_entry.to_sparse_feature_vector(self.attr2idx, self.counter), header_bids, keys
 
 
-    def transform(self, dbname, colname, ImpressionEntry):
+    def transform(self, dbname, colname, ImpressionEntry, query=None):
         self.col = self.client[dbname][colname]
         n = 0
-        total_entries = self.col.find().count()
+        total_entries = self.col.find(query).count()
         matrix = []
         header_bids = []
-        for doc in self.col.find(projection=FEATURE_FIELDS):
+        keys = []
+        for doc in self.col.find(query, projection=FEATURE_FIELDS):
             if n % 1000000 == 0:
                 print('%d/%d (%.2f%%)' % (n, total_entries, n / total_entries * 100))
-                yield matrix, header_bids
+                yield matrix, header_bids, keys
                 matrix.clear()
                 header_bids.clear()
+                keys.clear()
 
             n += 1
-            feat_vector, hbs = self.transform_one(doc, ImpressionEntry)
+            feat_vector, hbs, key = self.transform_one(doc, ImpressionEntry)
 
             if feat_vector:
                 matrix.append(feat_vector)
                 header_bids.append(hbs)
+                keys.append(key)
 
-        yield matrix, header_bids
+        yield matrix, header_bids, keys
         matrix.clear()
         header_bids.clear()
+        keys.clear()
 
 
-def output_vector_files(featfile_path, hbfile_path, colname, ImpressionEntry):
-    with open(featfile_path, 'a', newline='\n') as outfile_feat, open(hbfile_path, 'a', newline='\n') as outfile_hb:
+def output_vector_files(featfile_path, hbfile_path, keyfile_path, colname, ImpressionEntry, query=None):
+    with open(featfile_path, 'a', newline='\n') as outfile_feat, open(hbfile_path, 'a', newline='\n') as outfile_hb, \
+            open(keyfile_path, 'a', newline='\n') as outfile_key:
         writer_feat = csv.writer(outfile_feat, delimiter=',')
         writer_hb = csv.writer(outfile_hb, delimiter=',')
+        writer_key = csv.writer(outfile_key, delimiter=',')
         writer_feat.writerow([vectorizer.num_features])  # the number of features WITH header bidding BUT WITHOUT 'duration', 'event', and header bids
         writer_hb.writerow([len(HEADER_BIDDING_KEYS)])
-        for mat, hbs in vectorizer.transform('Header_Bidding', colname, ImpressionEntry):
+        writer_key.writerow(KEY_FIELDS)
+        for mat, hbs, keys in vectorizer.transform('Header_Bidding', colname, ImpressionEntry, query):
             writer_feat.writerows(mat)
             writer_hb.writerows(hbs)
+            writer_key.writerows(keys)
 
 
+def vector_file_sets(dir_path='output'):
+    '''
+    The (FeatVec, HeaderBids, Keys) files of the full vectorization, then those of every incremental_update tag in
+    the order of the tags; their header lines hold the number of features when each was written, which only grows.
+    '''
+    tags = sorted(match.group(1) for match in map(re.compile(r'FeatVec_adxwon_(.+)\.csv$').match, os.listdir(dir_path))
+                  if match)
+    file_sets = []
+    for suffix in [''] + ['_%s' % tag for tag in tags]:
+        for auction in ('adxwon', 'adxlose'):
+            file_sets.append(tuple(os.path.join(dir_path, '%s_%s%s.csv' % (prefix, auction, suffix))
+                                   for prefix in ('FeatVec', 'HeaderBids', 'Keys')))
+    return file_sets
 
-if __name__ == "__main__":
-    vectorizer = Vectorizer()
-    print('Fitting NetworkBackfillImpressions...')
-    vectorizer.fit('Header_Bidding', 'NetworkBackfillImpressions', NetworkBackfillImpressionEntry)
-    pprint(vectorizer.counter)
-    print()
-    print('Fitting NetworkImpressions...')
-    vectorizer.fit('Header_Bidding', 'NetworkImpressions', NetworkImpressionEntry)
-    vectorizer.build_attr2idx()
-    pprint(vectorizer.counter)
-    pprint(vectorizer.attr2idx)
-    pprint(vectorizer.num_features)
 
+def incremental_update(query, tag):
     '''
-    counter does NOT contain header bidding.
-    counter contains the most common feature in each attribute
+    Merge the counts of the documents matching the query (e.g. the new days) into output/counter.dict,
+    extend output/attr2idx.dict without renumbering and vectorize only the matching documents.
+    The header line of the new vector files holds the extended number of features; TrainValTestSplitter splits
+    them together with the earlier ones (vector_file_sets).
     '''
+    vectorizer.load('output/counter.dict', 'output/attr2idx.dict')
+    print('Fitting NetworkBackfillImpressions (%s)...' % tag)
+    vectorizer.fit('Header_Bidding', 'NetworkBackfillImpressions', NetworkBackfillImpressionEntry, query)
+    print('Fitting NetworkImpressions (%s)...' % tag)
+    vectorizer.fit('Header_Bidding', 'NetworkImpressions', NetworkImpressionEntry, query)
+    vectorizer.extend_attr2idx()
+
     pickle.dump(vectorizer.counter, open("output/counter.dict", "wb"))
-    '''
-    attr2idx does NOT contain header bidding.
-    attr2idx does NOT contain the most common feature in each attribute
-    '''
     pickle.dump(vectorizer.attr2idx, open("output/attr2idx.dict", "wb"))
 
-    try:
-        os.remove('output/FeatVec_adxwon.csv')
-        os.remove('output/FeatVec_adxlose.csv')
-        os.remove('output/HeaderBids_adxwon.csv')
-        os.remove('output/HeaderBids_adxlose.csv')
-    except OSError:
-        pass
-
-    output_vector_files('output/FeatVec_adxwon.csv',
-                        'output/HeaderBids_adxwon.csv',
+    output_vector_files('output/FeatVec_adxwon_%s.csv' % tag,
+                        'output/HeaderBids_adxwon_%s.csv' % tag,
+                        'output/Keys_adxwon_%s.csv' % tag,
                         'NetworkBackfillImpressions',
-                        NetworkBackfillImpressionEntry)
-    output_vector_files('output/FeatVec_adxlose.csv',
-                        'output/HeaderBids_adxlose.csv',
+                        NetworkBackfillImpressionEntry,
+                        query)
+    output_vector_files('output/FeatVec_adxlose_%s.csv' % tag,
+                        'output/HeaderBids_adxlose_%s.csv' % tag,
+                        'output/Keys_adxlose_%s.csv' % tag,
                         'NetworkImpressions',
-                        NetworkImpressionEntry)
+                        NetworkImpressionEntry,
+                        query)
+
+
+''' Set to a Mongo filter on 'Time' (e.g. {'Time': {'$gte': datetime(2018, 4, 16)}}) to only add new days of data '''
+INCREMENTAL_QUERY, INCREMENTAL_TAG = None, None
+
+if __name__ == "__main__":
+    vectorizer = Vectorizer()
+    if INCREMENTAL_QUERY is not None:
+        incremental_update(INCREMENTAL_QUERY, INCREMENTAL_TAG)
+    else:
+        print('Fitting NetworkBackfillImpressions...')
+        vectorizer.fit('Header_Bidding', 'NetworkBackfillImpressions', NetworkBackfillImpressionEntry)
+        pprint(vectorizer.counter)
+        print()
+        print('Fitting NetworkImpressions...')
+        vectorizer.fit('Header_Bidding', 'NetworkImpressions', NetworkImpressionEntry)
+        vectorizer.build_attr2idx()
+        pprint(vectorizer.counter)
+        pprint(vectorizer.attr2idx)
+        pprint(vectorizer.num_features)
+
+        '''
+        counter does NOT contain header bidding.
+        counter contains the most common feature in each attribute
+        '''
+        pickle.dump(vectorizer.counter, open("output/counter.dict", "wb"))
+        '''
+        attr2idx does NOT contain header bidding.
+        attr2idx does NOT contain the most common feature in each attribute
+        '''
+        pickle.dump(vectorizer.attr2idx, open("output/attr2idx.dict", "wb"))
+
+        try:
+            os.remove('output/FeatVec_adxwon.csv')
+            os.remove('output/FeatVec_adxlose.csv')
+            os.remove('output/HeaderBids_adxwon.csv')
+            os.remove('output/HeaderBids_adxlose.csv')
+            os.remove('output/Keys_adxwon.csv')
+            os.remove('output/Keys_adxlose.csv')
+        except OSError:
+            pass
+
+        output_vector_files('output/FeatVec_adxwon.csv',
+                            'output/HeaderBids_adxwon.csv',
+                            'output/Keys_adxwon.csv',
+                            'NetworkBackfillImpressions',
+                            NetworkBackfillImpressionEntry)
+        output_vector_files('output/FeatVec_adxlose.csv',
+                            'output/HeaderBids_adxlose.csv',
+                            'output/Keys_adxlose.csv',
+                            'NetworkImpressions',
+                            NetworkImpressionEntry)
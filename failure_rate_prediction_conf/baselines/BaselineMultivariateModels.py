@@ -32,7 +32,7 @@ class MultivariateSGDLogisticRegression:
         y_bin_true = []
         all_times = []
         weights = []
-        for times, events, features in data.get_sparse_feat_vec_batch(10000):
+        for times, events, features in data.get_sparse_feat_vec_batch(10000, shuffle=False):
             times_features = hstack((np.expand_dims(times, axis=1), features))
             y_bin_true.extend(events)
             y_proba_pred.extend(self.predict_proba(times_features)[:,1])
@@ -1,16 +1,13 @@
 import pickle, numpy as np, math
 from pprint import pprint
 from sklearn.feature_selection import chi2
-from failure_rate_prediction_conf.DataReader import SurvivalData
+from failure_rate_prediction_conf.DataReader import load_survival_data
 from tabulate import tabulate
 
 TRAIN_FILE_PATH = '../output/Vectors_train.p'
 VAL_FILE_PATH = '../output/Vectors_val.p'
 TEST_FILE_PATH = '../output/Vectors_test.p'
 
-def _read_data(file_path):
-    return pickle.load(open(file_path, 'rb'))
-
 def chi2_feature_selection(X, y):
     chi, pval = chi2(X, y)
     attr2idx = pickle.load(open('../output/attr2idx.dict', 'rb'))
@@ -35,6 +32,6 @@ def chi2_feature_selection(X, y):
 
 
 if __name__ == '__main__':
-    training_data = SurvivalData(*_read_data(TRAIN_FILE_PATH))
+    training_data = load_survival_data(TRAIN_FILE_PATH)
     chi2_feature_selection(training_data.sparse_features, training_data.events)
     # chi2_feature_selection(np.expand_dims(training_data.times, -1), training_data.events)
\ No newline at end of file
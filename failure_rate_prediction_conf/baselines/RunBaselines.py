@@ -1,16 +1,20 @@
-import pickle, numpy as np
+import os, pickle, numpy as np
 
-from failure_rate_prediction_conf.DataReader import SurvivalData
+from failure_rate_prediction_conf.DataReader import load_survival_data
 from failure_rate_prediction_conf.baselines.BaselineUnivariateModels import UnivariateLogisticRegression, KaplanMeier
 from failure_rate_prediction_conf.baselines.BaselineMultivariateModels import MultivariateSGDLogisticRegression
 
 
-TRAIN_FILE_PATH = '../output/TRAIN_SET.p'
-VAL_FILE_PATH = '../output/VAL_SET.p'
-TEST_FILE_PATH = '../output/TEST_SET.p'
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'output')
+TRAIN_FILE_PATH = os.path.join(OUTPUT_DIR, 'TRAIN_SET.p')
+VAL_FILE_PATH = os.path.join(OUTPUT_DIR, 'VAL_SET.p')
+TEST_FILE_PATH = os.path.join(OUTPUT_DIR, 'TEST_SET.p')
 
 def _read_data(file_path):
-    return pickle.load(open(file_path, 'rb'))
+    ''' the times and events columns of a pickled data set, without building its SurvivalData '''
+    with open(file_path, 'rb') as f:
+        times, events = pickle.load(f)[:2]
+    return np.asarray(times), np.asarray(events)
 
 def _expand_dims(data, axis=1):
     return np.expand_dims(data, axis=axis)
@@ -18,11 +22,11 @@ def _expand_dims(data, axis=1):
 def run_univariate_baselines(Baseline):
     baseline = Baseline()
 
-    times_train, events_train = _read_data(TRAIN_FILE_PATH)[:2]
+    times_train, events_train = _read_data(TRAIN_FILE_PATH)
     times_train = _expand_dims(times_train, axis=1)
-    times_val, events_val = _read_data(VAL_FILE_PATH)[:2]
+    times_val, events_val = _read_data(VAL_FILE_PATH)
     times_val = _expand_dims(times_val, axis=1)
-    times_test, events_test = _read_data(TEST_FILE_PATH)[:2]
+    times_test, events_test = _read_data(TEST_FILE_PATH)
     times_test = _expand_dims(times_test, axis=1)
 
     baseline.fit(np.array(times_train), np.array(events_train))
@@ -38,18 +42,17 @@ def run_univariate_baselines(Baseline):
 def run_multivariate_baselines(Baseline, sample_weights=None):
 
     baseline = Baseline()
-    training_data = SurvivalData(*_read_data(TRAIN_FILE_PATH))
-    baseline.partial_fit(training_data)
+    train_data = load_survival_data(TRAIN_FILE_PATH)  # the batches do not reorder it, so it is loaded once
+    baseline.partial_fit(train_data)
 
-    train_data = SurvivalData(*_read_data(TRAIN_FILE_PATH))
     print("Training Performance:\tlogloss=%.6f, c-index=%.6f, accuracy=%.6f" %
           baseline.evaluate(train_data, sample_weights=sample_weights))
 
-    val_data = SurvivalData(*_read_data(VAL_FILE_PATH))
+    val_data = load_survival_data(VAL_FILE_PATH)
     print("Validation Performance:\tlogloss=%.6f, c-index=%.6f, accuracy=%.6f" %
           baseline.evaluate(val_data, sample_weights=sample_weights))
 
-    test_data = SurvivalData(*_read_data(TEST_FILE_PATH))
+    test_data = load_survival_data(TEST_FILE_PATH)
     print("Test Performance:\tlogloss=%.6f, c-index=%.6f, accuracy=%.6f" %
           baseline.evaluate(test_data, sample_weights=sample_weights))
 
@@ -0,0 +1,52 @@
+"""
+Memory of the embedding tables and their optimizer slots with EMBEDDING_DTYPE float32, bfloat16 and float16, and the
+validation log-loss and C-index of ParametricSurvival.run_graph with each, on synthetic data shaped like TRAIN_SET.p
+whose events depend on the features (a random linear model), so the precision shows in the metrics.
+"""
+import os, tempfile
+import numpy as np
+from failure_rate_prediction_conf import Distributions, ParametricSurvivalModels
+from failure_rate_prediction_conf.ParametricSurvivalModels import ParametricSurvival
+from failure_rate_prediction_conf.SyntheticData import random_survival_data
+from util.embedding_precision import EMBEDDING_DTYPES, embedding_memory
+
+NUM_INSTANCES, NUM_EVAL_INSTANCES, NUM_FEATURES, NUM_HB_KEYS = 200000, 20000, 100000, 6
+NNZ_PER_ROW = 94
+BATCH_SIZE = 2048
+K = 20
+NUM_EPOCHS = 3
+
+
+def make_data(rs, num_instances, weights):
+    def event_probability(features):
+        logits = features.dot(weights)
+        return 1 / (1 + np.exp(-(logits - logits.mean()) / logits.std()))
+    return random_survival_data(rs, num_instances, NUM_FEATURES, NNZ_PER_ROW, NUM_HB_KEYS, event_probability)
+
+
+if __name__ == "__main__":
+    rs = np.random.RandomState(0)
+    weights = rs.normal(size=NUM_FEATURES)
+    train_data, val_data, test_data = make_data(rs, NUM_INSTANCES, weights), \
+                                      make_data(rs, NUM_EVAL_INSTANCES, weights), \
+                                      make_data(rs, NUM_EVAL_INSTANCES, weights)
+    os.chdir(tempfile.mkdtemp())  # run_graph writes its predictions and parameters under output/
+    os.makedirs('output')
+
+    results = {}
+    for dtype_name in EMBEDDING_DTYPES:
+        ParametricSurvivalModels.EMBEDDING_DTYPE = dtype_name
+        model = ParametricSurvival(distribution=Distributions.WeibullDistribution(), batch_size=BATCH_SIZE,
+                                   num_epochs=NUM_EPOCHS, k=K)
+        model.run_graph(train_data.num_features, train_data, val_data, test_data)
+        ''' the graph of the last run_graph stays the default graph '''
+        results[dtype_name] = embedding_memory() + min(model.val_history)
+
+    print('\n%d features, k=%d, optimizer %s, best validation epoch of %d'
+          % (train_data.num_features, K, ParametricSurvivalModels.OPTIMIZER, NUM_EPOCHS))
+    print('%9s %10s %10s %8s %10s %9s' % ('dtype', 'tables MB', 'slots MB', 'saved', 'val loss', 'C-index'))
+    float32_bytes = sum(results['float32'][:2])
+    for dtype_name, (tables, slots, loss_val, c_index_val) in results.items():
+        print('%9s %10.1f %10.1f %7.0f%% %10.5f %9.4f'
+              % (dtype_name, tables / 2 ** 20, slots / 2 ** 20, 100 * (1 - (tables + slots) / float32_bytes),
+                 loss_val, c_index_val))
@@ -0,0 +1,66 @@
+"""
+Time ParametricSurvival.factorization_machines (sum-of-squares form) against the pairwise form it replaced
+(tf.matmul(V, V^T) over the padded rows), across the embedding size k and the padded row length max_nonzero_len,
+and compare the size of their largest intermediate tensor.
+"""
+import time
+import numpy as np
+import tensorflow as tf
+from failure_rate_prediction_conf.ParametricSurvivalModels import ParametricSurvival
+
+BATCH_SIZE = 2048
+KS = (5, 20, 50)
+MAX_NONZERO_LENS = (16, 48, 94, 256)
+NUM_RUNS = 20
+
+
+def pairwise_factorization_machines(weights_factorized):
+    ''' the replaced implementation: all the (max_nonzero_len x max_nonzero_len) dot products of a row '''
+    dot_product_res = tf.matmul(weights_factorized, tf.transpose(weights_factorized, perm=[0,2,1]))
+    element_product_res = weights_factorized * weights_factorized
+    return tf.reduce_sum(tf.multiply(0.5, tf.reduce_sum(dot_product_res, axis=2)
+                                     - tf.reduce_sum(element_product_res, axis=2)),
+                         axis=-1)
+
+
+def make_batch(rs, max_nonzero_len, k):
+    ''' embeddings times feature values: the rows have 1 to max_nonzero_len nonzeros, the padding is zeros '''
+    weights = rs.normal(scale=0.1, size=(BATCH_SIZE, max_nonzero_len, k)).astype(np.float32)
+    lengths = rs.randint(1, max_nonzero_len + 1, size=BATCH_SIZE)
+    weights[np.arange(max_nonzero_len) >= lengths[:, None]] = 0.0
+    return weights
+
+
+def time_op(sess, op, feed_dict):
+    sess.run(op, feed_dict=feed_dict)  # warm up
+    start = time.time()
+    for _ in range(NUM_RUNS):
+        sess.run(op, feed_dict=feed_dict)
+    return (time.time() - start) / NUM_RUNS
+
+
+if __name__ == "__main__":
+    rs = np.random.RandomState(0)
+    model = ParametricSurvival(distribution=None, batch_size=BATCH_SIZE, num_epochs=0, k=0)
+
+    weights_factorized = tf.placeholder(tf.float32, shape=[None, None, None])
+    linear_op = model.factorization_machines(weights_factorized)
+    pairwise_op = pairwise_factorization_machines(weights_factorized)
+
+    print('%4s %6s %14s %14s %8s %16s %16s' % ('k', 'maxnnz', 'pairwise rows/s', 'linear rows/s', 'speedup',
+                                               'pairwise MB', 'linear MB'))
+    with tf.Session() as sess:
+        for k in KS:
+            for max_nonzero_len in MAX_NONZERO_LENS:
+                feed_dict = {weights_factorized: make_batch(rs, max_nonzero_len, k)}
+                linear_res, pairwise_res = sess.run([linear_op, pairwise_op], feed_dict=feed_dict)
+                assert np.allclose(linear_res, pairwise_res, rtol=1e-4, atol=1e-5)
+
+                pairwise_time = time_op(sess, pairwise_op, feed_dict)
+                linear_time = time_op(sess, linear_op, feed_dict)
+                ''' largest intermediate: (batch, max_nonzero_len, max_nonzero_len) vs the (batch, max_nonzero_len, k) input '''
+                pairwise_mb = BATCH_SIZE * max_nonzero_len * max(max_nonzero_len, k) * 4 / 2 ** 20
+                linear_mb = BATCH_SIZE * max_nonzero_len * k * 4 / 2 ** 20
+                print('%4d %6d %14.0f %14.0f %7.1fx %16.1f %16.1f'
+                      % (k, max_nonzero_len, BATCH_SIZE / pairwise_time, BATCH_SIZE / linear_time,
+                         pairwise_time / linear_time, pairwise_mb, linear_mb))
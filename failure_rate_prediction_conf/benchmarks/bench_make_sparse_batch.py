@@ -0,0 +1,122 @@
+"""
+Time SurvivalData.make_sparse_batch against the per-row assembly it replaced (np.split on indptr, a Python filter
+of the infrequent columns, per-row padding and min/max of the header bids), on synthetic data shaped like TRAIN_SET.p,
+and count the padded cells saved by length-bucketed batches.
+"""
+import time
+import numpy as np
+from failure_rate_prediction_conf.DataReader import SurvivalData
+from failure_rate_prediction_conf.SyntheticData import random_csr, rares_attr2idx
+from failure_rate_prediction_conf.data_entry_class.ImpressionEntry import MIN_OCCURRENCE as ORIGIN_MIN_OCCURRENCE
+
+NUM_INSTANCES, NUM_FEATURES, NUM_HB_KEYS = 200000, 100000, 6
+NNZ_PER_ROW = 94  # at most; the rows have 1 to NNZ_PER_ROW nonzeros
+INFREQ_FRACTION = 0.2  # of the columns, treated as additionally merged users and pages
+BATCH_SIZE = 2048
+NUM_LENGTH_BUCKETS = 4
+
+
+class SyntheticSurvivalData(SurvivalData):
+    ''' the additionally merged users and pages are random columns instead of those of output/counter.dict '''
+    infreq_cols = np.array([], dtype=int)
+
+    def load_addtl_infreq(self, min_occur, attr2idx=None, counter=None):
+        return tuple(np.array_split(self.infreq_cols, 2))
+
+    def merge_addtl_infreq(self):
+        pass
+
+
+def make_data(seed=0):
+    '''
+    :return: the SurvivalData to batch and, for the legacy batches, the same data before dropping the infrequent columns
+    '''
+    rs = np.random.RandomState(seed)
+    sparse_features = random_csr(rs, NUM_INSTANCES, NUM_FEATURES, NNZ_PER_ROW)
+    sparse_headerbids = random_csr(rs, NUM_INSTANCES, NUM_HB_KEYS, NUM_HB_KEYS)
+    sparse_headerbids = sparse_headerbids.multiply(rs.rand(NUM_INSTANCES, 1) < 0.5).tocsr()  # half without hb
+    sparse_headerbids.eliminate_zeros()
+    times, events = rs.exponential(size=NUM_INSTANCES), rs.randint(2, size=NUM_INSTANCES)
+    attr2idx = rares_attr2idx()
+    SyntheticSurvivalData.infreq_cols = 2 + np.flatnonzero(rs.rand(NUM_FEATURES - 2) < INFREQ_FRACTION)
+    data = SyntheticSurvivalData(times, events, sparse_features, sparse_headerbids,
+                                 min_occurrence=ORIGIN_MIN_OCCURRENCE + 1, attr2idx=attr2idx)
+
+    legacy_data = SurvivalData(times, events, sparse_features, sparse_headerbids, attr2idx=attr2idx)
+    legacy_data.infreq_user_col_indices, legacy_data.infreq_page_col_indices = \
+        np.array_split(SyntheticSurvivalData.infreq_cols, 2)
+    return data, legacy_data
+
+
+def _pad(rows, max_len, dtype):
+    ''' pad_sequences(rows, maxlen=max_len, padding='post') '''
+    padded = np.zeros((len(rows), max_len), dtype=dtype)
+    for i, row in enumerate(rows):
+        row = row[-max_len:]
+        padded[i, :len(row)] = row
+    return padded
+
+
+def legacy_batches(data, batch_size):
+    infreq_col_set = set(data.infreq_user_col_indices) | set(data.infreq_page_col_indices)
+    start_index = 0
+    while start_index < data.num_instances:
+        batch_feat_mat = data.sparse_features[start_index: start_index + batch_size, :]
+        feat_indices_batch = np.split(batch_feat_mat.indices, batch_feat_mat.indptr)[1:-1]
+        feat_values_batch = np.split(batch_feat_mat.data, batch_feat_mat.indptr)[1:-1]
+        filter_mask = [np.array(list(map(lambda i: i not in infreq_col_set, indices_arr))).astype(bool)
+                       for indices_arr in feat_indices_batch]
+        feat_indices_batch = [indices[mask] for indices, mask in zip(feat_indices_batch, filter_mask)]
+        feat_values_batch = [values[mask] for values, mask in zip(feat_values_batch, filter_mask)]
+        feat_indices_batch = _pad(feat_indices_batch, data.max_nonzero_len, np.int32)
+        feat_values_batch = _pad(feat_values_batch, data.max_nonzero_len, np.float32)
+
+        batch_hb_mat = data.sparse_headerbids[start_index: start_index + batch_size, :]
+        min_hbs_batch, max_hbs_batch = [], []
+        for row in np.split(batch_hb_mat.data, batch_hb_mat.indptr)[1:-1]:
+            min_hbs_batch.append(min(row) if row.size else 0.0)
+            max_hbs_batch.append(max(row) if row.size else 0.0)
+
+        yield data.times[start_index: start_index + batch_size], \
+              data.events[start_index: start_index + batch_size], \
+              feat_indices_batch, feat_values_batch, min_hbs_batch, max_hbs_batch, data.max_nonzero_len
+        start_index += batch_size
+
+
+def time_epoch(batches):
+    start = time.time()
+    num_batches = sum(1 for _ in batches)
+    return time.time() - start, num_batches
+
+
+if __name__ == "__main__":
+    data, legacy_data = make_data()
+
+    ''' the dropped columns are compacted away: the legacy columns are renumbered and the rows padded less '''
+    for new, old in zip(data.make_sparse_batch(BATCH_SIZE, only_freq=False, shuffle=False),
+                        legacy_batches(legacy_data, BATCH_SIZE)):
+        width = new[2].shape[1]
+        old_indices = np.where(old[3] != 0, data.col_map[old[2]], 0)
+        assert np.array_equal(new[2], old_indices[:, :width]) and not old_indices[:, width:].any()
+        assert np.array_equal(new[3], old[3][:, :width]) and not old[3][:, width:].any()
+        for a, b in zip(new[:2] + new[4:6], old[:2] + old[4:6]):
+            assert np.array_equal(np.asarray(a), np.asarray(b))
+    print('The vectorized batches are identical to the legacy ones (%d -> %d columns, padded to %d instead of %d).'
+          % (legacy_data.num_features, data.num_features, data.max_nonzero_len, legacy_data.max_nonzero_len))
+
+    legacy_time, num_batches = time_epoch(legacy_batches(legacy_data, BATCH_SIZE))
+    vectorized_time, _ = time_epoch(data.make_sparse_batch(BATCH_SIZE, only_freq=False, shuffle=False))
+    shuffled_time, _ = time_epoch(data.make_sparse_batch(BATCH_SIZE, only_freq=False))
+    print('%d batches of %d (up to %d nonzeros per row)' % (num_batches, BATCH_SIZE, NNZ_PER_ROW))
+    print('legacy:     %.2fs (%.1f ms/batch)' % (legacy_time, legacy_time / num_batches * 1000))
+    print('vectorized: %.2fs (%.1f ms/batch)' % (vectorized_time, vectorized_time / num_batches * 1000))
+    print('vectorized, shuffled: %.2fs (%.1f ms/batch)' % (shuffled_time, shuffled_time / num_batches * 1000))
+    print('speedup: %.1fx' % (legacy_time / vectorized_time))
+
+    ''' the padded cells are what the embedding lookups and the FM interactions run over '''
+    bucketed_time, _ = time_epoch(data.make_sparse_batch(BATCH_SIZE, only_freq=False, num_buckets=NUM_LENGTH_BUCKETS))
+    num_cells = sum(f_ind.size for _, _, f_ind, _, _, _, _ in data.make_sparse_batch(BATCH_SIZE, only_freq=False,
+                                                                                      num_buckets=NUM_LENGTH_BUCKETS))
+    print('%d length buckets: %.2fs (%.1f ms/batch), %.1f%% of the padded cells of max_nonzero_len batches'
+          % (NUM_LENGTH_BUCKETS, bucketed_time, bucketed_time / num_batches * 1000,
+             num_cells / (data.num_instances * data.max_nonzero_len) * 100))
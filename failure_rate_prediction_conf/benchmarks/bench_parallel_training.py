@@ -0,0 +1,45 @@
+"""
+Training throughput of ParametricSurvival.run_graph with 1 to 32 Hogwild worker threads (NUM_WORKERS), one epoch on
+synthetic data shaped like TRAIN_SET.p, and the speedup over a single worker.
+The intra/inter-op thread pools are set through INTRA_OP_THREADS and INTER_OP_THREADS of ParametricSurvivalModels;
+the optimizer is OPTIMIZER, one whose updates are sparse as the Hogwild threads need.
+"""
+import os, tempfile
+import numpy as np
+from failure_rate_prediction_conf import Distributions, ParametricSurvivalModels
+from failure_rate_prediction_conf.ParametricSurvivalModels import ParametricSurvival
+from failure_rate_prediction_conf.SyntheticData import random_survival_data
+
+NUM_INSTANCES, NUM_EVAL_INSTANCES, NUM_FEATURES, NUM_HB_KEYS = 200000, 10000, 100000, 6
+NNZ_PER_ROW = 94
+BATCH_SIZE = 2048
+K = 20
+WORKER_COUNTS = (1, 2, 4, 8, 16, 32)
+OPTIMIZER = 'lazy_adam'
+
+
+def make_data(rs, num_instances):
+    return random_survival_data(rs, num_instances, NUM_FEATURES, NNZ_PER_ROW, NUM_HB_KEYS)
+
+
+if __name__ == "__main__":
+    rs = np.random.RandomState(0)
+    train_data, val_data, test_data = make_data(rs, NUM_INSTANCES), make_data(rs, NUM_EVAL_INSTANCES), \
+                                      make_data(rs, NUM_EVAL_INSTANCES)
+    os.chdir(tempfile.mkdtemp())  # run_graph writes its predictions and parameters under output/
+    os.makedirs('output')
+    ParametricSurvivalModels.OPTIMIZER = OPTIMIZER
+
+    throughputs = {}
+    for num_workers in WORKER_COUNTS:
+        model = ParametricSurvival(distribution=Distributions.WeibullDistribution(), batch_size=BATCH_SIZE,
+                                   num_epochs=1, k=K)
+        throughputs[num_workers] = model.run_graph(train_data.num_features, train_data, val_data, test_data,
+                                                   num_workers=num_workers)[0]
+
+    print('\n%d instances, k=%d, batches of %d, optimizer %s (intra-op threads: %d, inter-op threads: %d; 0 = all cores)'
+          % (NUM_INSTANCES, K, BATCH_SIZE, OPTIMIZER, ParametricSurvivalModels.INTRA_OP_THREADS,
+             ParametricSurvivalModels.INTER_OP_THREADS))
+    print('%8s %14s %8s' % ('workers', 'instances/s', 'speedup'))
+    for num_workers, throughput in throughputs.items():
+        print('%8d %14.0f %7.2fx' % (num_workers, throughput, throughput / throughputs[1]))
@@ -14,6 +14,9 @@ HEADER_BIDDING_KEYS = ('mnetbidprice',
                         # 'fb_bid_price_cents'
                        )
 
+_amzbid_mapping = None  # loaded once per process, shared by all entries
+
+
 class ImpressionEntry:
     def __init__(self, doc):
         self.doc = doc
@@ -81,12 +84,15 @@ class ImpressionEntry:
         return string.lower()
 
     def load_amznbid_price_mapping(self):
-        self.amzbid_mapping = {}
-        with open(AMZBID_MAPPING_PATH) as infile:
-            csv_reader = csv.reader(infile, delimiter=',')
-            next(csv_reader)
-            for line in csv_reader:
-                self.amzbid_mapping[line[-1]] = float(line[-2].replace('$', '').strip())
+        global _amzbid_mapping
+        if _amzbid_mapping is None:
+            _amzbid_mapping = {}
+            with open(AMZBID_MAPPING_PATH) as infile:
+                csv_reader = csv.reader(infile, delimiter=',')
+                next(csv_reader)
+                for line in csv_reader:
+                    _amzbid_mapping[line[-1]] = float(line[-2].replace('$', '').strip())
+        self.amzbid_mapping = _amzbid_mapping
 
     def has_headerbidding(self):
         ct = self.doc['CustomTargeting']
@@ -118,20 +124,25 @@ class ImpressionEntry:
         return sparse_rep
 
     def to_sparse_feature_vector(self, attr2idx):
-        vector = []
-        for attr, feats in self.entry.items():
-            if type(feats) == list:
-                for f in feats:
-                    ''' if the feature is unseen or rare in the training data, skip (leave it to the intercept) '''
-                    if f not in attr2idx[attr]:
-                        continue
-                    vector.append(':'.join(map(str, [attr2idx[attr][f], 1.0 / len(feats)])))
-            elif type(feats) == str:
-                if feats not in attr2idx[attr]:
+        return entry_to_sparse_feature_vector(self.entry, attr2idx)
+
+
+def entry_to_sparse_feature_vector(entry, attr2idx):
+    ''' also used on the entries stored in the data partitions, which no longer have their doc '''
+    vector = []
+    for attr, feats in entry.items():
+        if type(feats) == list:
+            for f in feats:
+                ''' if the feature is unseen or rare in the training data, skip (leave it to the intercept) '''
+                if f not in attr2idx[attr]:
                     continue
-                vector.append(':'.join(map(str, [attr2idx[attr][feats], 1])))
-            else:
-                ''' if the feature is float for example '''
-                vector.append(':'.join(map(str, [attr2idx[attr][attr], feats])))
+                vector.append(':'.join(map(str, [attr2idx[attr][f], 1.0 / len(feats)])))
+        elif type(feats) == str:
+            if feats not in attr2idx[attr]:
+                continue
+            vector.append(':'.join(map(str, [attr2idx[attr][feats], 1])))
+        else:
+            ''' if the feature is float for example '''
+            vector.append(':'.join(map(str, [attr2idx[attr][attr], feats])))
 
-        return vector
+    return vector
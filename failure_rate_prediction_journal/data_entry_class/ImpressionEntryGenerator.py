@@ -11,13 +11,15 @@ FEATURE_FIELDS = ['URIs_pageno', 'NaturalIDs', 'RefererURL', 'UserId',
                   'Time',
                   'RequestLanguage', 'Country', 'Region', 'Metro', 'City',
                   'RequestedAdUnitSizes', 'AdPosition',
-                  'CustomTargeting', ]
+                  'CustomTargeting', 'ImpressionId']
+
+DBNAME = 'Header_Bidding'
+COLLECTIONS = [('NetworkBackfillImpressions', NetworkBackfillImpressionEntry),
+               ('NetworkImpressions', NetworkImpressionEntry)]
 
 def imp_entry_gen():
 
-    DBNAME = 'Header_Bidding'
-    for COLNAME, ImpressionEntry in [('NetworkBackfillImpressions', NetworkBackfillImpressionEntry),
-                                     ('NetworkImpressions', NetworkImpressionEntry)]:
+    for COLNAME, ImpressionEntry in COLLECTIONS:
         col = client[DBNAME][COLNAME]
         total_entries = col.find().count()
         n = 0
@@ -34,3 +36,26 @@ def imp_entry_gen():
 
             yield imp_entry
 
+
+
+def doc_chunk_gen(chunk_size):
+    '''
+    Raw documents in chunks, so that building and filtering the entries can be done by worker processes.
+    :return: (ImpressionEntry class, [doc, ...])
+    '''
+    for COLNAME, ImpressionEntry in COLLECTIONS:
+        col = client[DBNAME][COLNAME]
+        total_entries = col.find().count()
+        n = 0
+        chunk = []
+        for doc in col.find(projection=FEATURE_FIELDS, no_cursor_timeout=True):
+            if n % 100000 == 0:
+                print('%d/%d (%.2f%%)' % (n, total_entries, n/total_entries*100))
+            n += 1
+
+            chunk.append(doc)
+            if len(chunk) == chunk_size:
+                yield ImpressionEntry, chunk
+                chunk = []
+        if chunk:
+            yield ImpressionEntry, chunk
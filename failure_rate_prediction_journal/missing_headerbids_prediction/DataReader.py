@@ -1,63 +1,126 @@
-import os
+import os, copy, hashlib
 import numpy as np
 from scipy import sparse
-from keras.preprocessing.sequence import pad_sequences
-from collections import Counter
-from sklearn.utils import shuffle
-from failure_rate_prediction_conf.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS
+from failure_rate_prediction_journal.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS
+# the agents of the all_agents one-hot columns: the last one (fb_bid_price_cents, not in the journal) is the dummy
+from failure_rate_prediction_conf.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS as AGENT_ONEHOT_KEYS
+from util.day_index import DayIndex
+from util.sparse_batch import pad_csr_rows, batch_rows, bucket_batch_rows
+from util.shards import BUFFER_SHARDS, load_shard_meta, read_shard, iter_shard_buffers
+from util.sparse_vector_reader import read_sparse_vectors
+from util.shared_arrays import SharedArrays
 
 
 HB_OUTLIER_THLD = 5.0
+''' the file prefix of the vectors with every impression once and the bids of all the agents (Vectorizer) '''
+MULTITASK_NAME = 'multitask'
+ATTACH_SHARED = True  # load_hb_data attaches the data set when DataServer hosts it, instead of loading a copy
 
 class HeaderBiddingData:
 
     def __init__(self):
-        self.headerbids = []
+        self.headerbids = np.empty(0)  # or (rows, agents), the bids of all the agents of load_hb_data_multitask
         self.sparse_features = None
         self.max_nonzero_len = 0
+        self.blocks = []  # (headerbids, sparse_features) added since the last build()
+        self.window_rows = None  # the rows of window(), the only ones batched
 
     def num_instances(self):
-        return self.sparse_features.shape[0]
+        self.build()
+        return self.sparse_features.shape[0] if self.window_rows is None else len(self.window_rows)
 
     def num_features(self):
+        self.build()
         return self.sparse_features.shape[1]
 
     def add_data(self, headerbids : np.array,
                  sparse_features : sparse.csr.csr_matrix):
-        self.headerbids.extend(headerbids)
-
-        if self.sparse_features is None:
-            self.sparse_features = sparse_features
-        else:
-            self.sparse_features = sparse.vstack(
-                (self.sparse_features,
-                 sparse_features)
-            )
-
-        assert self.sparse_features.shape[0] == len(self.headerbids)
-
-        self.max_nonzero_len = max(self.max_nonzero_len,
-                                   Counter(self.sparse_features.nonzero()[0]).most_common(1)[0][1]
-                                   )
-
-    def make_sparse_batch(self, batch_size=10000):
-        self.headerbids, self.sparse_features = shuffle(self.headerbids, self.sparse_features)
-
-        start_index = 0
-        while start_index < self.num_instances():
-            batch_feat_mat = self.sparse_features[start_index: start_index + batch_size, :]
-            # print(batch_feat_mat)
-            # padding
-            feat_indices_batch = np.split(batch_feat_mat.indices, batch_feat_mat.indptr)[1:-1]
-            feat_values_batch = np.split(batch_feat_mat.data, batch_feat_mat.indptr)[1:-1]
-            feat_indices_batch = pad_sequences(feat_indices_batch, maxlen=self.max_nonzero_len,
-                                               padding='post', value=0)
-            feat_values_batch = pad_sequences(feat_values_batch, maxlen=self.max_nonzero_len,
-                                              padding='post', value=0.0, dtype='float32')
-            yield self.headerbids[start_index: start_index + batch_size], \
-                  feat_indices_batch, \
-                  feat_values_batch
-            start_index += batch_size
+        ''' the block is only kept; all the blocks are stacked at once by build() '''
+        sparse_features = sparse_features.tocsr()
+        assert sparse_features.shape[0] == len(headerbids)
+        self.blocks.append((np.asarray(headerbids, dtype=np.float64), sparse_features))
+
+        if sparse_features.shape[0]:
+            self.max_nonzero_len = max(self.max_nonzero_len, int(np.diff(sparse_features.indptr).max()))
+
+    def build(self):
+        ''' stack the added blocks into one CSR matrix, allocating each array once '''
+        if not self.blocks:
+            return
+        blocks = ([(self.headerbids, self.sparse_features)] if self.sparse_features is not None else []) + self.blocks
+        mats = [mat for _, mat in blocks]
+        assert len(set(mat.shape[1] for mat in mats)) == 1
+
+        indptr = np.concatenate(([0], np.cumsum(np.concatenate([np.diff(mat.indptr) for mat in mats]))))
+        self.sparse_features = sparse.csr_matrix((np.concatenate([mat.data for mat in mats]),
+                                                  np.concatenate([mat.indices for mat in mats]),
+                                                  indptr),
+                                                 shape=(len(indptr) - 1, mats[0].shape[1]))
+        self.headerbids = np.concatenate([headerbids for headerbids, _ in blocks])
+        self.blocks = []
+
+    def window(self, rows):
+        '''
+        The built data restricted to rows (e.g. a time window of load_day_index), sharing its arrays: the rows are
+        only the selection of the batches, which gather them batch by batch.
+        '''
+        self.build()
+        data = copy.copy(self)
+        data.blocks = []
+        data.window_rows = np.asarray(rows)
+        return data
+
+    def make_sparse_batch(self, batch_size=10000, shuffle=True, num_buckets=None):
+        ''' gather_batch of each batch of batch_plan '''
+        for rows, max_len in self.batch_plan(batch_size, shuffle, num_buckets):
+            yield self.gather_batch(rows, max_len)
+
+    def batch_plan(self, batch_size=10000, shuffle=True, num_buckets=None, rs=None):
+        '''
+        The rows of the batches of make_sparse_batch, without gathering them
+        :param shuffle: False for evaluation passes, which take the rows in order
+        :param num_buckets: if given, the rows are batched by length buckets and each batch is padded only to the
+                            longest row of its bucket instead of max_nonzero_len
+        :param rs: the np.random.RandomState of the shuffling, the global one by default
+        :return: (rows, padded length) for each batch
+        '''
+        self.build()
+        if num_buckets:
+            return bucket_batch_rows(np.diff(self.sparse_features.indptr), batch_size, num_buckets, shuffle,
+                                     self.window_rows, rs)
+        return ((rows, self.max_nonzero_len) for rows in batch_rows(self.sparse_features.shape[0], batch_size,
+                                                                    shuffle, self.window_rows, rs))
+
+    def gather_batch(self, rows, max_len):
+        batch_feat_mat = self.sparse_features[rows]
+        # padding
+        feat_indices_batch, feat_values_batch = pad_csr_rows(batch_feat_mat, max_len)
+        return self.headerbids[rows], \
+               feat_indices_batch, \
+               feat_values_batch
+
+    def share(self, name):
+        ''' :return: the SharedArrays of the built data, for attach(name) in the other processes '''
+        self.build()
+        mat = self.sparse_features
+        return SharedArrays.publish(name, {'headerbids': self.headerbids, 'features_data': mat.data,
+                                           'features_indices': mat.indices, 'features_indptr': mat.indptr},
+                                    {'shape': mat.shape, 'max_nonzero_len': self.max_nonzero_len})
+
+    @classmethod
+    def attach(cls, name):
+        '''
+        A HeaderBiddingData on the arrays shared by share(name), zero-copy.
+        :raise FileNotFoundError: if nothing is shared under name
+        '''
+        shared = SharedArrays.attach(name)
+        data = cls()
+        data.headerbids = shared.arrays['headerbids']
+        data.sparse_features = sparse.csr_matrix((shared.arrays['features_data'], shared.arrays['features_indices'],
+                                                  shared.arrays['features_indptr']), shape=shared.meta['shape'])
+        data.max_nonzero_len = shared.meta['max_nonzero_len']
+        data.shared = shared
+        return data
 
 
 def _load_sparsefeatures_file(dir_path, hb_agent_name, data_type):
@@ -76,9 +139,38 @@ def _load_headerbids_file(dir_path, hb_agent_name, data_type):
         )
     )
 
-def _filter_outliers(headerbids, sparse_features):
+def _load_multitask_headerbids_file(dir_path, data_type):
+    ''' the bids of all the agents, a column each of HEADER_BIDDING_KEYS (0: not observed) '''
+    _, headerbids, _, _, _ = read_sparse_vectors(os.path.join(dir_path, '%s_headerbids_%s.csv' % (MULTITASK_NAME, data_type)),
+                                                 num_scalars=len(HEADER_BIDDING_KEYS), has_header=False)
+    return headerbids
+
+def load_day_index(dir_path, hb_agent_name, data_type='all'):
+    '''
+    DayIndex over the rows returned by load_hb_data_one_agent/load_hb_data_all_agents, or load_hb_data_multitask with
+    MULTITASK_NAME (outliers filtered)
+    '''
+    days = np.load(os.path.join(dir_path, '%s_days_%s.npy' % (hb_agent_name, data_type)))
+    if hb_agent_name == MULTITASK_NAME:
+        headerbids = _load_multitask_headerbids_file(dir_path, data_type)
+    else:
+        headerbids = _load_headerbids_file(dir_path, hb_agent_name, data_type)
+    _, mask = _outlier_mask(headerbids)
+    return DayIndex(days[mask])
+
+def _outlier_mask(headerbids):
+    '''
+    The bids with the outliers of all the agents (one column each, 0: not observed) only set as not observed, and the
+    mask of the rows kept: any bid left, or a single bid below HB_OUTLIER_THLD
+    '''
     headerbids = np.array(headerbids)
-    mask = headerbids < HB_OUTLIER_THLD
+    if headerbids.ndim == 2:
+        headerbids = np.where(headerbids < HB_OUTLIER_THLD, headerbids, 0.0)
+        return headerbids, (headerbids > 0).any(axis=1)
+    return headerbids, headerbids < HB_OUTLIER_THLD
+
+def _filter_outliers(headerbids, sparse_features):
+    headerbids, mask = _outlier_mask(headerbids)
     headerbids = headerbids[mask]
     sparse_features = sparse_features[mask, :]
     return headerbids, sparse_features
@@ -98,22 +190,137 @@ def load_hb_data_one_agent(dir_path, hb_agent_name, data_type):
                                                                         sparse_features.shape[1]))
     return headerbids, sparse_features
 
+def _prepend_agent_onehot(mat, agent_col, num_agent_cols):
+    ''' the num_agent_cols one-hot columns of the agent in front of the features, written as sparse entries '''
+    indices = mat.indices + num_agent_cols
+    shape = (mat.shape[0], mat.shape[1] + num_agent_cols)
+    if agent_col >= num_agent_cols:  # the dummy agent
+        return sparse.csr_matrix((mat.data, indices, mat.indptr), shape=shape)
+
+    row_starts = mat.indptr[:-1]
+    return sparse.csr_matrix((np.insert(mat.data, row_starts, 1.0),
+                              np.insert(indices, row_starts, agent_col),
+                              mat.indptr + np.arange(mat.shape[0] + 1)),
+                             shape=shape)
+
 def load_hb_data_all_agents(dir_path, hb_agent_name, data_type):
     headerbids, sparse_features = load_hb_data_one_agent(dir_path, hb_agent_name, data_type)
 
     # add hb_agent as one additional feature
-    hb_agent_onehot = [float(hb_agent_name == agent) for agent in HEADER_BIDDING_KEYS]
-    hb_agent_onehot = hb_agent_onehot[:-1]  # skip the last one for dummy variable
-    sparse_features = sparse.hstack(
-        (np.array([hb_agent_onehot] * sparse_features.shape[0]),
-         sparse_features)
-    )
+    sparse_features = _prepend_agent_onehot(sparse_features.tocsr(), AGENT_ONEHOT_KEYS.index(hb_agent_name),
+                                            len(AGENT_ONEHOT_KEYS) - 1)  # skip the last one for dummy variable
     print("\tAFTER ADDING AGENT: %d *%s* instances and %d features" % (sparse_features.shape[0],
                                                                       data_type,
                                                                       sparse_features.shape[1]))
 
     return headerbids, sparse_features
 
+def load_hb_data_multitask(dir_path, data_type):
+    '''
+    Every impression once, with the header bids of all the agents in the columns of HEADER_BIDDING_KEYS (0: not
+    observed), for the multi-task model; the rows whose bids are all outliers are dropped.
+    '''
+    sparse_features = _load_sparsefeatures_file(dir_path, MULTITASK_NAME, data_type)
+    headerbids = _load_multitask_headerbids_file(dir_path, data_type)
+
+    assert sparse_features.shape[0] == len(headerbids)
+
+    print("\tORIGINAL: %d *%s* impressions, %d bids and %d features" % (sparse_features.shape[0],
+                                                                       data_type,
+                                                                       np.count_nonzero(headerbids),
+                                                                       sparse_features.shape[1]))
+    headerbids, sparse_features = _filter_outliers(headerbids, sparse_features)
+    print("\tAFTER FILTERING OUTLIERS: %d *%s* impressions, %d bids and %d features" % (sparse_features.shape[0],
+                                                                                       data_type,
+                                                                                       np.count_nonzero(headerbids),
+                                                                                       sparse_features.shape[1]))
+    return headerbids, sparse_features
+
+
+def shared_name(dir_path, hb_agent_name, data_type):
+    ''' the shared memory name of the data set of load_hb_data '''
+    key = '%s_%s_%s' % (os.path.abspath(dir_path), hb_agent_name, data_type)
+    return 'hb_%s' % hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def load_hb_data(dir_path, hb_agent_name, data_type):
+    '''
+    HeaderBiddingData of an agent (load_hb_data_one_agent), or of all the agents with MULTITASK_NAME
+    (load_hb_data_multitask). With ATTACH_SHARED, the data set hosted in shared memory by DataServer is attached
+    instead, if any.
+    '''
+    if ATTACH_SHARED:
+        try:
+            data = HeaderBiddingData.attach(shared_name(dir_path, hb_agent_name, data_type))
+            print("\tAttached the *%s* data of %s shared by DataServer" % (data_type, hb_agent_name))
+            return data
+        except FileNotFoundError:
+            pass
+
+    data = HeaderBiddingData()
+    if hb_agent_name == MULTITASK_NAME:
+        data.add_data(*load_hb_data_multitask(dir_path, data_type))
+    else:
+        data.add_data(*load_hb_data_one_agent(dir_path, hb_agent_name, data_type))
+    return data
+
+
+class ShardedHeaderBiddingData:
+    '''
+    The shards written by Vectorizer.featstr_to_shards, for data sets that do not fit in memory: make_sparse_batch
+    loads buffer_shards shards at a time (in a random order when shuffling) and batches each buffer as a
+    HeaderBiddingData, so the memory held is bounded by the buffer instead of the data set.
+    '''
+    def __init__(self, dir_path, hb_agent_names, data_type, all_agents=False, buffer_shards=BUFFER_SHARDS):
+        '''
+        :param hb_agent_names: the agents whose shards are read, or [MULTITASK_NAME] for the multi-task shards
+        :param all_agents: prepend the one-hot agent columns, as load_hb_data_all_agents
+        '''
+        self.all_agents = all_agents
+        self.buffer_shards = buffer_shards
+        self.shard_agents = {}  # shard path -> agent name
+        self.num_rows, num_features = 0, set()
+        for hb_agent_name in hb_agent_names:
+            shard_paths, meta = load_shard_meta(os.path.join(dir_path, '%s_shards_%s' % (hb_agent_name, data_type)))
+            self.shard_agents.update((shard_path, hb_agent_name) for shard_path in shard_paths)
+            self.num_rows += sum(meta['num_rows'])
+            num_features.add(meta['num_features'])
+        assert len(num_features) == 1
+        self._num_features = num_features.pop() + (len(AGENT_ONEHOT_KEYS) - 1 if all_agents else 0)
+
+    def num_instances(self):
+        ''' counted before filtering the outliers, which happens as the shards are read '''
+        return self.num_rows
+
+    def num_features(self):
+        return self._num_features
+
+    def _read_shard(self, shard_path):
+        shard = read_shard(shard_path)
+        headerbids, sparse_features = _filter_outliers(shard['headerbids'], shard['sparse_features'])
+        if self.all_agents:
+            sparse_features = _prepend_agent_onehot(sparse_features,
+                                                    AGENT_ONEHOT_KEYS.index(self.shard_agents[shard_path]),
+                                                    len(AGENT_ONEHOT_KEYS) - 1)
+        return {'headerbids': headerbids, 'sparse_features': sparse_features}
+
+    def make_sparse_batch(self, batch_size=10000, shuffle=True, num_buckets=None):
+        ''' the batches of HeaderBiddingData.make_sparse_batch; padded to the longest row of their buffer '''
+        for data, rows, max_len in self.batch_plan(batch_size, shuffle, num_buckets):
+            yield data.gather_batch(rows, max_len)
+
+    def batch_plan(self, batch_size=10000, shuffle=True, num_buckets=None, rs=None):
+        ''' (buffer, rows, padded length) of each batch; a buffer is read when the plan reaches it '''
+        for buffer in iter_shard_buffers(sorted(self.shard_agents), self.buffer_shards, shuffle, read=self._read_shard,
+                                         rs=rs):
+            data = HeaderBiddingData()
+            data.add_data(buffer['headerbids'], buffer['sparse_features'])
+            for rows, max_len in data.batch_plan(batch_size, shuffle, num_buckets, rs):
+                yield data, rows, max_len
+
+    @staticmethod
+    def gather_batch(data, rows, max_len):
+        return data.gather_batch(rows, max_len)
+
 
 
 if __name__ == "__main__":
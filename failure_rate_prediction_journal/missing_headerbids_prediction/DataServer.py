@@ -0,0 +1,28 @@
+"""
+Hosts the train, val and test vectors of every agent (and with MULTITASK, of the multi-task model) in shared memory,
+so the processes training on them concurrently (the HeaderBidsPredictionModels, Sweep) attach one copy instead of
+each loading its own:
+    python -m failure_rate_prediction_journal.missing_headerbids_prediction.DataServer
+load_hb_data attaches a hosted data set by itself, keyed by the absolute vectors directory, the agent and the data
+type. The shared memory is freed once the server is stopped (Ctrl-C) and the processes attached have exited.
+"""
+from failure_rate_prediction_journal.missing_headerbids_prediction import DataReader
+from failure_rate_prediction_journal.missing_headerbids_prediction.DataReader import load_hb_data, shared_name, \
+    MULTITASK_NAME
+from failure_rate_prediction_journal.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS
+from util.shared_arrays import serve
+
+VECTORS_DIR = '../output/vectorization'  # the VECTORS_DIR of the models
+MULTITASK = True  # also host the vectors of the multi-task model (Vectorizer.MULTITASK_VECTORS)
+
+
+if __name__ == "__main__":
+    DataReader.ATTACH_SHARED = False  # load the data sets to host, not a copy hosted already
+    shared = []
+    for hb_agent_name in list(HEADER_BIDDING_KEYS) + ([MULTITASK_NAME] if MULTITASK else []):
+        print("HB AGENT %s:" % hb_agent_name)
+        for data_type in ('train', 'val', 'test'):
+            data = load_hb_data(VECTORS_DIR, hb_agent_name, data_type)
+            shared.append(data.share(shared_name(VECTORS_DIR, hb_agent_name, data_type)))
+            del data
+    serve(shared)
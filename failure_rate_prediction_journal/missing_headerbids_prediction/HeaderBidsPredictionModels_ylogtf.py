@@ -1,22 +1,50 @@
 import os
+import itertools
 import numpy as np
 import pandas as pd
 
 import tensorflow as tf
 from time import time as nowtime
 from sklearn.metrics import mean_squared_error
-from failure_rate_prediction_journal.missing_headerbids_prediction.DataReader import HeaderBiddingData, load_hb_data_all_agents, load_hb_data_one_agent
+from util.tf_input import BatchInput
+from util.distributed import Cluster
+from util.sparse_updates import make_optimizer, clip_sparse_gradients
+from util.embedding_precision import embedding_table, embedding_lookup, adam_epsilon, print_embedding_memory
+from failure_rate_prediction_journal.missing_headerbids_prediction.DataReader import HeaderBiddingData, ShardedHeaderBiddingData, load_hb_data_all_agents, load_hb_data, \
+    MULTITASK_NAME
 from failure_rate_prediction_journal.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS
 
-MODE = 'one_agent'
+MODE = 'one_agent'  # 'all_agents': one model over the rows of every agent; 'multi_task': one head per agent
 INPUT_DIR = '../output'
 VECTORS_DIR = os.path.join(INPUT_DIR, 'vectorization')
+NUM_LENGTH_BUCKETS = None  # e.g. 4: batches padded to the longest row of their length bucket
+TRAIN_FROM_SHARDS = False  # stream the training set from the shards of Vectorizer.featstr_to_shards
+OPTIMIZER = 'adam'  # or 'lazy_adam' / 'adagrad': update only the embedding rows of each batch, clipped row by row
+INTRA_OP_THREADS = INTER_OP_THREADS = 0  # the thread pools of the session (tf.ConfigProto); 0: as many as the cores
+EMBEDDING_DTYPE = 'float32'  # or 'bfloat16' / 'float16': the embedding tables and their optimizer slots in half the memory
 OUTPUT_PKL_NAME = """prediction_result_ylogtf_%s.pkl"""
 
+
+def observed_bids(hb_pred, hb_true):
+    '''
+    :return: the predicted and true bids that were observed, flattened, and their agents; with a single task every
+             bid is observed and the agents are None
+    '''
+    if hb_true.ndim == 1:
+        return hb_pred, hb_true, None
+    rows, agent_cols = np.nonzero(hb_true > 0)
+    return hb_pred[rows, agent_cols], hb_true[rows, agent_cols], np.array(HEADER_BIDDING_KEYS)[agent_cols]
+
+
 class HBPredictionModel:
 
     def __init__(self, batch_size, num_epochs, k, distribution=None, learning_rate=0.001,
-                 lambda_linear=0.0, lambda_factorized=0.0, hb_agent=''):
+                 lambda_linear=0.0, lambda_factorized=0.0, hb_agent='', multi_task=False):
+        '''
+        :param multi_task: one head per agent of HEADER_BIDDING_KEYS over the data of load_hb_data_multitask: each
+                           agent has its column of embeddings_linear, its intercept and its weights of the k
+                           interactions of the shared embeddings_factorized; the loss only counts the observed bids
+        '''
         self.distribution = distribution
         self.batch_size = batch_size
         self.num_epochs = num_epochs
@@ -25,88 +53,137 @@ class HBPredictionModel:
         self.lambda_linear = lambda_linear
         self.lambda_factorized = lambda_factorized
         self.hb_agent_name = hb_agent
+        self.multi_task = multi_task
 
     def linear_function(self, weights_linear, intercept):
-        return tf.reduce_sum(weights_linear, axis=-1) + intercept
+        ''' :param weights_linear: (batch_size, max_nonzero_len), or (batch_size, max_nonzero_len, num_agents) '''
+        return tf.reduce_sum(weights_linear, axis=1) + intercept
 
     def factorization_machines(self, weights_factorized):
-        dot_product_res = tf.matmul(weights_factorized, tf.transpose(weights_factorized, perm=[0,2,1]))
-        element_product_res = weights_factorized * weights_factorized
-        pairs_mulsum = tf.reduce_sum(tf.multiply(0.5, tf.reduce_sum(dot_product_res, axis=2)
-                                        - tf.reduce_sum(element_product_res, axis=2)),
-                            axis=-1)
-        return pairs_mulsum
+        '''
+        sum_{i<j} <v_i, v_j> = 0.5 * sum_f ((sum_i v_if)^2 - sum_i v_if^2), in O(max_nonzero_len * k) per row
+        instead of the (max_nonzero_len x max_nonzero_len) matrix of all the dot products.
+        :param weights_factorized: (batch_size, max_nonzero_len, k), the embeddings times the feature values, so the
+                                   padded entries (value 0) are zero vectors and add nothing
+        '''
+        return tf.reduce_sum(self.factorized_interactions(weights_factorized), axis=-1)
+
+    def factorized_interactions(self, weights_factorized):
+        ''' the k terms 0.5 * ((sum_i v_if)^2 - sum_i v_if^2) summed by factorization_machines, (batch_size, k) '''
+        sum_squared = tf.square(tf.reduce_sum(weights_factorized, axis=1))
+        squared_sum = tf.reduce_sum(tf.square(weights_factorized), axis=1)
+        return tf.multiply(0.5, sum_squared - squared_sum)
 
 
-    def run_graph(self, train_data, val_data, test_data, early_stop=False, bad_epoch_tol=0, verbose=True):
+    def run_graph(self, train_data, val_data, test_data, early_stop=False, bad_epoch_tol=0, verbose=True, cluster=None,
+                  stop_early=None):
         '''
 
         :param distribution:
         :param num_features:
         :param k: the dimensionality of the embedding, Must be >= 0; when k=0, it is a simple model; Otherwise it is factorized
-        :return:
+        :param cluster: the util.distributed.Cluster of this worker, to train on parameter servers
+        :param stop_early: called as stop_early(epoch, validation MSE) after every evaluation, True stops the training
+                           (e.g. util.sweep.SuccessiveHalving)
+        :return: the validation MSE of every epoch evaluated is left in self.val_history
         '''
         tf.reset_default_graph()
+        self.val_history = []
 
         num_features = train_data.num_features()
 
-        # INPUTs
-        feature_indice = tf.placeholder(tf.int32, name='feature_indice')
-        feature_values = tf.placeholder(tf.float32, name='feature_values')
-        header_bids_true = tf.placeholder(tf.float32, name='header_bids')
-
-        # shape: (batch_size, max_nonzero_len)
-        embeddings_linear = tf.Variable(tf.truncated_normal(shape=(num_features,), mean=0.0, stddev=1e-5))
-        filtered_embeddings_linear = tf.nn.embedding_lookup(embeddings_linear, feature_indice) * feature_values
-        intercept = tf.Variable(1e-5)
-        scale = self.linear_function(filtered_embeddings_linear, intercept)
-
-        embeddings_factorized = None
-        filtered_embeddings_factorized = None
-        if self.k > 0:
-            # shape: (batch_size, max_nonzero_len, k)
-            embeddings_factorized = tf.Variable(tf.truncated_normal(shape=(num_features, self.k), mean=0.0, stddev=1e-5))
-            filtered_embeddings_factorized = tf.nn.embedding_lookup(embeddings_factorized, feature_indice) * \
-                                      tf.tile(tf.expand_dims(feature_values, axis=-1), [1, 1, 1])
-            factorized_term = self.factorization_machines(filtered_embeddings_factorized)
-            scale += factorized_term
-
-
-        header_bids_pred = tf.exp(scale)
-
-
-        batch_loss = tf.losses.mean_squared_error(labels=header_bids_true,
-                                                      predictions=header_bids_pred,
-                                                      reduction = tf.losses.Reduction.MEAN)
-        running_loss, loss_update = tf.metrics.mean(batch_loss)
-
-
-        # L2 regularized sum of squares loss function over the embeddings
-        l2_norm = self.lambda_linear * tf.nn.l2_loss(filtered_embeddings_linear)
-        if embeddings_factorized is not None:
-            l2_norm += self.lambda_factorized * tf.nn.l2_loss(filtered_embeddings_factorized)
-
-        loss_mean = batch_loss +l2_norm
-
-        training_op = tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(loss_mean)
-
-        ### gradient clipping
-        # optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
-        # gradients, variables = zip(*optimizer.compute_gradients(loss_mean))
-        # gradients_clipped, _ = tf.clip_by_global_norm(gradients, 5.0)
-        # training_op = optimizer.apply_gradients(zip(gradients_clipped, variables))
-
-
-        # Isolate the variables stored behind the scenes by the metric operation
-        running_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES)
-        # Define initializer to initialize/reset running variables
-        running_vars_initializer = tf.variables_initializer(var_list=running_vars)
-
-        init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
-
-
-        with tf.Session() as sess:
-            init.run()
+        ''' with a cluster, the variables live on the ps tasks and the embedding tables are partitioned over them '''
+        device = cluster.device_setter() if cluster else None
+        local_device = cluster.worker_device if cluster else None
+        partitioner = cluster.partitioner() if cluster else None
+
+        with tf.device(device):
+            # INPUTs: the arrays of make_sparse_batch
+            ''' multi-task: the bids of all the agents, (batch_size, num_agents), with 0 where not observed '''
+            agents_shape = (len(HEADER_BIDDING_KEYS),) if self.multi_task else ()
+            batch_input = BatchInput((tf.float32, tf.int32, tf.float32),
+                                     ([None, *agents_shape], [None, None], [None, None]))
+            header_bids_true, feature_indice, feature_values = batch_input.next_batch
+            self.batch_input = batch_input  # also read by evaluate
+            observed = tf.cast(tf.greater(header_bids_true, 0.0), tf.float32) if self.multi_task else 1.0
+
+            # shape: (batch_size, max_nonzero_len), multi-task (batch_size, max_nonzero_len, num_agents)
+            embeddings_linear = embedding_table('embeddings_linear', (num_features, *agents_shape), EMBEDDING_DTYPE,
+                                                partitioner)
+            filtered_embeddings_linear = embedding_lookup(embeddings_linear, feature_indice) * \
+                                         (tf.expand_dims(feature_values, axis=-1) if self.multi_task else feature_values)
+            intercept = tf.Variable(np.full(agents_shape, 1e-5, dtype=np.float32))
+            scale = self.linear_function(filtered_embeddings_linear, intercept)
+
+            embeddings_factorized = None
+            filtered_embeddings_factorized = None
+            if self.k > 0:
+                # shape: (batch_size, max_nonzero_len, k)
+                embeddings_factorized = embedding_table('embeddings_factorized', (num_features, self.k),
+                                                        EMBEDDING_DTYPE, partitioner)
+                filtered_embeddings_factorized = embedding_lookup(embeddings_factorized, feature_indice) * \
+                                          tf.tile(tf.expand_dims(feature_values, axis=-1), [1, 1, 1])
+                if self.multi_task:  # each agent weighs the k shared interactions
+                    heads = tf.Variable(tf.ones((self.k, len(HEADER_BIDDING_KEYS))))
+                    factorized_term = tf.matmul(self.factorized_interactions(filtered_embeddings_factorized), heads)
+                else:
+                    factorized_term = self.factorization_machines(filtered_embeddings_factorized)
+                scale += factorized_term
+
+
+            header_bids_pred = tf.exp(scale)
+
+
+            batch_loss = tf.losses.mean_squared_error(labels=header_bids_true,
+                                                          predictions=header_bids_pred,
+                                                          weights=observed,
+                                                          reduction = tf.losses.Reduction.MEAN)
+            with tf.device(local_device):  # the running metrics of each worker are its own
+                running_loss, loss_update = tf.metrics.mean(batch_loss)
+
+
+            # L2 regularized sum of squares loss function over the embeddings
+            l2_norm = self.lambda_linear * tf.nn.l2_loss(filtered_embeddings_linear)
+            if embeddings_factorized is not None:
+                l2_norm += self.lambda_factorized * tf.nn.l2_loss(filtered_embeddings_factorized)
+
+            loss_mean = batch_loss +l2_norm
+
+            optimizer = make_optimizer(OPTIMIZER, self.learning_rate, epsilon=adam_epsilon(EMBEDDING_DTYPE))
+            if OPTIMIZER == 'adam':
+                training_op = optimizer.minimize(loss_mean)
+            else:
+                training_op = optimizer.apply_gradients(clip_sparse_gradients(optimizer.compute_gradients(loss_mean), 5.0))
+
+            ### gradient clipping
+            # optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+            # gradients, variables = zip(*optimizer.compute_gradients(loss_mean))
+            # gradients_clipped, _ = tf.clip_by_global_norm(gradients, 5.0)
+            # training_op = optimizer.apply_gradients(zip(gradients_clipped, variables))
+
+
+            # Isolate the variables stored behind the scenes by the metric operation
+            running_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES)
+            # Define initializer to initialize/reset running variables
+            running_vars_initializer = tf.variables_initializer(var_list=running_vars)
+
+            init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+            epochs = itertools.count()  # the workers of a cluster split the batches of each epoch
+            train_init = batch_input.data_initializer(
+                train_data, (lambda make_plan: cluster.worker_batches(make_plan, seed=next(epochs))) if cluster else None,
+                batch_size=self.batch_size, num_buckets=NUM_LENGTH_BUCKETS)
+            train_eval_init, val_init, test_init = [
+                batch_input.data_initializer(data, shuffle=False, num_buckets=NUM_LENGTH_BUCKETS)
+                for data in (train_data, val_data, test_data)]
+        print_embedding_memory(EMBEDDING_DTYPE)
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=INTRA_OP_THREADS,
+                                inter_op_parallelism_threads=INTER_OP_THREADS)
+        sess = cluster.session(init, tf.local_variables_initializer(), config) if cluster else tf.Session(config=config)
+        with sess:
+            if cluster is None:
+                init.run()
 
             max_loss_val = None
             current_bad_epochs = 0
@@ -116,20 +193,15 @@ class HBPredictionModel:
                 ''' model training '''
                 num_batch = 0
                 start = nowtime()
-                for hb_batch, featidx_batch, featval_batch in train_data.make_sparse_batch(self.batch_size):
+                batch_input.start(sess, train_init)
+                while True:
+                    try:
+                        _, loss_batch, hb_pred, hb_true = batch_input.run(sess, [training_op, loss_mean, header_bids_pred,
+                                                                                 header_bids_true])
+                    except tf.errors.OutOfRangeError:
+                        break
                     num_batch += 1
 
-                    # print(hb_batch)
-                    # print(featidx_batch)
-                    # print(featval_batch)
-
-                    _, loss_batch, hb_pred, hb_true = sess.run([training_op, loss_mean, header_bids_pred,
-                                                                header_bids_true],
-                                             feed_dict={
-                                             'feature_indice:0': featidx_batch,
-                                             'feature_values:0': featval_batch,
-                                             'header_bids:0': hb_batch})
-
                     # print(hb_true)
                     # print(hb_pred)
 
@@ -138,14 +210,17 @@ class HBPredictionModel:
                               (epoch, num_batch, num_total_batches, loss_batch))
                         print("\t\t\t\ttime: %.4fs" % (nowtime() - start))
                         start = nowtime()
+                batch_input.report("Epoch %d training batches" % epoch)
+                if cluster is not None and not cluster.is_chief:  # the chief evaluates the shared model
+                    continue
 
                 # evaluation on training data
-                eval_nodes_update = [loss_update, header_bids_pred]
+                eval_nodes_update = [loss_update, header_bids_pred, header_bids_true]
                 eval_nodes_metric = [running_loss]
                 print()
                 print("========== Evaluation at Epoch %d ==========" % epoch)
                 print('*** On Training Set:')
-                [loss_train], _, _ = self.evaluate(train_data.make_sparse_batch(),
+                [loss_train], _, _ = self.evaluate(train_eval_init,
                                                                  running_vars_initializer, sess,
                                                                  eval_nodes_update, eval_nodes_metric,
                                                                  )
@@ -153,11 +228,12 @@ class HBPredictionModel:
 
                 # evaluation on validation data
                 print('*** On Validation Set:')
-                [loss_val], hb_pred_val, hb_true_val = self.evaluate(val_data.make_sparse_batch(),
+                [loss_val], hb_pred_val, hb_true_val = self.evaluate(val_init,
                                                            running_vars_initializer, sess,
                                                            eval_nodes_update, eval_nodes_metric,
                                                            )
                 print("TENSORFLOW:\tMSE = %.6f" % loss_val)
+                self.val_history.append(loss_val)
 
 
                 if max_loss_val is None or loss_val < max_loss_val:
@@ -167,16 +243,19 @@ class HBPredictionModel:
 
                     # evaluation on test data
                     print('*** On Test Set:')
-                    [loss_test], hb_pred_test, hb_true_test = self.evaluate(test_data.make_sparse_batch(),
+                    [loss_test], hb_pred_test, hb_true_test = self.evaluate(test_init,
                                                                             running_vars_initializer, sess,
                                                                             eval_nodes_update, eval_nodes_metric,
                                                                             )
                     print("TENSORFLOW:\tMSE = %.6f" % loss_test)
 
+                    hb_pred_test, hb_true_test, agents_test = observed_bids(hb_pred_test, hb_true_test)
                     prediction_result = pd.DataFrame(
                         {'y_pred': hb_pred_test,
                          'y_true': hb_true_test
                          })
+                    if agents_test is not None:
+                        prediction_result['agent'] = agents_test
                     prediction_result.to_pickle(
                         os.path.join(INPUT_DIR, OUTPUT_PKL_NAME % self.hb_agent_name))
                 elif early_stop:
@@ -184,19 +263,25 @@ class HBPredictionModel:
                     if current_bad_epochs == bad_epoch_tol:
                         break
 
+                if stop_early is not None and stop_early(epoch, loss_val):
+                    print("Stopped at epoch %d" % epoch)
+                    break
+
 
 
-    def evaluate(self, next_batch, running_init, sess, updates, metrics):
+    def evaluate(self, batch_init, running_init, sess, updates, metrics):
+        ''' :param batch_init: the BatchInput initializer of the data set to evaluate '''
         all_hb_pred = []
         all_hb_true = []
-        sess.run(running_init)
-        for hb_batch, featidx_batch, featval_batch in next_batch:
-            _, hb_pred  = sess.run(updates, feed_dict={
-                                             'feature_indice:0': featidx_batch,
-                                             'feature_values:0': featval_batch,
-                                             'header_bids:0': hb_batch})
+        self.batch_input.start(sess, batch_init, running_init)
+        while True:
+            try:
+                _, hb_pred, hb_batch = self.batch_input.run(sess, updates)
+            except tf.errors.OutOfRangeError:
+                break
             all_hb_pred.extend(hb_pred)
             all_hb_true.extend(hb_batch)
+        self.batch_input.report("Evaluation batches")
 
         all_hb_pred = np.array(all_hb_pred, dtype=np.float32)
         all_hb_true = np.array(all_hb_true, dtype=np.float32)
@@ -204,21 +289,37 @@ class HBPredictionModel:
         # print(all_hb_pred)
         # print(all_hb_true)
 
-        print("SKLEARN:\tMSE = %.6f" % (mean_squared_error(all_hb_true, all_hb_pred)))
+        hb_pred_observed, hb_true_observed, agents = observed_bids(all_hb_pred, all_hb_true)
+        print("SKLEARN:\tMSE = %.6f" % (mean_squared_error(hb_true_observed, hb_pred_observed)))
+        if agents is not None:
+            for hb_agent_name in HEADER_BIDDING_KEYS:
+                if np.any(agents == hb_agent_name):
+                    print("\t%s:\tMSE = %.6f" % (hb_agent_name,
+                                                  mean_squared_error(hb_true_observed[agents == hb_agent_name],
+                                                                     hb_pred_observed[agents == hb_agent_name])))
         return sess.run(metrics), all_hb_pred, all_hb_true
 
 
 
 if __name__ == "__main__":
+    ''' set by util.distributed.launch_local for every process of a local cluster; a ps task only serves from here on '''
+    cluster = Cluster.from_env()
+    if cluster is not None:
+        assert MODE in ('all_agents', 'multi_task'), "the one_agent models are trained on one machine"
+        cluster.start()
+
     if MODE == 'all_agents':
         hb_data_train = HeaderBiddingData()
         hb_data_val = HeaderBiddingData()
         hb_data_test = HeaderBiddingData()
         for i, hb_agent_name in enumerate(HEADER_BIDDING_KEYS):
             print("HB AGENT (%d/%d) %s:" % (i + 1, len(HEADER_BIDDING_KEYS), hb_agent_name))
-            hb_data_train.add_data(*load_hb_data_all_agents(VECTORS_DIR, hb_agent_name, 'train'))
+            if not TRAIN_FROM_SHARDS:
+                hb_data_train.add_data(*load_hb_data_all_agents(VECTORS_DIR, hb_agent_name, 'train'))
             hb_data_val.add_data(*load_hb_data_all_agents(VECTORS_DIR, hb_agent_name, 'val'))
             hb_data_test.add_data(*load_hb_data_all_agents(VECTORS_DIR, hb_agent_name, 'test'))
+        if TRAIN_FROM_SHARDS:
+            hb_data_train = ShardedHeaderBiddingData(VECTORS_DIR, HEADER_BIDDING_KEYS, 'train', all_agents=True)
 
 
         print('Building model...')
@@ -233,19 +334,53 @@ if __name__ == "__main__":
         print('Start training...')
         model.run_graph(hb_data_train,
                         hb_data_val,
-                        hb_data_test)
+                        hb_data_test,
+                        cluster=cluster)
+
+
+    elif MODE == 'multi_task':
+        ''' every impression once, all the agents trained together in one pass over it '''
+        if TRAIN_FROM_SHARDS:
+            hb_data_train = ShardedHeaderBiddingData(VECTORS_DIR, [MULTITASK_NAME], 'train')
+        else:
+            hb_data_train = load_hb_data(VECTORS_DIR, MULTITASK_NAME, 'train')
+        hb_data_val = load_hb_data(VECTORS_DIR, MULTITASK_NAME, 'val')
+        hb_data_test = load_hb_data(VECTORS_DIR, MULTITASK_NAME, 'test')
+
+        print('Building model...')
+        model = HBPredictionModel(batch_size=512,
+                                  num_epochs=50,
+                                  k=20,
+                                  learning_rate=1e-4,
+                                  lambda_linear=0.0,
+                                  lambda_factorized=0.0,
+                                  hb_agent=MODE,
+                                  multi_task=True)
+
+        print('Start training...')
+        model.run_graph(hb_data_train,
+                        hb_data_val,
+                        hb_data_test,
+                        early_stop=True,
+                        bad_epoch_tol=3,
+                        verbose=False,
+                        cluster=cluster)
+
+        if cluster is None or cluster.is_chief:  # the chief wrote the test predictions
+            pred_res = pd.read_pickle(os.path.join(INPUT_DIR, OUTPUT_PKL_NAME % MODE))
+            print("\n###### FINAL EVALUATION RESULT ######")
+            print("SKLEARN:\tMSE = %.6f" % (mean_squared_error(pred_res['y_true'], pred_res['y_pred'])))
 
 
     elif MODE == 'one_agent':
         for i, hb_agent_name in enumerate(HEADER_BIDDING_KEYS):
             print("\nHB AGENT (%d/%d) %s:" % (i + 1, len(HEADER_BIDDING_KEYS), hb_agent_name))
-            hb_data_train = HeaderBiddingData()
-            hb_data_val = HeaderBiddingData()
-            hb_data_test = HeaderBiddingData()
-
-            hb_data_train.add_data(*load_hb_data_one_agent(VECTORS_DIR, hb_agent_name, 'train'))
-            hb_data_val.add_data(*load_hb_data_one_agent(VECTORS_DIR, hb_agent_name, 'val'))
-            hb_data_test.add_data(*load_hb_data_one_agent(VECTORS_DIR, hb_agent_name, 'test'))
+            if TRAIN_FROM_SHARDS:
+                hb_data_train = ShardedHeaderBiddingData(VECTORS_DIR, [hb_agent_name], 'train')
+            else:
+                hb_data_train = load_hb_data(VECTORS_DIR, hb_agent_name, 'train')
+            hb_data_val = load_hb_data(VECTORS_DIR, hb_agent_name, 'val')
+            hb_data_test = load_hb_data(VECTORS_DIR, hb_agent_name, 'test')
 
             print('Building model...')
             model = HBPredictionModel(batch_size=512,
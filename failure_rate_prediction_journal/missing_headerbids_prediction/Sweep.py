@@ -0,0 +1,75 @@
+"""
+Hyperparameter sweep of HBPredictionModel with util.sweep: the agents are a dimension of the search space, so the
+per-agent models train concurrently instead of one after the other (MULTITASK_NAME: the multi-task model of all
+the agents).
+    python -m failure_rate_prediction_journal.missing_headerbids_prediction.Sweep
+Each process of the pool loads the data of an agent the first time one of its trials needs it, or attaches it when
+DataServer hosts it; the results table is written to INPUT_DIR/sweep_results_<MODEL>.csv.
+"""
+import os, importlib
+from util.sweep import grid, random_search, log_uniform, run_sweep
+from failure_rate_prediction_journal.missing_headerbids_prediction.DataReader import load_hb_data, MULTITASK_NAME
+from failure_rate_prediction_journal.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS
+
+MODEL = 'ylogtf'  # or 'gumbel': HeaderBidsPredictionModels_<MODEL>
+models = importlib.import_module('failure_rate_prediction_journal.missing_headerbids_prediction.'
+                                 'HeaderBidsPredictionModels_%s' % MODEL)
+VECTORS_DIR = os.path.abspath(models.VECTORS_DIR)  # the trials run in their own working directories
+INPUT_DIR = os.path.abspath(models.INPUT_DIR)
+
+SEARCH = 'grid'  # or 'random': NUM_TRIALS trials drawn from SPACE
+NUM_TRIALS = 40
+SEED = 0
+THREADS_PER_TRIAL = 2
+NUM_PROCESSES = None  # the trials run concurrently; None: as many as fit on the cores
+''' a trial never stopped trains NUM_EPOCHS epochs; with successive halving the rungs are at 1, 3, 9 and 27 epochs '''
+NUM_EPOCHS = 27
+HALVING = True
+ETA = 3
+
+SPACE = {
+    'hb_agent': list(HEADER_BIDDING_KEYS),
+    'k': [10, 20, 40],
+    'learning_rate': log_uniform(1e-5, 1e-2),
+    'lambda_linear': [0.0, 1e-6, 1e-4],
+    'lambda_factorized': [0.0, 1e-6, 1e-4],
+}
+GRID = {
+    'hb_agent': list(HEADER_BIDDING_KEYS),
+    'k': [20, 40],
+    'learning_rate': [1e-3, 1e-4],
+}
+
+
+def pin_threads(threads):
+    models.INTRA_OP_THREADS = threads
+    models.INTER_OP_THREADS = 1
+
+
+def load():
+    return {}  # hb_agent -> (train, val, test), filled by the trials
+
+
+def load_data_sets(hb_agent_name):
+    return [load_hb_data(VECTORS_DIR, hb_agent_name, data_type) for data_type in ('train', 'val', 'test')]
+
+
+def trial(params, data, stop_early):
+    ''' :return: the best validation MSE and the epochs trained '''
+    if params['hb_agent'] not in data:
+        data[params['hb_agent']] = load_data_sets(params['hb_agent'])
+    model = models.HBPredictionModel(batch_size=512, num_epochs=NUM_EPOCHS,
+                                     multi_task=params['hb_agent'] == MULTITASK_NAME, **params)
+
+    models.INPUT_DIR = '.'  # the test predictions of the trial in its working directory
+    model.run_graph(*data[params['hb_agent']], early_stop=True, bad_epoch_tol=3, verbose=False,
+                    stop_early=stop_early)
+    return {'val_loss': min(model.val_history), 'epochs': len(model.val_history)}
+
+
+if __name__ == "__main__":
+    trials = random_search(SPACE, NUM_TRIALS, SEED) if SEARCH == 'random' else grid(GRID)
+    run_sweep(trial, trials, load=load, pin_threads=pin_threads, threads_per_trial=THREADS_PER_TRIAL,
+              num_processes=NUM_PROCESSES, halving=HALVING, eta=ETA, halving_group='hb_agent',
+              trials_dir=os.path.join(INPUT_DIR, 'sweep'),
+              results_path=os.path.join(INPUT_DIR, 'sweep_results_%s.csv' % MODEL))
@@ -1,57 +1,193 @@
 """
 1. Given all impressions in MongoDB, filter the impressions whose at least one header bids are known.
 2. Split them into training, validation, and test datasets.
+
+Every impression is written once, into a columnar shard (an .npz of numpy arrays) holding its features, its header-bid
+vector (NaN if unknown), its data set label and its day. Each attribute is a dictionary-encoded column as in the
+FeatureStore of the conf: the codes of its values (-1 if missing) and their vocabulary, with the row offsets of the
+multi-valued attributes. The impressions of one header bidding agent in one data set are listed by an index
+file over the shards, so the Vectorizer reads each impression once whatever the number of agents.
 """
-import pickle
 import os
-from random import shuffle
-from failure_rate_prediction_journal.data_entry_class.ImpressionEntryGenerator import imp_entry_gen
+import numpy as np
+from collections import deque
+from multiprocessing import Pool
+from util.hash_split import assign_partition, TRAIN, VAL, TEST
+from failure_rate_prediction_journal.data_entry_class.ImpressionEntryGenerator import doc_chunk_gen
 from failure_rate_prediction_journal.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS
 
-BUFFER_QUEUE_SIZE = 80000
+SHARD_SIZE = 80000  # documents per shard (before filtering)
+NUM_WORKERS = os.cpu_count()
+MAX_PENDING_CHUNKS = 2  # per worker; the chunks of docs read ahead of the shard writer are bounded by this
 
 ROOT = '../output/missing_headerbids_data_partitions'
 
-TRAIN_OUT_PATH, VAL_OUT_PATH, TEST_OUT_PATH = os.path.join(ROOT, 'TRAIN_SET'), \
-                                              os.path.join(ROOT, 'VAL_SET'), \
-                                              os.path.join(ROOT, 'TEST_SET')
+SHARD_NAME = 'shard_%05d.npz'
+INDEX_NAME = '%s_%s_index.npy'  # % (agent_name, data_type); the global rows of the agent's impressions
+DATA_TYPES = {TRAIN: 'train', VAL: 'val', TEST: 'test'}
 
 TRAIN_PCT, VAL_PCT = 0.8, 0.1
+SPLIT_SALT = 'split-v1'  # an impression is assigned by its ImpressionId, so the split is reproducible
+
+SINGLE, MULTI, NUMERIC = 'single', 'multi', 'numeric'
+
+
+def encode_features(entries):
+    '''
+    The attributes of the entries as columns; an attribute missing from some entries (even the first) is kept, with
+    those rows missing.
+    :return: {attr: {'kind', 'vocab', 'codes' (SINGLE, MULTI) or 'values' (NUMERIC), 'offsets' (MULTI)}}
+    '''
+    kinds = {}
+    for entry in entries:
+        for attr, v in entry.items():
+            if v is not None and attr not in kinds:
+                kinds[attr] = MULTI if type(v) == list else SINGLE if type(v) == str else NUMERIC
 
-''' Delete the files that were generated before '''
-for file in os.listdir(ROOT):
-    os.remove(os.path.join(ROOT, file))
-
-''' For each header bidding agents, get all impressions in which their header bids are known '''
-hb_known_impressions = [[] for _ in range(len(HEADER_BIDDING_KEYS))]
-hb_known_file_index = [0] * len(HEADER_BIDDING_KEYS)
-for imp_entry in imp_entry_gen():
-    headerbids = imp_entry.get_headerbids()
-    for i, hb in enumerate(headerbids):
-        if hb is None:
+    columns = {}
+    for attr, kind in kinds.items():
+        values = [entry.get(attr) for entry in entries]
+        if kind == NUMERIC:
+            columns[attr] = {'kind': kind, 'values': np.array([np.nan if v is None else v for v in values], dtype=np.float64)}
             continue
 
-        hb_known_impressions[i].append(imp_entry)
+        if kind == MULTI:
+            offsets = np.concatenate(([0], np.cumsum([len(v or []) for v in values]))).astype(np.int64)
+            feats = [f for v in values for f in (v or [])]
+        else:
+            feats = [v for v in values if v is not None]
+        vocab, codes = np.unique(np.array(feats, dtype=str), return_inverse=True)
+        codes = codes.astype(np.int32).ravel()
+        if kind == MULTI:
+            columns[attr] = {'kind': kind, 'vocab': vocab, 'codes': codes, 'offsets': offsets}
+        else:
+            row_codes = np.full(len(values), -1, dtype=np.int32)
+            row_codes[[v is not None for v in values]] = codes
+            columns[attr] = {'kind': kind, 'vocab': vocab, 'codes': row_codes}
+    return columns
+
+
+def column_value(column, row):
+    ''' the value of an attribute in a row, as in the entry (None if missing) '''
+    if column['kind'] == NUMERIC:
+        v = column['values'][row]
+        return None if np.isnan(v) else float(v)
+    if column['kind'] == MULTI:
+        return column['vocab'][column['codes'][column['offsets'][row]:column['offsets'][row + 1]]].tolist()
+    code = column['codes'][row]
+    return str(column['vocab'][code]) if code >= 0 else None
+
+
+def column_counts(column, attr, rows_mask):
+    ''' {feature: occurrences in the rows of rows_mask}, counted on the codes; a numeric attribute is one feature '''
+    if column['kind'] == NUMERIC:
+        return {attr: int((~np.isnan(column['values'][rows_mask])).sum())}
+    codes = column['codes']
+    if column['kind'] == MULTI:
+        codes = codes[np.repeat(rows_mask, np.diff(column['offsets']))]
+    else:
+        codes = codes[rows_mask]
+    counts = np.bincount(codes[codes >= 0], minlength=len(column['vocab']))
+    return {str(column['vocab'][code]): int(counts[code]) for code in np.flatnonzero(counts)}
+
+
+def save_shard(file_path, shard):
+    arrays = {name: shard[name] for name in ('headerbids', 'split', 'day')}
+    for attr, column in shard['features'].items():
+        arrays.update(('features:%s:%s' % (attr, key), np.asarray(value)) for key, value in column.items())
+    np.savez(file_path, **arrays)
+
+
+def load_shard(file_path):
+    arrays = np.load(file_path)
+    shard = {'features': {}}
+    for key in arrays.files:
+        if key.startswith('features:'):
+            _, attr, part = key.split(':')
+            shard['features'].setdefault(attr, {})[part] = str(arrays[key]) if part == 'kind' else arrays[key]
+        else:
+            shard[key] = arrays[key]
+    return shard
+
+
+def extract_shard(args):
+    ''' Runs in a worker process: build the entries of a chunk of docs and keep those with header bids '''
+    ImpressionEntry, docs = args
+    entries, headerbids, splits, days = [], [], [], []
+    for doc in docs:
+        imp_entry = ImpressionEntry(doc)
+        imp_entry.build_entry()
+        if not imp_entry.is_qualified():
+            continue
+
+        header_bids = imp_entry.get_headerbids()
+        if all(hb is None for hb in header_bids):
+            continue
+
+        entries.append(imp_entry.entry)
+        headerbids.append([np.nan if hb is None else hb for hb in header_bids])
+        splits.append(assign_partition(doc.get('ImpressionId', doc['_id']), TRAIN_PCT, VAL_PCT, SPLIT_SALT))
+        days.append(doc['Time'].date())
+
+    return {'features': encode_features(entries),
+            'headerbids': np.array(headerbids, dtype=np.float64).reshape(-1, len(HEADER_BIDDING_KEYS)),
+            'split': np.array(splits, dtype=np.int8),
+            'day': np.array(days, dtype='datetime64[D]')}
+
+
+def iter_shards(dir_path):
+    ''' :return: (the global row of the first impression, shard) in the order the shards were written '''
+    offsets = np.load(os.path.join(dir_path, 'shard_offsets.npy'))
+    for shard_no, offset in enumerate(offsets[:-1]):
+        yield offset, load_shard(os.path.join(dir_path, SHARD_NAME % shard_no))
+
+
+def load_index(dir_path, agent_name, data_type):
+    ''' data_type 'all' takes the impressions of the three data sets, e.g. for time-window splits '''
+    if data_type == 'all':
+        return np.unique(np.concatenate([load_index(dir_path, agent_name, t) for t in DATA_TYPES.values()]))
+    return np.load(os.path.join(dir_path, INDEX_NAME % (agent_name, data_type)))
+
+
+def bounded_imap(pool, func, iterable, max_pending):
+    '''
+    pool.imap(func, iterable), but with at most max_pending items submitted and not yet consumed: pool.imap reads
+    the iterable as fast as it can (here, every chunk of docs of the collections) when the consumer falls behind.
+    '''
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def write_partitions(root=ROOT, num_workers=NUM_WORKERS):
+    ''' Delete the files that were generated before '''
+    for file in os.listdir(root):
+        os.remove(os.path.join(root, file))
 
-        if len(hb_known_impressions[i]) == BUFFER_QUEUE_SIZE:
-            outfilename = HEADER_BIDDING_KEYS[i] + '_%d' % hb_known_file_index[i]
+    agent_rows = {(agent_name, data_type): [] for agent_name in HEADER_BIDDING_KEYS for data_type in DATA_TYPES.values()}
+    offsets = [0]
+    with Pool(num_workers) as pool:
+        shards = bounded_imap(pool, extract_shard, doc_chunk_gen(SHARD_SIZE), MAX_PENDING_CHUNKS * num_workers)
+        for shard_no, shard in enumerate(shards):
+            save_shard(os.path.join(root, SHARD_NAME % shard_no), shard)
 
-            ''' train, val, and test partitioning '''
-            shuffle(hb_known_impressions[i])
+            for i, agent_name in enumerate(HEADER_BIDDING_KEYS):
+                known = ~np.isnan(shard['headerbids'][:, i])
+                for split, data_type in DATA_TYPES.items():
+                    agent_rows[agent_name, data_type].append(offsets[-1] + np.flatnonzero(known & (shard['split'] == split)))
+            offsets.append(offsets[-1] + len(shard['split']))
+            print('Shard %d has been generated with %d impressions.' % (shard_no, len(shard['split'])))
 
-            train_len = int(TRAIN_PCT * len(hb_known_impressions[i]))
-            val_len = int(VAL_PCT * len(hb_known_impressions[i]))
-            pickle.dump(hb_known_impressions[i][ : train_len],
-                        open(os.path.join(ROOT, outfilename + '_train.p'),
-                             'wb'))
-            pickle.dump(hb_known_impressions[i][train_len : train_len + val_len],
-                        open(os.path.join(ROOT, outfilename + '_val.p'),
-                             'wb'))
-            pickle.dump(hb_known_impressions[i][train_len + val_len : ],
-                        open(os.path.join(ROOT, outfilename + '_test.p'),
-                             'wb'))
-            print('Files has been generated for %s.' % outfilename)
-            hb_known_impressions[i].clear()
-            hb_known_file_index[i] += 1
+    np.save(os.path.join(root, 'shard_offsets.npy'), np.array(offsets, dtype=np.int64))
+    for (agent_name, data_type), rows in agent_rows.items():
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        np.save(os.path.join(root, INDEX_NAME % (agent_name, data_type)), rows)
+        print('%d %s impressions for %s.' % (len(rows), data_type, agent_name))
 
 
+if __name__ == "__main__":
+    write_partitions()
@@ -1,33 +1,84 @@
-import os, re, csv, pickle
+import os, re, csv, pickle, shutil
+import numpy as np
 from scipy import sparse
 from pprint import pprint
-from scipy.sparse import coo_matrix
+from util.hash_split import TRAIN
+from util.sparse_vector_reader import read_sparse_vectors, iter_sparse_vector_blocks, to_csr_matrix
+from util.shards import write_shard, write_shard_meta, shuffle_shards
+from util.sparse_batch import ragged_positions
 from failure_rate_prediction_journal.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS, MIN_OCCURRENCE
+from failure_rate_prediction_journal.missing_headerbids_prediction.TrainValTestSplitter import iter_shards, load_index, \
+    column_counts, SINGLE, MULTI, NUMERIC
+from failure_rate_prediction_journal.missing_headerbids_prediction.DataReader import MULTITASK_NAME
 from collections import defaultdict, Counter
 
 
 PARTITION_DIR = '../output/missing_headerbids_data_partitions'
 VECTOR_DIR = '../output/vectorization'
 
+DATASET_TYPES = ('train', 'val', 'test')  # add 'all' to also vectorize every impression together, for time windows
+SHARD_SIZE = None  # e.g. 1000000 to also write the vectors as shards of that many rows, for out-of-core training
+SHUFFLE_TRAIN_SHARDS = True  # the vectors are in shard (roughly time) order; shuffle the training shards on disk
+MULTITASK_VECTORS = True  # also write every impression once with the bids of all the agents, for MODE = 'multi_task'
+
+
+def columns_to_sparse_feature_vectors(columns, rows, attr2idx):
+    '''
+    entry_to_sparse_feature_vector of the entries of the rows of the shard columns, computed per attribute on the
+    codes instead of decoding every entry: the 'col:value' strings are built once per feature (and value) and
+    gathered by code.
+    :return: the vector of every row, in the order of rows
+    '''
+    if not len(rows):
+        return []
+    row_ids, tokens = [], []
+    for attr, column in columns.items():
+        feat2col = attr2idx.get(attr, {})
+        if column['kind'] == NUMERIC:
+            if attr not in feat2col:
+                continue
+            values = column['values'][rows]
+            present = np.flatnonzero(~np.isnan(values))
+            row_ids.append(present)
+            tokens.append(np.array(['%d:%s' % (feat2col[attr], v) for v in values[present].tolist()], dtype=object))
+            continue
+
+        ''' the 'col:' prefix of every code, None for the features left to the intercept '''
+        code2prefix = np.array([None] + ['%d:' % feat2col[f] if f in feat2col else None for f in column['vocab'].tolist()],
+                               dtype=object)
+        if column['kind'] == MULTI:
+            offsets = column['offsets']
+            lengths = offsets[rows + 1] - offsets[rows]
+            row_id = np.repeat(np.arange(len(rows)), lengths)
+            prefixes = code2prefix[column['codes'][ragged_positions(offsets[rows], lengths)] + 1]
+            distinct_lengths, length_ids = np.unique(lengths[row_id], return_inverse=True)
+            suffixes = np.array([str(1.0 / n) for n in distinct_lengths.tolist()], dtype=object)[length_ids]
+        else:
+            row_id = np.arange(len(rows))
+            prefixes = code2prefix[column['codes'][rows] + 1]  # code -1 (missing) takes the None of position 0
+            suffixes = np.full(len(rows), '1', dtype=object)
+        kept = np.flatnonzero(prefixes != None)
+        row_ids.append(row_id[kept])
+        tokens.append(prefixes[kept] + suffixes[kept])
+
+    if not row_ids:
+        return [[] for _ in rows]
+    row_ids = np.concatenate(row_ids)
+    order = np.argsort(row_ids, kind='stable')  # per row, the attributes in the order of the entry
+    tokens = np.concatenate(tokens)[order]
+    return [row_tokens.tolist() for row_tokens in np.split(tokens, np.cumsum(np.bincount(row_ids, minlength=len(rows)))[:-1])]
+
 
 class Vectorizer:
     def __init__(self):
         self.counter = defaultdict(Counter)  # {Attribute1:Counter<features>, Attribute2:Counter<features>, ...}
 
-    def fit(self, dir_path, file_filter_re):
-        for filename in os.listdir(dir_path):
-            if not re.match(file_filter_re, filename):
-                # filename[ : len(agent_name)] != agent_name or filename[-len('train.p'):] != 'train.p':
-                continue
-            print("Fitting %s" % filename)
-            for imp_entry in pickle.load(open(os.path.join(dir_path, filename), 'rb')):
-                for k, v in imp_entry.entry.items():  # iterate all <fields:feature>
-                    if type(v) == list:
-                        self.counter[k].update(v)
-                    elif type(v) == str:
-                        self.counter[k][v] += 1
-                    else:
-                        self.counter[k][k] += 1  # for float or int features, occupy only one column
+    def fit(self, dir_path):
+        ''' count the training impressions of all agents, each impression once '''
+        for _, shard in iter_shards(dir_path):
+            is_train = shard['split'] == TRAIN
+            for k, column in shard['features'].items():  # iterate all <fields:features>
+                self.counter[k].update(column_counts(column, k, is_train))  # float or int features occupy one column
 
 
     def build_attr2idx(self):
@@ -45,49 +96,71 @@ class Vectorizer:
         print('Finish building attr2idx')
 
 
-    def transform_one_impression(self, imp_entry, agent_index):
-        ''' Get prediction target '''
-        header_bid = imp_entry.get_headerbids()[agent_index]
-        if not imp_entry.is_qualified() or not header_bid:
-            return None, None
-        # return target + imp_entry.to_full_feature_vector(self.num_features)
-        return header_bid, imp_entry.to_sparse_feature_vector(self.attr2idx)
-
-    def transform(self, dir_path, agent_name, file_filter_re):
-        agent_index = HEADER_BIDDING_KEYS.index(agent_name)
-        header_bids = []
-        feature_matrix = []
-        # n = 0
-        for filename in os.listdir(dir_path):
-            if not re.match(file_filter_re, filename):
-                continue
-            print("Transforming %s" % filename)
-
-            for imp_entry in pickle.load(open(os.path.join(dir_path, filename), 'rb')):
-                header_bid, features = self.transform_one_impression(imp_entry, agent_index)
-                if header_bid is not None:
-                    header_bids.append([header_bid])
-                    feature_matrix.append(features)
-
-        return header_bids, feature_matrix
-
-
-
-def output_one_agent_vector_files(vectorizer, output_dir, imp_files_path, agent_name):
-    for dataset_type in ('train', 'val', 'test'):
-        with open(os.path.join(output_dir,
-                               '%s_featvec_%s.csv' % (agent_name, dataset_type)
-                               ), 'a', newline='\n') as outfile_feat, \
-                open(os.path.join(output_dir,
-                               '%s_headerbids_%s.csv' % (agent_name, dataset_type)
-                               ), 'a', newline='\n') as outfile_hb:
-            writer_feat = csv.writer(outfile_feat, delimiter=',')
-            writer_feat.writerow([vectorizer.num_features])  # the number of features
-            writer_hb = csv.writer(outfile_hb, delimiter=',')
-            hbs, mat = vectorizer.transform(imp_files_path, agent_name,
-                                            r'%s_\d+_%s' % (agent_name, dataset_type))
+    def transform(self, dir_path, data_type):
+        '''
+        Vectorize each impression of the data set once and hand it to every agent whose index lists it.
+        With MULTITASK_VECTORS, every impression is also output once under MULTITASK_NAME, with the bids of all the
+        agents (0 for an agent whose index does not list it).
+        :return: {agent_name: (header_bids, feature_matrix, days)} for each shard
+        '''
+        agent_indices = {agent_name: load_index(dir_path, agent_name, data_type) for agent_name in HEADER_BIDDING_KEYS}
+        for offset, shard in iter_shards(dir_path):
+            num_rows = len(shard['split'])
+            agent_rows = {agent_name: index[np.searchsorted(index, offset):np.searchsorted(index, offset + num_rows)] - offset
+                          for agent_name, index in agent_indices.items()}
+
+            all_rows = np.unique(np.concatenate(list(agent_rows.values())))
+            vectors = dict(zip(all_rows.tolist(),
+                               columns_to_sparse_feature_vectors(shard['features'], all_rows, self.attr2idx)))
+
+            shard_output = {}
+            for agent_name, rows in agent_rows.items():
+                header_bids = shard['headerbids'][rows, HEADER_BIDDING_KEYS.index(agent_name)]
+                shard_output[agent_name] = ([[float(hb)] for hb in header_bids if hb],
+                                            [vectors[row] for row, hb in zip(rows, header_bids) if hb],
+                                            shard['day'][rows][header_bids != 0])
+
+            if MULTITASK_VECTORS:
+                all_bids = np.zeros((len(all_rows), len(HEADER_BIDDING_KEYS)))
+                for i, agent_name in enumerate(HEADER_BIDDING_KEYS):
+                    listed = np.isin(all_rows, agent_rows[agent_name])
+                    all_bids[listed, i] = shard['headerbids'][all_rows[listed], i]
+                observed = (all_bids != 0).any(axis=1)
+                shard_output[MULTITASK_NAME] = (all_bids[observed].tolist(),
+                                                [vectors[row] for row in all_rows[observed]],
+                                                shard['day'][all_rows[observed]])
+            yield shard_output
+
+
+
+def output_vector_files(vectorizer, output_dir, partition_dir, dataset_type):
+    outfiles = []
+    writers = {}
+    output_names = HEADER_BIDDING_KEYS + ((MULTITASK_NAME,) if MULTITASK_VECTORS else ())
+    for agent_name in output_names:
+        outfile_feat = open(os.path.join(output_dir, '%s_featvec_%s.csv' % (agent_name, dataset_type)), 'a', newline='\n')
+        outfile_hb = open(os.path.join(output_dir, '%s_headerbids_%s.csv' % (agent_name, dataset_type)), 'a', newline='\n')
+        outfiles.extend((outfile_feat, outfile_hb))
+        writer_feat = csv.writer(outfile_feat, delimiter=',')
+        writer_feat.writerow([vectorizer.num_features])  # the number of features
+        writers[agent_name] = (writer_feat, csv.writer(outfile_hb, delimiter=','))
+
+    print("Transforming the %s impressions" % dataset_type)
+    agent_days = {agent_name: [] for agent_name in output_names}
+    for shard_output in vectorizer.transform(partition_dir, dataset_type):
+        for agent_name, (hbs, mat, days) in shard_output.items():
+            writer_feat, writer_hb = writers[agent_name]
             writer_feat.writerows(mat)
             writer_hb.writerows(hbs)
+            agent_days[agent_name].append(days)
+
+    for outfile in outfiles:
+        outfile.close()
+
+    ''' the day of every row, for DayIndex time windows '''
+    for agent_name, days in agent_days.items():
+        np.save(os.path.join(output_dir, '%s_days_%s.npy' % (agent_name, dataset_type)),
+                np.concatenate(days) if days else np.empty(0, dtype='datetime64[D]'))
 
 
 def build_vectors_across_all_agents():
@@ -96,7 +169,7 @@ def build_vectors_across_all_agents():
     i.e., all agents share the same feature space.
     """
     vectorizer = Vectorizer()
-    vectorizer.fit(PARTITION_DIR, r'.+_train\.p')
+    vectorizer.fit(PARTITION_DIR)
     vectorizer.build_attr2idx()
     print("\nCounter:")
     pprint(vectorizer.counter)
@@ -113,33 +186,58 @@ def build_vectors_across_all_agents():
     pickle.dump(vectorizer.attr2idx, open(os.path.join(VECTOR_DIR, "attr2idx.dict"), "wb"))
     print("The counter and attr2idx are dumped")
 
-    for agent_name in HEADER_BIDDING_KEYS:
-        output_one_agent_vector_files(vectorizer,
-                                      VECTOR_DIR,
-                                      PARTITION_DIR,
-                                      agent_name)
+    for dataset_type in DATASET_TYPES:
+        output_vector_files(vectorizer,
+                            VECTOR_DIR,
+                            PARTITION_DIR,
+                            dataset_type)
 
 
 def featstr_to_sparsemat(dir_path):
     for filename in os.listdir(dir_path):
-        if not re.match(r'.*_featvec_(train|val|test)\.csv', filename):
+        if not re.match(r'.*_featvec_(train|val|test|all)\.csv', filename):
             continue
         print("Converting file %s" % filename)
-        row_indices_fv, col_indices_fv, values_fv = [], [], []
-        num_rows = 0
-        row_gen = csv.reader(open(os.path.join(dir_path, filename)))
-        num_features = int(next(row_gen)[0])
-        for row in row_gen:
-            for node in row:
-                col_index, val = node.split(':')
-                row_indices_fv.append(num_rows)
-                col_indices_fv.append(int(col_index))
-                values_fv.append(float(val))
-            num_rows += 1
+        num_features, _, indptr, indices, data = read_sparse_vectors(os.path.join(dir_path, filename))
         sparse.save_npz(os.path.join(dir_path, filename[:-len('.csv')] + '.csr'),
-                        coo_matrix((values_fv, (row_indices_fv, col_indices_fv)),
-                                   shape=(num_rows, num_features)).tocsr())
+                        to_csr_matrix(indptr, indices, data, num_features))
+
+def featstr_to_shards(dir_path, shard_size):
+    '''
+    Write every <agent>_featvec_<data type>.csv and its header bids as shards of shard_size rows under
+    <agent>_shards_<data type>/, for ShardedHeaderBiddingData
+    '''
+    for filename in os.listdir(dir_path):
+        match = re.match(r'(.*)_featvec_(train|val|test|all)\.csv', filename)
+        if not match:
+            continue
+        agent_name, data_type = match.groups()
+        shards_dir = os.path.join(dir_path, '%s_shards_%s' % (agent_name, data_type))  # read by ShardedHeaderBiddingData
+        shuffle = data_type == 'train' and SHUFFLE_TRAIN_SHARDS
+        out_dir = shards_dir + '_unshuffled' if shuffle else shards_dir
+        os.makedirs(out_dir, exist_ok=True)
+        print("Sharding file %s" % filename)
+        with open(os.path.join(dir_path, filename)) as featvec_file:
+            num_features = int(featvec_file.readline())
+
+        num_rows = []
+        num_bids = len(HEADER_BIDDING_KEYS) if agent_name == MULTITASK_NAME else 1  # a column per agent
+        for shard_no, ((_, *featvec_csr), (headerbids, *_)) in enumerate(zip(
+                iter_sparse_vector_blocks(os.path.join(dir_path, filename), lines_per_block=shard_size),
+                iter_sparse_vector_blocks(os.path.join(dir_path, '%s_headerbids_%s.csv' % (agent_name, data_type)),
+                                          num_scalars=num_bids, has_header=False, lines_per_block=shard_size))):
+            write_shard(out_dir, shard_no,
+                        headerbids=headerbids if agent_name == MULTITASK_NAME else headerbids[:, 0],
+                        sparse_features=to_csr_matrix(*featvec_csr, num_features))
+            num_rows.append(len(headerbids))
+        write_shard_meta(out_dir, num_rows, num_features=num_features)
+        if shuffle:
+            shuffle_shards(out_dir, shards_dir)
+            shutil.rmtree(out_dir)
+
 
 if __name__ == "__main__":
     build_vectors_across_all_agents()
-    featstr_to_sparsemat(VECTOR_DIR)
\ No newline at end of file
+    featstr_to_sparsemat(VECTOR_DIR)
+    if SHARD_SIZE:
+        featstr_to_shards(VECTOR_DIR, SHARD_SIZE)
\ No newline at end of file
@@ -0,0 +1,17 @@
+import numpy as np
+from itertools import islice
+from failure_rate_prediction_conf.SyntheticData import random_survival_data
+
+
+def test_workers_split_a_plan_drawn_with_the_same_seed():
+    ''' as Cluster.worker_batches: every worker draws the plan with RandomState(seed) and takes its share '''
+    data = random_survival_data(np.random.RandomState(0), 1000, 100, 10, 6)
+    state = np.random.get_state()
+    num_workers = 3
+    for num_buckets in (None, 4):
+        shares = [list(islice(data.batch_plan(64, num_buckets=num_buckets, rs=np.random.RandomState(7)),
+                              task_index, None, num_workers)) for task_index in range(num_workers)]
+        rows = np.concatenate([np.arange(1000)[batch_rows] for share in shares for batch_rows, _ in share])
+        assert np.array_equal(np.sort(rows), np.arange(1000))
+        assert all(len(share) > 0 for share in shares)
+    assert np.array_equal(np.random.get_state()[1], state[1])  # the global RandomState is left alone
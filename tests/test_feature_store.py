@@ -0,0 +1,33 @@
+import numpy as np
+from failure_rate_prediction_conf.FeatureStore import FeatureStore
+from failure_rate_prediction_conf.DataReader import SurvivalData
+from failure_rate_prediction_conf.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS, MIN_OCCURRENCE
+
+
+def _store(user_counts, page_counts):
+    ''' one row per occurrence, the n-th user with the n-th page '''
+    users = [user for user, n in user_counts for _ in range(n)]
+    pages = [page for page, n in page_counts for _ in range(n)]
+    store = FeatureStore()
+    for i, (user, page) in enumerate(zip(users, pages)):
+        entry = {'UserId': user, 'NaturalIDs': [page]}
+        for k, v in entry.items():
+            store._count(k, v)
+        store._append(entry, (1.0 + i, i % 2), [0.1 + i] + [None] * (len(HEADER_BIDDING_KEYS) - 1))
+    return store
+
+
+def test_survival_data_merges_the_infrequent_features_of_the_store(tmp_path, monkeypatch):
+    ''' nothing is read from output/ when the data comes from the FeatureStore '''
+    monkeypatch.chdir(tmp_path)
+    store = _store([('u0', 20), ('u1', 12), ('u2', 7), ('u3', 1)], [('p0', 20), ('p1', 12), ('p2', 7), ('p3', 1)])
+    times, events, sparse_features, sparse_headerbids = store.to_csr(MIN_OCCURRENCE)
+    assert store.counter()['UserId'] == {'u0': 20, 'u1': 12, 'u2': 7, 'u3': 1}
+    assert float(sparse_headerbids[-1, 0]) == 0.1 + store.num_rows - 1  # not rounded to float32
+
+    data = SurvivalData(times, events, sparse_features, sparse_headerbids, min_occurrence=10,
+                        attr2idx=store.attr2idx, counter=store.counter())
+    assert data.infreq_user_col_indices.tolist() == [store.attr2idx['UserId']['u2']]
+    assert data.infreq_page_col_indices.tolist() == [store.attr2idx['NaturalIDs']['p2']]
+    assert data.num_features == store.num_features - 2
+    assert np.all(data.sparse_features.sum(axis=0) > 0)
@@ -0,0 +1,36 @@
+import csv, io
+from collections import Counter
+from util.hash_split import assign_partition, split_key_value, TRAIN, VAL, TEST
+
+
+def _keys_rows(lines):
+    reader = csv.reader(io.StringIO(lines))
+    header = next(reader)
+    return [dict(zip(header, row)) for row in reader]
+
+
+def test_blank_user_ids_fall_back_to_the_impression_id():
+    ''' the keys file of the Vectorizer writes a missing UserId as '' '''
+    rows = _keys_rows('ImpressionId,UserId,Date\n' +
+                      ''.join('imp%d,,2018-01-01\n' % i for i in range(3000)))
+    keys = [split_key_value(row, 'UserId') for row in rows]
+    assert len(set(keys)) == len(rows)
+
+    counts = Counter(assign_partition(key, 0.8, 0.1, 'split-v1') for key in keys)
+    assert set(counts) == {TRAIN, VAL, TEST}
+    assert 0.75 < counts[TRAIN] / len(rows) < 0.85
+
+
+def test_user_ids_keep_a_user_in_one_partition():
+    rows = _keys_rows('ImpressionId,UserId,Date\nimp1,u1,2018-01-01\nimp2,u1,2018-01-02\nimp3, ,2018-01-02\n')
+    keys = [split_key_value(row, 'UserId') for row in rows]
+    assert keys[0] == keys[1] == 'u1'
+    assert keys[2] == 'ImpressionId:imp3'
+    assert split_key_value({'ImpressionId': 'imp4', 'UserId': None}, 'UserId') == 'ImpressionId:imp4'
+
+
+def test_missing_user_ids_of_pandas_fall_back_to_the_impression_id():
+    ''' a missing UserId of a DataFrame is NaN, written as 'nan' '''
+    rows = _keys_rows('ImpressionId,UserId,Date\nimp1,nan,2018-01-01\nimp2,nan,2018-01-01\n')
+    assert [split_key_value(row, 'UserId') for row in rows] == ['ImpressionId:imp1', 'ImpressionId:imp2']
+    assert split_key_value({'ImpressionId': 'imp3', 'UserId': float('nan')}, 'UserId') == 'ImpressionId:imp3'
@@ -0,0 +1,61 @@
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from failure_rate_prediction_journal.data_entry_class.ImpressionEntry import entry_to_sparse_feature_vector
+from failure_rate_prediction_journal.missing_headerbids_prediction.TrainValTestSplitter import encode_features, \
+    column_value, column_counts, save_shard, load_shard, bounded_imap
+from failure_rate_prediction_journal.missing_headerbids_prediction.Vectorizer import columns_to_sparse_feature_vectors
+
+ENTRIES = [{'UserId': 'u1', 'channel': ['news', 'sport']},
+           {'UserId': 'u2', 'channel': [], 'trend': 'up', 'SellerReservePrice': 0.5},
+           {'UserId': 'u1', 'channel': ['news'], 'trend': None}]
+
+
+def _shard():
+    return {'features': encode_features(ENTRIES), 'headerbids': np.full((3, 5), np.nan),
+            'split': np.zeros(3, dtype=np.int8), 'day': np.array(['2018-01-01'] * 3, dtype='datetime64[D]')}
+
+
+def test_attributes_missing_from_the_first_entry_are_kept(tmp_path):
+    save_shard(str(tmp_path / 'shard_00000.npz'), _shard())
+    shard = load_shard(str(tmp_path / 'shard_00000.npz'))
+
+    assert set(shard['features']) == {'UserId', 'channel', 'trend', 'SellerReservePrice'}
+    for row, entry in enumerate(ENTRIES):
+        decoded = {attr: column_value(column, row) for attr, column in shard['features'].items()}
+        assert {attr: v for attr, v in decoded.items() if v is not None} == \
+               {attr: v for attr, v in entry.items() if v is not None}
+    assert shard['day'].dtype == np.dtype('datetime64[D]')
+
+
+def test_column_counts_of_a_row_subset():
+    features = encode_features(ENTRIES)
+    rows = np.array([True, False, True])
+    assert column_counts(features['UserId'], 'UserId', rows) == {'u1': 2}
+    assert column_counts(features['channel'], 'channel', rows) == {'news': 2, 'sport': 1}
+    assert column_counts(features['trend'], 'trend', ~rows) == {'up': 1}
+    assert column_counts(features['SellerReservePrice'], 'SellerReservePrice', ~rows) == {'SellerReservePrice': 1}
+
+
+def test_vectors_of_the_columns_match_those_of_the_entries():
+    features = encode_features(ENTRIES)
+    attr2idx = {'UserId': {'u1': 0}, 'channel': {'news': 1, 'sport': 2}, 'trend': {},
+                'SellerReservePrice': {'SellerReservePrice': 3}}
+    rows = np.array([2, 0, 1])
+    expected = [entry_to_sparse_feature_vector({attr: v for attr, v in ENTRIES[row].items() if v is not None}, attr2idx)
+                for row in rows]
+    assert columns_to_sparse_feature_vectors(features, rows, attr2idx) == expected
+    assert expected == [['0:1', '1:1.0'], ['0:1', '1:0.5', '2:0.5'], ['3:0.5']]
+
+
+def test_chunks_read_ahead_are_bounded():
+    consumed = []
+
+    def chunks():
+        for i in range(20):
+            consumed.append(i)
+            yield i
+
+    with ThreadPool(2) as pool:
+        for n, result in enumerate(bounded_imap(pool, lambda i: i * i, chunks(), 3)):
+            assert result == n * n
+            assert len(consumed) - n <= 3
@@ -0,0 +1,63 @@
+import os
+import numpy as np
+from failure_rate_prediction_journal.data_entry_class.ImpressionEntry import HEADER_BIDDING_KEYS
+from failure_rate_prediction_journal.missing_headerbids_prediction.TrainValTestSplitter import SHARD_NAME, \
+    INDEX_NAME, DATA_TYPES, encode_features, save_shard
+from failure_rate_prediction_journal.missing_headerbids_prediction.Vectorizer import Vectorizer, output_vector_files, \
+    featstr_to_sparsemat
+from failure_rate_prediction_journal.missing_headerbids_prediction.DataReader import load_hb_data_multitask, \
+    load_hb_data_one_agent, load_hb_data_all_agents, load_day_index, MULTITASK_NAME
+from util.hash_split import TRAIN
+
+NUM_ROWS = 40
+
+
+def _write_partitions(dir_path, headerbids):
+    ''' one shard of training impressions, and the indexes of write_partitions '''
+    entries = [{'DeviceCategory': 'mobile' if row % 2 else 'desktop', 'channel': ['news']} for row in range(NUM_ROWS)]
+    save_shard(os.path.join(dir_path, SHARD_NAME % 0),
+               {'features': encode_features(entries), 'headerbids': headerbids,
+                'split': np.full(NUM_ROWS, TRAIN, dtype=np.int8),
+                'day': np.array(['2018-01-01'] * NUM_ROWS, dtype='datetime64[D]')})
+    np.save(os.path.join(dir_path, 'shard_offsets.npy'), np.array([0, NUM_ROWS], dtype=np.int64))
+    for i, agent_name in enumerate(HEADER_BIDDING_KEYS):
+        for split, data_type in DATA_TYPES.items():
+            rows = np.flatnonzero(~np.isnan(headerbids[:, i])) if split == TRAIN else np.empty(0, dtype=np.int64)
+            np.save(os.path.join(dir_path, INDEX_NAME % (agent_name, data_type)), rows)
+
+
+def test_vectorizer_output_loads_as_multitask_data(tmp_path):
+    rs = np.random.RandomState(0)
+    headerbids = np.round(rs.uniform(0.1, 3.0, size=(NUM_ROWS, len(HEADER_BIDDING_KEYS))), 2)
+    headerbids[rs.rand(*headerbids.shape) < 0.5] = np.nan
+    headerbids[0] = np.nan  # no bid at all: not vectorized
+    headerbids[1, 0] = 7.0  # an outlier, only set as not observed
+    partition_dir, vector_dir = tmp_path / 'partitions', tmp_path / 'vectors'
+    partition_dir.mkdir()
+    vector_dir.mkdir()
+    _write_partitions(str(partition_dir), headerbids)
+
+    vectorizer = Vectorizer()
+    vectorizer.fit(str(partition_dir))
+    vectorizer.build_attr2idx()
+    output_vector_files(vectorizer, str(vector_dir), str(partition_dir), 'train')
+    featstr_to_sparsemat(str(vector_dir))
+
+    bids, features = load_hb_data_multitask(str(vector_dir), 'train')
+    expected = np.nan_to_num(headerbids[1:])
+    expected[expected >= 5.0] = 0.0
+    expected = expected[(expected > 0).any(axis=1)]
+    assert bids.shape == (len(expected), len(HEADER_BIDDING_KEYS))
+    assert np.allclose(bids, expected)
+    assert features.shape == (len(expected), vectorizer.num_features)
+
+    ''' every observed bid of the multi-task data is a row of its agent's data '''
+    for i, agent_name in enumerate(HEADER_BIDDING_KEYS):
+        agent_bids, _ = load_hb_data_one_agent(str(vector_dir), agent_name, 'train')
+        assert np.allclose(np.sort(agent_bids), np.sort(bids[bids[:, i] > 0, i]))
+    assert len(load_day_index(str(vector_dir), MULTITASK_NAME, 'train').order) == len(expected)
+
+    ''' all_agents keeps a one-hot column for each journal agent, fb_bid_price_cents being the dummy '''
+    agent_bids, agent_features = load_hb_data_all_agents(str(vector_dir), HEADER_BIDDING_KEYS[-1], 'train')
+    assert agent_features.shape[1] == vectorizer.num_features + len(HEADER_BIDDING_KEYS)
+    assert np.all(agent_features[:, len(HEADER_BIDDING_KEYS) - 1].toarray() == 1)
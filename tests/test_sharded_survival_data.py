@@ -0,0 +1,40 @@
+import os, pickle
+import numpy as np
+from scipy import sparse
+from failure_rate_prediction_conf.DataReader import ShardedSurvivalData
+from failure_rate_prediction_conf.SyntheticData import random_csr, rares_attr2idx
+from util.shards import write_shard, write_shard_meta
+
+
+def test_counts_and_columns_come_from_the_shard_meta(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('output')
+    attr2idx = rares_attr2idx()
+    attr2idx['UserId'].update({'u1': 2, 'u2': 3})
+    pickle.dump(attr2idx, open('output/attr2idx.dict', 'wb'))
+    pickle.dump({'UserId': {'u1': 6, 'u2': 50}, 'NaturalIDs': {}}, open('output/counter.dict', 'wb'))
+
+    rs = np.random.RandomState(0)
+    num_rows, num_hb_rows = [], 0
+    for shard_no in range(3):
+        n = 100 + shard_no
+        features = sparse.hstack([sparse.csr_matrix((n, 4)), random_csr(rs, n, 46, 5)], format='csr')  # no user
+        headerbids = random_csr(rs, n, 6, 2).multiply(rs.rand(n, 1) < 0.5).tocsr()
+        write_shard(str(tmp_path), shard_no, times=rs.exponential(size=n), events=rs.randint(2, size=n),
+                    sparse_features=features, sparse_headerbids=headerbids)
+        num_rows.append(n)
+        num_hb_rows += len(np.unique(headerbids.nonzero()[0]))
+    write_shard_meta(str(tmp_path), num_rows, num_features=50, num_hb_rows=num_hb_rows)
+
+    data = ShardedSurvivalData(str(tmp_path), buffer_shards=2)
+    assert data.num_instances == sum(num_rows) and data.num_features == 50
+    hb_data = ShardedSurvivalData(str(tmp_path), only_hb_imp=True, buffer_shards=2)
+    assert hb_data.num_instances == num_hb_rows
+    times = np.concatenate([batch[0] for batch in hb_data.make_sparse_batch(64)])
+    assert len(times) == num_hb_rows
+
+    ''' u1 is merged into <RARE> with min_occurrence 10; its column is dropped in every buffer '''
+    infreq_data = ShardedSurvivalData(str(tmp_path), min_occurrence=10, buffer_shards=2)
+    assert infreq_data.num_features == 49 and infreq_data.col_map[2] == -1 and infreq_data.col_map[3] == 2
+    for batch in infreq_data.make_sparse_batch(64):
+        assert batch[2].max() < 49
@@ -0,0 +1,14 @@
+import os
+from failure_rate_prediction_conf.Vectorizer import vector_file_sets
+
+
+def test_incremental_files_follow_the_full_vectorization(tmp_path):
+    for name in ('FeatVec_adxwon.csv', 'FeatVec_adxlose.csv', 'FeatVec_adxwon_day2.csv', 'FeatVec_adxlose_day2.csv',
+                 'FeatVec_adxwon_day1.csv', 'FeatVec_adxlose_day1.csv', 'HeaderBids_adxwon_day1.csv'):
+        (tmp_path / name).write_text('0\n')
+    file_sets = vector_file_sets(str(tmp_path))
+    assert [os.path.basename(featvec) for featvec, _, _ in file_sets] == [
+        'FeatVec_adxwon.csv', 'FeatVec_adxlose.csv', 'FeatVec_adxwon_day1.csv', 'FeatVec_adxlose_day1.csv',
+        'FeatVec_adxwon_day2.csv', 'FeatVec_adxlose_day2.csv']
+    assert [os.path.basename(path) for path in file_sets[2]] == [
+        'FeatVec_adxwon_day1.csv', 'HeaderBids_adxwon_day1.csv', 'Keys_adxwon_day1.csv']
@@ -0,0 +1,41 @@
+import numpy as np
+from failure_rate_prediction_conf.SyntheticData import random_csr, random_survival_data
+from failure_rate_prediction_journal.missing_headerbids_prediction.DataReader import HeaderBiddingData
+from util.day_index import DayIndex
+
+
+def _survival_data(num_rows=500):
+    return random_survival_data(np.random.RandomState(0), num_rows, 200, 10, 6)
+
+
+def _window_rows(num_rows):
+    days = np.datetime64('2018-01-01') + np.random.RandomState(1).randint(10, size=num_rows)
+    return DayIndex(days).rows('2018-01-03', '2018-01-06')
+
+
+def test_survival_data_window_shares_the_arrays_and_batches_its_rows():
+    data = _survival_data()
+    rows = _window_rows(len(data.times))
+    window = data.window(rows, only_hb_imp=True)
+
+    assert window.sparse_features is data.sparse_features and window.times is data.times
+    expected = rows[data.subsets.mask('has_hb')[rows]]
+    assert window.num_instances == len(expected)
+    times = np.concatenate([batch[0] for batch in window.make_sparse_batch(64, shuffle=False)])
+    assert np.array_equal(times, data.times[expected])
+    assert data.select_rows() is None  # the base data set is left as it is
+
+
+def test_header_bidding_data_window():
+    rs = np.random.RandomState(0)
+    data = HeaderBiddingData()
+    data.add_data(rs.rand(300), random_csr(rs, 300, 50, 5))
+    rows = _window_rows(300)
+    window = data.window(rows)
+
+    assert window.sparse_features is data.sparse_features
+    assert window.num_instances() == len(rows) and data.num_instances() == 300
+    headerbids = np.concatenate([batch[0] for batch in window.make_sparse_batch(64, shuffle=False)])
+    assert np.array_equal(headerbids, data.headerbids[rows])
+    shuffled = np.concatenate([batch[0] for batch in window.make_sparse_batch(64, num_buckets=3)])
+    assert np.array_equal(np.sort(shuffled), np.sort(data.headerbids[rows]))
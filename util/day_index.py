@@ -0,0 +1,51 @@
+import numpy as np
+
+ONE_DAY = np.timedelta64(1, 'D')
+
+
+class DayIndex:
+    '''
+    The rows of a vectorized data set grouped by day, built once from the day of every row.
+    A time window is a slice of the grouped rows, i.e. a view that copies neither the rows nor the data.
+    '''
+    def __init__(self, days=None):
+        if days is None:
+            return
+        days = np.asarray(days, dtype='datetime64[D]')
+        self.order = np.argsort(days, kind='stable')  # within a day, the rows keep their original order
+        self.days, starts = np.unique(days[self.order], return_index=True)
+        self.bounds = np.append(starts, len(days))
+
+    def save(self, file_path):
+        np.savez(file_path, order=self.order, days=self.days, bounds=self.bounds)
+
+    def load(self, file_path):
+        arrays = np.load(file_path)
+        self.order, self.days, self.bounds = arrays['order'], arrays['days'], arrays['bounds']
+        return self
+
+    def rows(self, start_day, end_day):
+        ''' the rows of the days in [start_day, end_day) '''
+        start, end = np.searchsorted(self.days, np.array([start_day, end_day], dtype='datetime64[D]'))
+        return self.order[self.bounds[start]:self.bounds[end]]
+
+    def window(self, test_day, train_days, val_days=1):
+        '''
+        train on the days [test_day - train_days, test_day), validate on [test_day, test_day + val_days)
+        :return: train_rows, val_rows
+        '''
+        test_day = np.datetime64(test_day, 'D')
+        return self.rows(test_day - train_days * ONE_DAY, test_day), \
+               self.rows(test_day, test_day + val_days * ONE_DAY)
+
+    def rolling_windows(self, train_days, first_test_day=None, last_test_day=None, val_days=1, step=1):
+        '''
+        Walk-forward windows, the validation day(s) moving forward by step days each time.
+        By default, from the first day with train_days days of history before it, to the last day.
+        :return: (test_day, train_rows, val_rows) for each window
+        '''
+        test_day = np.datetime64(first_test_day, 'D') if first_test_day is not None else self.days[0] + train_days * ONE_DAY
+        last_test_day = np.datetime64(last_test_day, 'D') if last_test_day is not None else self.days[-1]
+        while test_day <= last_test_day:
+            yield (test_day,) + self.window(test_day, train_days, val_days)
+            test_day += step * ONE_DAY
@@ -0,0 +1,104 @@
+"""
+Parameter-server training on several processes: the embedding tables are partitioned over the ps tasks, and every
+worker runs its own copy of the graph (between-graph replication), pulling the embedding rows of its batch and
+pushing their sparse gradients back.
+
+Every process reads its task from the TF_CONFIG environment variable; to run a model script as a local cluster:
+    python -m util.distributed failure_rate_prediction_conf.ParametricSurvivalModels <num ps> <num workers>
+"""
+import json, os, subprocess, sys
+from itertools import islice
+import numpy as np
+import tensorflow as tf
+
+BASE_PORT = 2222
+
+
+class Cluster:
+    '''
+    The task of this process in the cluster: {"cluster": {"ps": [host:port, ...], "worker": [host:port, ...]},
+    "task": {"type": "ps" or "worker", "index": i}}. The first worker is the chief, which initializes the variables,
+    evaluates and writes the results.
+    '''
+    def __init__(self, cluster, job_name, task_index):
+        self.spec = tf.train.ClusterSpec(cluster)
+        self.job_name, self.task_index = job_name, task_index
+        self.num_ps, self.num_workers = len(cluster['ps']), len(cluster['worker'])
+        self.is_chief = job_name == 'worker' and task_index == 0
+        self.worker_device = '/job:worker/task:%d' % task_index
+        self.server = None
+
+    @classmethod
+    def from_env(cls):
+        ''' :return: the Cluster of TF_CONFIG, or None to train on this machine alone '''
+        if 'TF_CONFIG' not in os.environ:
+            return None
+        config = json.loads(os.environ['TF_CONFIG'])
+        return cls(config['cluster'], config['task']['type'], config['task']['index'])
+
+    def start(self):
+        ''' start the server of this task; a ps task then only serves its variables, until it is killed '''
+        self.server = tf.train.Server(self.spec, job_name=self.job_name, task_index=self.task_index)
+        if self.job_name == 'ps':
+            self.server.join()
+
+    def device_setter(self):
+        ''' the variables (each partition of a partitioned one) round-robin on the ps tasks, the other ops here '''
+        return tf.train.replica_device_setter(worker_device=self.worker_device, cluster=self.spec)
+
+    def partitioner(self):
+        ''' contiguous row ranges, one per ps task: embedding_lookup needs partition_strategy='div' '''
+        return tf.fixed_size_partitioner(self.num_ps)
+
+    def session(self, init_op, local_init_op, config=None):
+        ''' the chief initializes the shared variables, the other workers wait for them '''
+        session_manager = tf.train.SessionManager(local_init_op=local_init_op,
+                                                  ready_op=tf.report_uninitialized_variables(tf.global_variables()))
+        if self.is_chief:
+            return session_manager.prepare_session(self.server.target, init_op=init_op, config=config)
+        return session_manager.wait_for_session(self.server.target, config=config)
+
+    def worker_batches(self, make_plan, seed):
+        '''
+        The batches of this worker in a pass: every worker draws the same batch plan, shuffled with a RandomState of
+        the same seed, and takes every num_workers-th batch of it from the task index on. Only the rows are split:
+        the batches of the other workers are never gathered here.
+        :param make_plan: rs -> the (rows, padded length) of the batches of the pass, e.g. batch_plan(rs=rs)
+        '''
+        return islice(make_plan(np.random.RandomState(seed)), self.task_index, None, self.num_workers)
+
+
+def local_cluster(num_ps, num_workers, base_port=BASE_PORT):
+    ports = iter(range(base_port, base_port + num_ps + num_workers))
+    return {'ps': ['localhost:%d' % port for port in islice(ports, num_ps)],
+            'worker': ['localhost:%d' % port for port in islice(ports, num_workers)]}
+
+
+def launch_local(module, num_ps, num_workers, base_port=BASE_PORT):
+    '''
+    Run `python -m module` once per task of a local cluster, each with its TF_CONFIG; the ps tasks are stopped once
+    all the workers are done.
+    :return: the exit codes of the workers
+    '''
+    cluster = local_cluster(num_ps, num_workers, base_port)
+
+    def spawn(job_name, task_index):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster,
+                                                     'task': {'type': job_name, 'index': task_index}}))
+        return subprocess.Popen([sys.executable, '-m', module], env=env)
+
+    ps_tasks = [spawn('ps', i) for i in range(num_ps)]
+    workers = [spawn('worker', i) for i in range(num_workers)]
+    try:
+        return [worker.wait() for worker in workers]
+    finally:
+        for process in ps_tasks + workers:
+            if process.poll() is None:
+                process.terminate()
+
+
+if __name__ == "__main__":
+    module, num_ps, num_workers = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    exit_codes = launch_local(module, num_ps, num_workers)
+    print("Workers exited with %s" % exit_codes)
+    sys.exit(max(exit_codes))
@@ -0,0 +1,68 @@
+import re
+import tensorflow as tf
+
+'''
+The storage dtype of the embedding tables. The TF optimizers create the slots of a variable in its dtype, so the
+Adam/Adagrad slots of the tables are stored in it too; the looked-up rows are cast to float32, so the FM and the loss
+accumulate in float32.
+'bfloat16': the float32 exponent range with an 8-bit mantissa
+'float16': an 11-bit mantissa, but nothing below 6e-8 (Adam's epsilon is raised to FLOAT16_EPSILON)
+'''
+EMBEDDING_DTYPES = {'float32': tf.float32, 'bfloat16': tf.bfloat16, 'float16': tf.float16}
+FLOAT16_EPSILON = 1e-4
+
+
+def adam_epsilon(dtype_name):
+    ''' the default 1e-8 rounds to 0 in float16, and the update of a row without gradient is then 0 / 0 '''
+    return FLOAT16_EPSILON if dtype_name == 'float16' else 1e-8
+
+
+def embedding_table(name, shape, dtype_name='float32', partitioner=None, stddev=1e-5):
+    ''' a table drawn in float32 (truncated normal) and stored in the dtype of dtype_name '''
+    initializer = tf.truncated_normal_initializer(mean=0.0, stddev=stddev)
+
+    def cast_initializer(shape, dtype, partition_info=None):
+        return tf.cast(initializer(shape, tf.float32, partition_info=partition_info), dtype)
+
+    return tf.get_variable(name, shape=shape, dtype=EMBEDDING_DTYPES[dtype_name], partitioner=partitioner,
+                           initializer=cast_initializer)
+
+
+def embedding_lookup(table, ids):
+    ''' the rows of ids in float32; the gradient flows back to the table in its own dtype '''
+    return tf.cast(tf.nn.embedding_lookup(table, ids, partition_strategy='div'), tf.float32)
+
+
+def _cast_gradient(grad, dtype):
+    if isinstance(grad, tf.IndexedSlices):
+        return tf.IndexedSlices(tf.cast(grad.values, dtype), grad.indices, grad.dense_shape)
+    return None if grad is None else tf.cast(grad, dtype)
+
+
+def clip_by_global_norm(gradients, clip_norm):
+    ''' tf.clip_by_global_norm over gradients of several dtypes: the norm in float32, each gradient kept in its dtype '''
+    clipped, _ = tf.clip_by_global_norm([_cast_gradient(grad, tf.float32) for grad in gradients], clip_norm)
+    return [grad if grad is None else _cast_gradient(clip, grad.dtype) for clip, grad in zip(clipped, gradients)]
+
+
+def embedding_memory(graph=None):
+    '''
+    :return: the bytes of the embedding tables (all their partitions) and of their optimizer slots in the graph,
+             e.g. the default graph once run_graph has built its training op
+    '''
+    graph = graph or tf.get_default_graph()
+    tables, slots = 0, 0
+    for var in graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
+        if not var.op.name.startswith('embeddings_'):
+            continue
+        size = var.shape.num_elements() * var.dtype.base_dtype.size
+        if re.fullmatch(r'embeddings_\w+(/part_\d+)?', var.op.name):
+            tables += size
+        else:  # e.g. embeddings_linear/Adam_1 or embeddings_linear/part_0/Adagrad
+            slots += size
+    return tables, slots
+
+
+def print_embedding_memory(dtype_name):
+    tables, slots = embedding_memory()
+    print("Embedding tables: %.1f MB in %s, optimizer slots: %.1f MB" % (tables / 2 ** 20, dtype_name, slots / 2 ** 20))
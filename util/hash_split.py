@@ -0,0 +1,32 @@
+import hashlib
+
+TRAIN, VAL, TEST = 0, 1, 2
+FALLBACK_KEY = 'ImpressionId'  # the split key of the rows whose own key is empty
+EMPTY_VALUES = ('', 'None', 'nan')  # str() of a missing value, e.g. NaN of a pandas column
+
+
+def hash_fraction(key, salt=''):
+    ''' a stable pseudo-random float in [0.0, 1.0) of the key; unlike hash(), it does not change between runs '''
+    digest = hashlib.md5((salt + '|' + str(key)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+def assign_partition(key, train_pct, val_pct, salt=''):
+    ''' TRAIN, VAL or TEST; the same key and salt always give the same partition '''
+    frac = hash_fraction(key, salt)
+    if frac < train_pct:
+        return TRAIN
+    elif frac < train_pct + val_pct:
+        return VAL
+    return TEST
+
+
+def split_key_value(keys, split_key, fallback_key=FALLBACK_KEY):
+    '''
+    The value of split_key in keys (a row of a keys file, as a dict), or the one of fallback_key when it is empty:
+    otherwise all the anonymous impressions (no UserId) would hash to the single partition of ''.
+    '''
+    value = keys.get(split_key)
+    if value is None or value != value or str(value).strip() in EMPTY_VALUES:
+        return '%s:%s' % (fallback_key, keys[fallback_key])
+    return value
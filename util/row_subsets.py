@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class RowSubsets:
+    '''
+    Named subsets of the rows of a data set (e.g. the impressions with header bids), each kept as a bitmap
+    (np.packbits, one bit per row), so any combination is selected by ANDing bitmaps instead of rescanning the data.
+    '''
+    def __init__(self, num_rows=0):
+        self.num_rows = num_rows
+        self.bitmaps = {}
+
+    def add(self, name, mask):
+        assert len(mask) == self.num_rows
+        self.bitmaps[name] = np.packbits(np.asarray(mask, dtype=bool))
+
+    def add_rows(self, name, rows):
+        mask = np.zeros(self.num_rows, dtype=bool)
+        mask[rows] = True
+        self.add(name, mask)
+
+    def mask(self, *names):
+        ''' the rows in all the named subsets '''
+        bits = np.full((self.num_rows + 7) // 8, 0xFF, dtype=np.uint8)
+        for name in names:
+            bits &= self.bitmaps[name]
+        return np.unpackbits(bits, count=self.num_rows).astype(bool)
+
+    def rows(self, *names):
+        return np.flatnonzero(self.mask(*names))
+
+    def count(self, *names):
+        return int(self.mask(*names).sum())
+
+    def save(self, file_path):
+        np.savez(file_path, num_rows=self.num_rows, **self.bitmaps)
+
+    def load(self, file_path):
+        arrays = np.load(file_path)
+        self.num_rows = int(arrays['num_rows'])
+        self.bitmaps = {name: arrays[name] for name in arrays.files if name != 'num_rows'}
+        return self
@@ -0,0 +1,123 @@
+import os, pickle, shutil
+import numpy as np
+from scipy import sparse
+
+SHARD_NAME = 'shard_%05d.npz'
+META_NAME = 'shards.p'
+BUFFER_SHARDS = 4  # shards held in memory at once by iter_shard_buffers
+BUCKET_ROWS = 2000000  # rows held in memory at once by shuffle_shards
+BUCKET_DIR_NAME = 'buckets'
+
+
+def write_shard(dir_path, shard_no, **arrays):
+    ''' :param arrays: the rows of the shard, as numpy arrays or csr matrices '''
+    flat = {}
+    for name, arr in arrays.items():
+        if sparse.issparse(arr):
+            arr = arr.tocsr()
+            flat.update({'%s__data' % name: arr.data, '%s__indices' % name: arr.indices,
+                         '%s__indptr' % name: arr.indptr, '%s__shape' % name: np.array(arr.shape)})
+        else:
+            flat[name] = np.asarray(arr)
+    np.savez(os.path.join(dir_path, SHARD_NAME % shard_no), **flat)
+
+
+def read_shard(file_path):
+    arrays = np.load(file_path)
+    shard = {}
+    for key in arrays.files:
+        name, _, part = key.partition('__')
+        if not part:
+            shard[name] = arrays[key]
+        elif part == 'data':
+            shard[name] = sparse.csr_matrix((arrays[key], arrays[name + '__indices'], arrays[name + '__indptr']),
+                                            shape=tuple(arrays[name + '__shape']))
+    return shard
+
+
+def write_shard_meta(dir_path, num_rows, **info):
+    ''' :param num_rows: the number of rows of every shard '''
+    pickle.dump(dict(info, num_rows=list(num_rows)), open(os.path.join(dir_path, META_NAME), 'wb'))
+
+
+def load_shard_meta(dir_path):
+    ''' :return: the paths of the shards and the meta information written by write_shard_meta '''
+    meta = pickle.load(open(os.path.join(dir_path, META_NAME), 'rb'))
+    return [os.path.join(dir_path, SHARD_NAME % shard_no) for shard_no in range(len(meta['num_rows']))], meta
+
+
+def _concatenate(values):
+    if sparse.issparse(values[0]):
+        return sparse.vstack(values, format='csr')
+    return np.concatenate(values)
+
+
+def _num_rows(arrays):
+    return next(iter(arrays.values())).shape[0]
+
+
+def iter_shard_buffers(shard_paths, buffer_shards=BUFFER_SHARDS, shuffle=True, read=read_shard, rs=None):
+    '''
+    The shards buffer_shards at a time, concatenated; at most buffer_shards shards are in memory.
+    With shuffling the shards are taken in a random order, so a buffer mixes shards from all over the data set;
+    the rows within a buffer are then to be permuted by the reader.
+    :param read: file path -> {name: rows}, e.g. read_shard followed by a per-shard preprocessing
+    :param rs: the np.random.RandomState of the order of the shards; the global one by default
+    :return: {name: rows of the buffer} for each buffer
+    '''
+    order = (np.random if rs is None else rs).permutation(len(shard_paths)) if shuffle else np.arange(len(shard_paths))
+    for start in range(0, len(order), buffer_shards):
+        shards = [read(shard_paths[i]) for i in order[start: start + buffer_shards]]
+        yield {name: _concatenate([shard[name] for shard in shards]) for name in shards[0]}
+
+
+def shuffle_shards(in_dir, out_dir, bucket_rows=BUCKET_ROWS, seed=None):
+    '''
+    Two-pass external shuffle of the shards of in_dir into shards of the same size in out_dir:
+    1. each row is scattered into one of num_rows / bucket_rows buckets on disk, drawn at random
+    2. each bucket, which fits in memory, is loaded, permuted and appended to the shards of out_dir
+    Random buckets each permuted uniformly make a uniform permutation of all the rows, so reading out_dir sequentially
+    gives a globally shuffled data set without ever holding more than a bucket in memory.
+    '''
+    shard_paths, meta = load_shard_meta(in_dir)
+    info = {key: value for key, value in meta.items() if key != 'num_rows'}
+    shard_size = max(meta['num_rows'], default=0)
+    num_buckets = max(1, -(-sum(meta['num_rows']) // bucket_rows))
+    rng = np.random.RandomState(seed)
+
+    bucket_dirs = [os.path.join(out_dir, BUCKET_DIR_NAME, '%05d' % bucket) for bucket in range(num_buckets)]
+    for bucket_dir in bucket_dirs:
+        os.makedirs(bucket_dir, exist_ok=True)
+
+    ''' pass 1: scatter; each input shard adds one piece to each bucket '''
+    for shard_no, shard_path in enumerate(shard_paths):
+        shard = read_shard(shard_path)
+        buckets = rng.randint(num_buckets, size=meta['num_rows'][shard_no])
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.searchsorted(buckets[order], np.arange(num_buckets + 1))
+        for bucket_dir, start, end in zip(bucket_dirs, bounds[:-1], bounds[1:]):
+            if end > start:
+                write_shard(bucket_dir, shard_no, **{name: rows[order[start: end]] for name, rows in shard.items()})
+
+    ''' pass 2: shuffle each bucket in memory and write it out in order '''
+    num_rows, pending = [], None
+    for bucket_dir in bucket_dirs:
+        pieces = [read_shard(os.path.join(bucket_dir, name)) for name in sorted(os.listdir(bucket_dir))]
+        if not pieces:
+            continue
+        bucket = {name: _concatenate([piece[name] for piece in pieces]) for name in pieces[0]}
+        perm = rng.permutation(_num_rows(bucket))
+        bucket = {name: rows[perm] for name, rows in bucket.items()}
+        pending = bucket if pending is None else {name: _concatenate([pending[name], bucket[name]]) for name in bucket}
+        while _num_rows(pending) >= shard_size:
+            write_shard(out_dir, len(num_rows), **{name: rows[:shard_size] for name, rows in pending.items()})
+            num_rows.append(shard_size)
+            pending = {name: rows[shard_size:] for name, rows in pending.items()}
+        shutil.rmtree(bucket_dir)
+
+    if pending is not None and _num_rows(pending):
+        write_shard(out_dir, len(num_rows), **pending)
+        num_rows.append(_num_rows(pending))
+    shutil.rmtree(os.path.join(out_dir, BUCKET_DIR_NAME))
+    write_shard_meta(out_dir, num_rows, **info)
+    print("Shuffled %d rows of %s through %d buckets into %s" % (sum(num_rows), in_dir, num_buckets, out_dir))
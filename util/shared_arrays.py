@@ -0,0 +1,133 @@
+"""
+Numpy arrays in POSIX shared memory, published once by a hosting process and attached zero-copy by name from the
+others, so the processes training or evaluating on the same data set share one copy of it instead of loading one each.
+
+A published set is two segments: <name>_header (a reference count, then the pickled layout of the arrays and their
+metadata) and <name> (the arrays, each at an aligned offset). The host holds one reference and every process attached
+one; the reference count is updated under a lock file, and the last process to release its reference unlinks the
+segments. A reference not released explicitly is released when its SharedArrays is garbage collected or at exit.
+"""
+import fcntl, os, pickle, signal, tempfile, weakref
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+ALIGNMENT = 64  # bytes, the offset of every array in the segment
+LOCK_DIR = tempfile.gettempdir()
+_COUNT = np.dtype(np.int64)
+
+
+@contextmanager
+def _locked(name):
+    with open(os.path.join(LOCK_DIR, '%s.lock' % name), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _segment(name, size=0):
+    ''' open (size 0) or create a segment, untracked: the resource tracker would unlink it when this process exits '''
+    segment = shared_memory.SharedMemory(name, create=size > 0, size=size)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def _add_refs(header, delta):
+    ''' :return: the reference count after adding delta '''
+    refs = np.ndarray((1,), dtype=_COUNT, buffer=header.buf)
+    refs[0] += delta
+    count = int(refs[0])
+    del refs  # no view may outlive the segment
+    return count
+
+
+def _release(name, header, segment):
+    with _locked(name):
+        last = _add_refs(header, -1) == 0
+    for shm in (segment, header):
+        if last:
+            resource_tracker.register(shm._name, 'shared_memory')  # unlink() unregisters it
+            shm.unlink()
+        try:
+            shm.close()
+        except BufferError:  # arrays of the segment are still referenced; unmapped at exit
+            pass
+    if last:
+        os.remove(os.path.join(LOCK_DIR, '%s.lock' % name))
+
+
+class SharedArrays:
+    '''
+    A named set of arrays in shared memory: .arrays maps each name to a read-only array on the segment, .meta holds
+    the picklable values published with them. release() gives up the reference of this process.
+    '''
+    def __init__(self, name, header, segment):
+        self.name = name
+        size = int(np.ndarray((1,), dtype=_COUNT, buffer=header.buf, offset=_COUNT.itemsize)[0])
+        layout, self.meta = pickle.loads(bytes(header.buf[2 * _COUNT.itemsize: 2 * _COUNT.itemsize + size]))
+        self.arrays = {}
+        for key, (offset, dtype, shape) in layout.items():
+            array = np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=offset)
+            array.flags.writeable = False
+            self.arrays[key] = array
+        self._finalizer = weakref.finalize(self, _release, name, header, segment)
+
+    @classmethod
+    def publish(cls, name, arrays, meta=None):
+        '''
+        Copy the arrays into new segments named after name, with a reference for this process.
+        :param arrays: {key: numpy array}, of any dtype but object
+        '''
+        layout, size = {}, 0
+        for key, array in arrays.items():
+            array = np.asarray(array)
+            size = -(-size // ALIGNMENT) * ALIGNMENT
+            layout[key] = (size, array.dtype.str, array.shape)
+            size += array.nbytes
+        pickled = pickle.dumps((layout, meta))
+
+        segment = _segment(name, max(size, 1))
+        for key, array in arrays.items():
+            offset, dtype, shape = layout[key]
+            np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=offset)[...] = array
+        header = _segment('%s_header' % name, 2 * _COUNT.itemsize + len(pickled))
+        np.ndarray((2,), dtype=_COUNT, buffer=header.buf)[:] = (1, len(pickled))
+        header.buf[2 * _COUNT.itemsize: 2 * _COUNT.itemsize + len(pickled)] = pickled
+        return cls(name, header, segment)
+
+    @classmethod
+    def attach(cls, name):
+        ''' :raise FileNotFoundError: if nothing is published under name '''
+        header = _segment('%s_header' % name)
+        with _locked(name):
+            if _add_refs(header, 0) == 0:  # being released by its last process
+                header.close()
+                raise FileNotFoundError('%s is no longer shared' % name)
+            segment = _segment(name)
+            _add_refs(header, 1)
+        return cls(name, header, segment)
+
+    def release(self):
+        self._finalizer()
+
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+
+def serve(shared):
+    '''
+    Keep the published SharedArrays until this process is interrupted (Ctrl-C or SIGTERM), then release them; the
+    segments are freed once the processes attached have released them too.
+    '''
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print("Hosting %s (%.1f MB); Ctrl-C to stop" % (', '.join(s.name for s in shared),
+                                                    sum(s.nbytes() for s in shared) / 2 ** 20))
+    try:
+        signal.pause()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for s in shared:
+            s.release()
@@ -0,0 +1,95 @@
+import numpy as np
+
+
+def pad_csr_rows(csr, max_len):
+    '''
+    The indices and values of every row of a csr matrix, padded with 0 to max_len (like pad_sequences with
+    padding='post'; longer rows keep their last max_len nonzeros), without a Python loop over the rows.
+    :return: indices (num_rows, max_len) int32, values (num_rows, max_len) float32
+    '''
+    num_rows = csr.shape[0]
+    indices, data = csr.indices, csr.data
+    lengths = np.diff(csr.indptr)
+    row_ids = np.repeat(np.arange(num_rows), lengths)
+    positions = np.arange(len(row_ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions -= np.maximum(lengths - max_len, 0)[row_ids]
+    fits = positions >= 0
+
+    indices_batch = np.zeros((num_rows, max_len), dtype=np.int32)
+    values_batch = np.zeros((num_rows, max_len), dtype=np.float32)
+    indices_batch[row_ids[fits], positions[fits]] = indices[fits]
+    values_batch[row_ids[fits], positions[fits]] = data[fits]
+    return indices_batch, values_batch
+
+
+def row_min_max(csr):
+    ''' the min and max of the nonzeros of every row; 0.0 for the rows without any '''
+    num_rows = csr.shape[0]
+    nonempty = np.diff(csr.indptr) > 0
+    mins, maxs = np.zeros(num_rows), np.zeros(num_rows)
+    if nonempty.any():
+        starts = csr.indptr[:-1][nonempty]
+        mins[nonempty] = np.minimum.reduceat(csr.data, starts)
+        maxs[nonempty] = np.maximum.reduceat(csr.data, starts)
+    return mins, maxs
+
+
+def ragged_positions(starts, lengths):
+    ''' positions of all elements of the segments [starts[i], starts[i] + lengths[i]), e.g. of some rows of a csr '''
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def batch_rows(num_rows, batch_size, shuffle=True, rows=None, rs=None):
+    '''
+    The rows of each batch of an epoch, so that a reader gathers only the rows of the batch instead of reordering
+    all its data. Without shuffling the batches are contiguous slices (views); with shuffling, the rows of a batch
+    are sorted so that the gather walks the data forward.
+    :param rows: the rows to iterate (e.g. a filtered subset); all num_rows rows by default
+    :param rs: the np.random.RandomState of the shuffling (e.g. seeded alike in all the workers of a cluster);
+               the global one of np.random by default
+    :return: slice or int array for each batch
+    '''
+    if rows is None and not shuffle:
+        for start in range(0, num_rows, batch_size):
+            yield slice(start, min(start + batch_size, num_rows))
+        return
+
+    order = np.arange(num_rows) if rows is None else np.asarray(rows)
+    if shuffle:
+        order = order[(np.random if rs is None else rs).permutation(len(order))]
+    for start in range(0, len(order), batch_size):
+        yield np.sort(order[start: start + batch_size]) if shuffle else order[start: start + batch_size]
+
+
+def bucket_batch_rows(lengths, batch_size, num_buckets, shuffle=True, rows=None, rs=None):
+    '''
+    Like batch_rows, but the batches are taken within num_buckets buckets of rows of similar lengths (split at the
+    quantiles of the lengths), so a batch is padded only to the longest row of its bucket.
+    With shuffling, the rows of each bucket and the order of all the batches are shuffled: an epoch still takes
+    every row once, in a random order.
+    :param lengths: the number of nonzeros of every row
+    :param rs: as in batch_rows
+    :return: (rows, padded length) for each batch
+    '''
+    rs = np.random if rs is None else rs
+    rows = np.arange(len(lengths)) if rows is None else np.asarray(rows)
+    row_lengths = np.asarray(lengths)[rows]
+    bounds = np.unique(np.quantile(row_lengths, np.linspace(0, 1, num_buckets + 1)[1:-1])) if len(rows) else []
+    bucket_ids = np.searchsorted(bounds, row_lengths)
+
+    batches = []
+    for bucket_id in range(len(bounds) + 1):
+        in_bucket = bucket_ids == bucket_id
+        if not in_bucket.any():
+            continue
+        bucket_rows = rows[in_bucket]
+        if shuffle:
+            bucket_rows = bucket_rows[rs.permutation(len(bucket_rows))]
+        max_len = max(int(row_lengths[in_bucket].max()), 1)
+        batches.extend((bucket_rows[start: start + batch_size], max_len)
+                       for start in range(0, len(bucket_rows), batch_size))
+
+    for i in (rs.permutation(len(batches)) if shuffle else range(len(batches))):
+        batch, max_len = batches[i]
+        yield (np.sort(batch) if shuffle else batch), max_len
@@ -0,0 +1,51 @@
+import tensorflow as tf
+
+'''
+'adam': tf.train.AdamOptimizer, whose sparse update still decays the moments of every row of a table at every step
+'lazy_adam', 'adagrad': only the rows of the batch (and their slots) are read and written
+'''
+OPTIMIZERS = ('adam', 'lazy_adam', 'adagrad')
+SPARSE_OPTIMIZERS = ('lazy_adam', 'adagrad')  # the only ones for unlocked (Hogwild) training threads
+
+
+def make_optimizer(name, learning_rate, epsilon=1e-8):
+    ''' :param epsilon: of the Adam updates, e.g. util.embedding_precision.adam_epsilon of float16 tables '''
+    assert name in OPTIMIZERS
+    if name == 'lazy_adam':
+        return tf.contrib.opt.LazyAdamOptimizer(learning_rate=learning_rate, epsilon=epsilon)
+    if name == 'adagrad':
+        return tf.train.AdagradOptimizer(learning_rate=learning_rate)
+    return tf.train.AdamOptimizer(learning_rate=learning_rate, epsilon=epsilon)
+
+
+def _clip_rows(grad, clip_norm):
+    '''
+    sum the values of each index, then clip the norm of each row, in float32 whatever the dtype of the table;
+    the gradient stays an IndexedSlices
+    '''
+    indices, positions = tf.unique(grad.indices)
+    values = tf.unsorted_segment_sum(tf.cast(grad.values, tf.float32), positions, tf.shape(indices)[0])
+    if values.shape.ndims == 1:  # the rows of embeddings_linear are scalars
+        values = tf.clip_by_value(values, -clip_norm, clip_norm)
+    else:
+        values = tf.clip_by_norm(values, clip_norm, axes=list(range(1, values.shape.ndims)))
+    return tf.IndexedSlices(tf.cast(values, grad.values.dtype), indices, grad.dense_shape)
+
+
+def clip_sparse_gradients(grads_and_vars, clip_norm):
+    '''
+    The gradients of the embedding lookups (IndexedSlices) clipped row by row, so a step costs the rows of the batch
+    whatever the size of the tables; the dense gradients are clipped together by their global norm.
+    '''
+    grads_and_vars = list(grads_and_vars)
+    dense = [i for i, (grad, _) in enumerate(grads_and_vars) if grad is not None and not isinstance(grad, tf.IndexedSlices)]
+    dense_clipped = {}
+    if dense:
+        dense_clipped = dict(zip(dense, tf.clip_by_global_norm([grads_and_vars[i][0] for i in dense], clip_norm)[0]))
+
+    clipped = []
+    for i, (grad, var) in enumerate(grads_and_vars):
+        if isinstance(grad, tf.IndexedSlices):
+            grad = _clip_rows(grad, clip_norm)
+        clipped.append((dense_clipped.get(i, grad), var))
+    return clipped
@@ -0,0 +1,99 @@
+import io, os
+from itertools import islice
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+BLOCK_SIZE = 64 * 1024 * 1024  # bytes read and tokenized at once
+
+_TOKEN_SEPARATORS = bytes.maketrans(b',:\r', b'\n\n\n')  # one number per line for the C parser
+
+
+def _parse_block(block, num_scalars):
+    buf = np.frombuffer(block, dtype=np.uint8)
+    eols = np.flatnonzero(buf == ord('\n'))
+    nnz = np.bincount(np.searchsorted(eols, np.flatnonzero(buf == ord(':'))), minlength=len(eols))
+    num_tokens = num_scalars * len(eols) + 2 * int(nnz.sum())
+    if num_tokens == 0:
+        return np.empty((len(eols), num_scalars)), nnz, np.empty(0, dtype=np.int32), np.empty(0)
+
+    numbers = pd.read_csv(io.BytesIO(block.translate(_TOKEN_SEPARATORS)), header=None, dtype=np.float64,
+                          engine='c', skip_blank_lines=True).values.ravel()
+    assert len(numbers) == num_tokens
+
+    ''' every line holds num_scalars numbers followed by the "index:value" pairs '''
+    line_starts = np.cumsum(num_scalars + 2 * nnz) - (num_scalars + 2 * nnz)
+    scalar_positions = line_starts[:, None] + np.arange(num_scalars)
+    pair_mask = np.ones(len(numbers), dtype=bool)
+    pair_mask[scalar_positions.ravel()] = False
+    pairs = numbers[pair_mask].reshape(-1, 2)
+
+    return numbers[scalar_positions], nnz, pairs[:, 0].astype(np.int32), pairs[:, 1]
+
+
+def read_sparse_vectors(file_path, num_scalars=0, has_header=True, block_size=BLOCK_SIZE):
+    '''
+    Read a file whose lines are "s_1,...,s_num_scalars,index:value,index:value,..." (the vector files
+    written by the Vectorizers) block by block, without a Python loop over the lines or nodes.
+    :param num_scalars: the number of leading plain numbers of each line (e.g. 2 for 'duration' and 'event')
+    :return: header (the int on the first line, or None), scalars (num_rows x num_scalars), indptr, indices, data
+    '''
+    total_size = os.path.getsize(file_path)
+    header = None
+    scalars, nnz, indices, data = [], [], [], []
+    num_rows = 0
+    with open(file_path, 'rb') as infile:
+        if has_header:
+            header = int(infile.readline().split(b',')[0])
+
+        while True:
+            block = infile.read(block_size)
+            if not block:
+                break
+            block += infile.readline()  # complete the last line
+            if not block.endswith(b'\n'):
+                block += b'\n'
+
+            block_scalars, block_nnz, block_indices, block_data = _parse_block(block, num_scalars)
+            scalars.append(block_scalars)
+            nnz.append(block_nnz)
+            indices.append(block_indices)
+            data.append(block_data)
+            num_rows += len(block_nnz)
+            print('%s: %d rows (%.2f%%)' % (os.path.basename(file_path), num_rows, infile.tell() / total_size * 100))
+
+    nnz = np.concatenate(nnz) if nnz else np.empty(0, dtype=np.int64)
+    indptr = np.concatenate(([0], np.cumsum(nnz))).astype(np.int64)
+    return header, \
+           np.concatenate(scalars) if scalars else np.empty((0, num_scalars)), \
+           indptr, \
+           np.concatenate(indices) if indices else np.empty(0, dtype=np.int32), \
+           np.concatenate(data) if data else np.empty(0)
+
+
+def iter_sparse_vector_blocks(file_path, num_scalars=0, has_header=True, lines_per_block=100000):
+    '''
+    Like read_sparse_vectors, but yields the lines block by block, lines_per_block lines at a time, so the blocks of
+    files with one line per row (e.g. a feature vector file and its header bids file) stay aligned.
+    :return: scalars, indptr, indices, data of every block
+    '''
+    with open(file_path, 'rb') as infile:
+        if has_header:
+            infile.readline()
+
+        while True:
+            block = b''.join(islice(infile, lines_per_block))
+            if not block:
+                break
+            if not block.endswith(b'\n'):
+                block += b'\n'
+
+            scalars, nnz, indices, data = _parse_block(block, num_scalars)
+            yield scalars, np.concatenate(([0], np.cumsum(nnz))).astype(np.int64), indices, data
+
+
+def to_csr_matrix(indptr, indices, data, num_columns):
+    ''' duplicate indices of a row are summed, as when converting the coo_matrix of the nodes '''
+    mat = csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, num_columns))
+    mat.sum_duplicates()
+    return mat
@@ -0,0 +1,141 @@
+"""
+Hyperparameter sweeps: the trials of a grid or of a random search space run concurrently in a process pool, each
+process on its own cores with a pinned number of threads, and their results (validation loss, C-index, epochs, wall
+time) are collected into one table.
+With successive halving, a trial reaching a rung (min_epochs, min_epochs * eta, min_epochs * eta^2, ... epochs) goes on
+only if its validation loss is in the best 1/eta of the losses reported at that rung so far; the rungs are shared by
+all the processes and no trial waits for the others, so the poor configurations stop after an epoch or two.
+"""
+import functools, itertools, multiprocessing, os, time, traceback
+import numpy as np
+import pandas as pd
+
+
+def grid(space):
+    ''' :param space: {name: the values to try}; :return: the params of every combination '''
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def log_uniform(low, high):
+    ''' a dimension of a random search space, drawn uniformly in log scale between low and high '''
+    return lambda rng: float(np.exp(rng.uniform(np.log(low), np.log(high))))
+
+
+def random_search(space, num_trials, seed=None):
+    '''
+    :param space: {name: a list of values drawn uniformly, or a function of a np.random.RandomState (log_uniform)}
+    :return: the params of num_trials trials
+    '''
+    rng = np.random.RandomState(seed)
+    return [{name: dimension(rng) if callable(dimension) else dimension[rng.randint(len(dimension))]
+             for name, dimension in sorted(space.items())}
+            for _ in range(num_trials)]
+
+
+class SuccessiveHalving:
+    '''
+    The stop_early of run_graph for the trials of a sweep: called as stop_early(epoch, validation loss) after every
+    epoch, True when the epoch is a rung and the loss is not in the best 1/eta reported at that rung. The first eta - 1
+    trials reaching a rung always go on, as there is nothing to compare them with yet. The trials of different groups
+    (e.g. agents, whose losses are not comparable) have separate rungs.
+    '''
+    def __init__(self, manager, min_epochs=1, eta=3):
+        ''' :param manager: a multiprocessing Manager, whose dict and lock share the rungs between the processes '''
+        self.min_epochs, self.eta = min_epochs, eta
+        self.rungs = manager.dict()  # (group, rung epoch) -> the losses reported at it
+        self.lock = manager.Lock()
+
+    def is_rung(self, epoch):
+        rung = self.min_epochs
+        while rung < epoch:
+            rung *= self.eta
+        return rung == epoch
+
+    def __call__(self, epoch, loss, group=None):
+        if not self.is_rung(epoch):
+            return False
+        with self.lock:
+            losses = self.rungs.get((group, epoch), []) + [loss]
+            self.rungs[group, epoch] = losses
+        if len(losses) < self.eta:
+            return False
+        return loss > np.sort(losses)[-(-len(losses) // self.eta) - 1]
+
+
+_worker = {}  # the data loaded by this process of the pool
+
+
+def _init_worker(cores, threads_per_trial, pin_threads, load):
+    core_set = cores.get()
+    if core_set and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, core_set)
+    os.environ['OMP_NUM_THREADS'] = str(threads_per_trial)
+    if pin_threads is not None:
+        pin_threads(threads_per_trial)
+    _worker['data'] = load() if load is not None else None
+
+
+def _run_trial(args):
+    ''' a trial in its own working directory, so the files written by run_graph do not clobber the other trials' '''
+    trial, trial_no, params, stop_early, halving_group, trials_dir = args
+    if stop_early is not None and halving_group is not None:
+        stop_early = functools.partial(stop_early, group=params[halving_group])
+    cwd = os.getcwd()
+    os.makedirs(os.path.join(trials_dir, 'trial_%03d' % trial_no), exist_ok=True)
+    os.chdir(os.path.join(trials_dir, 'trial_%03d' % trial_no))
+    start = time.time()
+    try:
+        result = trial(params, _worker['data'], stop_early)
+    except Exception:
+        result = {'error': traceback.format_exc(limit=1).strip().splitlines()[-1]}
+    finally:
+        os.chdir(cwd)
+    return dict(trial=trial_no, **params, **result, wall_time=time.time() - start)
+
+
+def run_sweep(trial, trials, load=None, pin_threads=None, threads_per_trial=1, num_processes=None, halving=True,
+              min_epochs=1, eta=3, halving_group=None, trials_dir='sweep', results_path=None):
+    '''
+    :param trial: a module-level function trial(params, data, stop_early) training one configuration and returning
+                  a dict of its results, e.g. {'val_loss': ..., 'c_index': ..., 'epochs': ...}
+    :param trials: the params of every trial, e.g. of grid or random_search
+    :param load: a module-level function returning the data of the trials, called once by each process
+    :param pin_threads: a module-level function setting the thread pools of the models to threads_per_trial
+    :param num_processes: the trials run concurrently; by default as many as fit on the cores
+    :param halving: stop the poor trials at the rungs of SuccessiveHalving(min_epochs, eta), otherwise stop_early
+                    is None
+    :param halving_group: a param whose values are halved separately, e.g. the header bidding agent
+    :param trials_dir: the working directories of the trials, trials_dir/trial_<no>
+    :param results_path: where to write the results table as csv
+    :return: the results table, best validation loss first
+    '''
+    num_cores = os.cpu_count() or 1
+    num_processes = num_processes or max(1, num_cores // threads_per_trial)
+    trials_dir = os.path.abspath(trials_dir)
+
+    ''' spawn: TensorFlow is not fork-safe '''
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        stop_early = SuccessiveHalving(manager, min_epochs, eta) if halving else None
+        cores = context.Queue()
+        for process_no in range(num_processes):
+            first = process_no * threads_per_trial
+            cores.put(set(range(first, first + threads_per_trial)) if first + threads_per_trial <= num_cores else None)
+
+        tasks = [(trial, trial_no, params, stop_early, halving_group, trials_dir) for trial_no, params in enumerate(trials)]
+        results = []
+        with context.Pool(num_processes, initializer=_init_worker,
+                          initargs=(cores, threads_per_trial, pin_threads, load)) as pool:
+            for result in pool.imap_unordered(_run_trial, tasks):
+                results.append(result)
+                print("Trial %d done (%d/%d) in %.0fs: %s" % (result['trial'], len(results), len(trials),
+                                                            result['wall_time'], result))
+
+    table = pd.DataFrame(results)
+    if 'val_loss' in table:  # the failed trials (error) last
+        table = table.sort_values('val_loss', na_position='last')
+    if results_path is not None:
+        table.to_csv(results_path, index=False)
+    print(table.to_string(index=False))
+    return table
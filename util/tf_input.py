@@ -0,0 +1,127 @@
+import threading
+import numpy as np
+import tensorflow as tf
+from time import time as nowtime
+
+PREFETCH_BATCHES = 4  # batches converted to tensors ahead of the training step
+GATHER_THREADS = 4  # batches gathered at once by rows_initializer
+
+
+class BatchInput:
+    '''
+    The input tensors of a model, read from a tf.data pipeline instead of placeholders fed through feed_dict.
+    Each source of batches (e.g. the training or the validation data set) gets its own initializer, and a pass over
+    the source ends with tf.errors.OutOfRangeError. A data set with batch_plan and gather_batch (SurvivalData,
+    HeaderBiddingData and their sharded versions) only plans the rows of its batches in Python; tf.data gathers the
+    batches from its arrays, GATHER_THREADS at once (rows_initializer). Any other source is a generator of batches
+    run by tf.data in one background thread (initializer). Both run PREFETCH_BATCHES ahead.
+    A pass started by start() and stepped by run() also measures the starvation of the consumer: a step waited when
+    its batch was ready only after the step asked for it, for the time in between.
+    '''
+    def __init__(self, dtypes, shapes):
+        '''
+        :param dtypes: the dtype of each array of a batch
+        :param shapes: the shape of each array of a batch, None for the batch size and the padded row length
+        '''
+        self.dtypes = tuple(dtypes)
+        self.shapes = tuple(tf.TensorShape(shape) for shape in shapes)
+        self.iterator = tf.data.Iterator.from_structure(self.dtypes, self.shapes)
+        self.next_batch = self.iterator.get_next()
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def initializer(self, make_batches):
+        '''
+        :param make_batches: a function returning a new generator of batches for every pass; values after the
+                             first len(dtypes) of a batch (e.g. the max_len of make_sparse_batch) are dropped
+        '''
+        num_arrays = len(self.dtypes)
+
+        def batches():
+            for batch_no, batch in enumerate(make_batches()):
+                self._ready(batch_no)
+                yield batch[:num_arrays]
+        dataset = tf.data.Dataset.from_generator(batches, self.dtypes, self.shapes)
+        return self.iterator.make_initializer(dataset.prefetch(PREFETCH_BATCHES))
+
+    def rows_initializer(self, make_plan, gather):
+        '''
+        Only the batch numbers go through tf.data; the rows of each batch are kept here and the batch is gathered
+        from the arrays of the data set in the map of the dataset, GATHER_THREADS batches at once and in order.
+        :param make_plan: a function returning the (rows, padded length) of the batches of a new pass, e.g. batch_plan
+        :param gather: (rows, padded length) -> the arrays of the batch, e.g. gather_batch; it takes the entries of
+                       the plan as they are (a sharded plan also holds the buffer of the rows)
+        '''
+        num_arrays = len(self.dtypes)
+        plan = {}  # batch no. -> (rows, padded length), until the batch is gathered
+
+        def batch_nos():
+            plan.clear()  # of a pass that was not run to its end
+            for batch_no, batch_rows in enumerate(make_plan()):
+                plan[batch_no] = batch_rows
+                yield batch_no
+
+        def gather_batch(batch_no):
+            batch = gather(*plan.pop(int(batch_no)))[:num_arrays]
+            self._ready(int(batch_no))
+            return tuple(np.asarray(arr, dtype=dtype.as_numpy_dtype) for arr, dtype in zip(batch, self.dtypes))
+
+        def gather_tensors(batch_no):
+            tensors = tf.py_func(gather_batch, [batch_no], self.dtypes, stateful=True)
+            for tensor, shape in zip(tensors, self.shapes):
+                tensor.set_shape(shape)
+            return tuple(tensors)
+
+        dataset = tf.data.Dataset.from_generator(batch_nos, tf.int64, tf.TensorShape([]))
+        dataset = dataset.map(gather_tensors, num_parallel_calls=GATHER_THREADS)
+        return self.iterator.make_initializer(dataset.prefetch(PREFETCH_BATCHES))
+
+    def data_initializer(self, data, take=None, **batch_args):
+        '''
+        The initializer of the batches of data.make_sparse_batch(**batch_args): rows_initializer if data plans its
+        batches (batch_plan, gather_batch), else initializer.
+        :param take: a function of make_plan (rs -> the batch plan of a pass shuffled with the np.random.RandomState
+                     rs) to the entries of the plan to take, e.g. Cluster.worker_batches; needs batch_plan
+        '''
+        if not hasattr(data, 'batch_plan'):
+            if take:
+                raise ValueError("%s has no batch_plan to take the batches from" % type(data).__name__)
+            return self.initializer(lambda: data.make_sparse_batch(**batch_args))
+        make_plan = lambda rs=None: data.batch_plan(rs=rs, **batch_args)
+        return self.rows_initializer((lambda: take(make_plan)) if take else make_plan, data.gather_batch)
+
+    def _ready(self, batch_no):
+        ''' the batch_no-th batch of the pass is ready, for the run() taking it '''
+        with self.lock:
+            self.ready_times[batch_no] = nowtime()
+
+    def reset_stats(self):
+        self.ready_times = {}  # batch no. -> when the batch was ready; under the lock, like the counters
+        self.num_requested, self.num_batches, self.num_starved, self.wait_time = 0, 0, 0, 0.0
+
+    def start(self, sess, initializer, *fetches):
+        ''' start a pass over the batches of initializer, with the other fetches (e.g. of the running metrics) '''
+        self.reset_stats()
+        sess.run((initializer,) + fetches)
+
+    def run(self, sess, fetches):
+        '''
+        sess.run of fetches taking the next batch, timed against its readiness; several threads may run steps at
+        once (Hogwild), the k-th step to start is then compared with the k-th batch.
+        :raise tf.errors.OutOfRangeError: at the end of the pass
+        '''
+        with self.lock:
+            batch_no = self.num_requested
+            self.num_requested += 1
+        start = nowtime()
+        values = sess.run(fetches)
+        with self.lock:
+            ready = self.ready_times.pop(batch_no, start)
+            self.num_batches += 1
+            if ready > start:
+                self.num_starved += 1
+                self.wait_time += ready - start
+        return values
+
+    def report(self, name):
+        print("%s: waited for %d/%d batches (%.2fs in total)" % (name, self.num_starved, self.num_batches, self.wait_time))